@@ -46,6 +46,13 @@ class GameChangeStateError(PublicError):
     Indicates error when changing the state of a game.
     """
 
+class DrawImpossible(GameChangeStateError):
+    """
+    Public Error
+
+    No draw can meet the exclusions set for a game.
+    """
+
 class SessionError(PublicError):
     """
     Public Error
@@ -74,6 +81,13 @@ class Exists(PublicError):
     Indicates that there is a conflict or something already exists.
     """
 
+class ImportValidationError(PublicError):
+    """
+    Public Error
+
+    Rows in a bulk import refer to rows that don't exist or are duplicated, nothing was imported.
+    """
+
 class DatabaseChangeError(PrivateError):
     """
     Private Error
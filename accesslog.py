@@ -0,0 +1,72 @@
+"""
+Structured access log, each request is written as one line of json.
+
+Lines are queued and written by a background thread so requests never wait on
+stdout. If the queue is full the line is dropped and counted instead of blocking.
+"""
+
+import json
+import queue
+import random
+import sys
+import threading
+
+class AccessLog:
+    """
+    :param stream: File like object to write lines to.
+    :param max_queue: Most lines waiting to be written before new lines are dropped.
+    :param sample_rate: Fraction of successful requests to log, errors are always logged.
+    """
+
+    def __init__(self,stream=None,max_queue:int=10000,sample_rate:float=1.0):
+        self.stream = stream if stream is not None else sys.stdout
+        self.sample_rate = sample_rate
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self.dropped = 0
+        self.written = 0
+        self.sampled_out = 0
+        self._writer = threading.Thread(target=self._run,name='access-log',daemon=True)
+        self._writer.start()
+
+    def log(self,record:dict,success:bool=True):
+        """
+        Queue a record to be written, never blocks.
+        """
+        if success and self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            with self._lock:
+                self.sampled_out += 1
+            return
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            try:
+                line = json.dumps(record,default=str)
+            except (TypeError,ValueError) as e:
+                line = json.dumps({'log_error':str(e)})
+            try:
+                self.stream.write(line + '\n')
+                # flush when caught up, so lines show up promptly without a flush per line.
+                if self._queue.empty():
+                    self.stream.flush()
+                with self._lock:
+                    self.written += 1
+            except Exception:
+                with self._lock:
+                    self.dropped += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queued': self._queue.qsize(),
+                'written': self.written,
+                'dropped': self.dropped,
+                'sampled_out': self.sampled_out,
+                'sample_rate': self.sample_rate,
+            }
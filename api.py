@@ -2,20 +2,29 @@
 
 
 import os
+import sys
 import traceback
+import time
+import datetime
+import email.utils
 # for REST like api
 import json
 from types import TracebackType
 # flask to provide http layer
-from flask import Flask, request, Response
+from flask import Flask, request, Response, g, stream_with_context
 # cheap keygen
 import string
 import random
 
 # localdb
 
+import accesslog
 import database
+import santamail
+import santaexport
+import santametrics
 import santalogic
+import santatokens
 import SantaErrors
 from SantaErrors import exception_as_string
 
@@ -23,8 +32,99 @@ app = Flask(__name__)
 
 # db setup
 
+# access log lines are written by a background thread, successful requests can be sampled.
+access_log = accesslog.AccessLog(
+    max_queue=int(os.environ.get('ACCESS_LOG_QUEUE',10000)),
+    sample_rate=float(os.environ.get('ACCESS_LOG_SAMPLE',1)),
+)
+
+# request counts and latency for /metrics, with gauges from the other parts of the app.
+metrics = santametrics.Metrics()
+metrics.register_gauges('db_pool',"Database connection pool usage.",database.pool_stats)
+metrics.register_gauges('session_cache',"Verified session cache usage.",database.session_cache_stats)
+metrics.register_gauges('game_cache',"Game cache usage.",database.game_cache_stats)
+metrics.register_gauges('mail_outbox',"Email outbox depth and send times.",santamail.outbox_stats)
+metrics.register_gauges('access_log',"Access log queue.",access_log.stats)
+metrics.register_gauges('draw_jobs',"Draw queue depth and draw times.",santalogic.draw_job_stats)
+
+def __query_gauges():
+    gauges = {}
+    for name,stats in database.query_stats().items():
+        for key in ['calls','time_total','time_max','rows','slow']:
+            gauges["{}_{}".format(name.replace('.','_'),key)] = stats[key]
+    return gauges
+metrics.register_gauges('query',"Named database query counts and times.",__query_gauges)
+
+# drop games from the game cache when other processes change them, if GAME_CACHE_NOTIFY is set.
+database.start_game_change_listener()
+
+# send mail and run draws left queued from before a restart, without waiting for new ones to be queued.
+if santamail.outbox is not None:
+    santamail.outbox.start()
+if santalogic.draw_queue is not None:
+    santalogic.draw_queue.start()
+
+# each request gets a single pooled connection, returned when the request ends.
+@app.before_request
+def db_begin_request():
+    g.request_start = time.perf_counter()
+    metrics.request_started()
+    database.begin_request()
+
+@app.after_request
+def log_request(response):
+    timings = database.request_timings()
+    log_status = g.get('log_status','ok' if response.status_code < 400 else 'error')
+    record = {
+        'time': datetime.datetime.utcnow().isoformat(),
+        'ip': request.remote_addr,
+        'agent': request.user_agent.string,
+        'method': request.method,
+        'route': request.url_rule.rule if request.url_rule is not None else None,
+        'path': request.path,
+        'status': log_status,
+        'http_status': response.status_code,
+        'latency_ms': round((time.perf_counter() - g.get('request_start',time.perf_counter())) * 1000,3),
+        'db_ms': round(timings['db_time'] * 1000,3),
+        'auth_ms': round(timings['auth_time'] * 1000,3),
+        'auth_count': timings['auth_count'],
+        'db_queries': timings['queries'],
+    }
+    if log_status != 'ok':
+        record['error'] = g.get('log_error')
+    access_log.log(record,success=(log_status == 'ok'))
+    metrics.record_request(
+        record['route'],
+        request.method,
+        log_status,
+        g.get('error_class','internal' if log_status != 'ok' else ''),
+        record['latency_ms'] / 1000,
+        timings['auth_time'],
+        timings['db_time'],
+        timings['auth_count'] > 0,
+    )
+    return response
+
+@app.teardown_request
+def db_end_request(exception=None):
+    metrics.request_finished()
+    # sessions are resolved once per request, more than that means a code path is missing the identity.
+    if database.request_auth_count() > 1:
+        print("Warning: {url} authenticated {count} times in one request".format(url=request.path,count=database.request_auth_count()))
+    database.end_request()
+
 # helper functions
 
+# class of error for metrics, errors raised outside an exception are bad request data.
+def __error_class(exception):
+    if exception is None:
+        return 'validation'
+    if isinstance(exception,SantaErrors.PublicError):
+        return 'public'
+    if isinstance(exception,SantaErrors.PrivateError):
+        return 'private'
+    return 'internal'
+
 # wrapper for sending error messages
 def json_error(message,internal_message=''):
     """Generate an error object for api return, and log the error.
@@ -35,7 +135,10 @@ def json_error(message,internal_message=''):
     }
     if (internal_message == ''):
         internal_message = message
-    print("{ip},{agent},{url},{method},{error}".format(ip=request.remote_addr, url=request.url, agent=request.user_agent, method=request.method, error=internal_message))
+    # written to the access log when the request finishes.
+    g.log_status = 'error'
+    g.log_error = internal_message
+    g.error_class = __error_class(sys.exc_info()[1])
     resp = Response(json.dumps(result))
     resp.headers['Access-Control-Allow-Origin'] = os.environ.get('XSS-Origin','*')
     resp.headers['Content-Type'] = 'application/json'
@@ -43,13 +146,67 @@ def json_error(message,internal_message=''):
 
 # return data with success code
 def json_ok(data_dict):
-    print("{ip},{agent},{url},{method},{error}".format(ip=request.remote_addr, url=request.url, agent=request.user_agent, method=request.method, error='ok'))
+    g.log_status = 'ok'
     data_dict['status'] = 'ok'
     resp = Response(json.dumps(data_dict))
     resp.headers['Access-Control-Allow-Origin'] = os.environ.get('XSS-Origin','*')
     resp.headers['Content-Type'] = 'application/json'
     return resp
 
+# conditional gets for the polled public routes, the game version changes with its state, players and ideas.
+__game_cache_max_age = int(os.environ.get('GAME_CACHE_MAX_AGE',5))
+
+def game_cache_headers(game):
+    """ETag, Last-Modified and Cache-Control headers for a response that only depends on the game version.
+    """
+    modified = game['modified'].replace(tzinfo=datetime.timezone.utc)
+    return {
+        'ETag': '"{}-{}"'.format(game['id'],game['version']),
+        'Last-Modified': email.utils.format_datetime(modified,usegmt=True),
+        'Cache-Control': 'public, max-age={}'.format(__game_cache_max_age) if __game_cache_max_age > 0 else 'no-cache',
+    }
+
+def game_not_modified(game,if_none_match,if_modified_since):
+    """Check the conditional headers of a request against a game, If-None-Match is used over If-Modified-Since when both are sent.
+    """
+    if if_none_match:
+        etag = '"{}-{}"'.format(game['id'],game['version'])
+        tags = [x.strip() for x in if_none_match.split(',')]
+        return '*' in tags or etag in tags or 'W/' + etag in tags
+    if if_modified_since:
+        try:
+            since = email.utils.parsedate_to_datetime(if_modified_since)
+        except (TypeError,ValueError):
+            return False
+        if since is None:
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=datetime.timezone.utc)
+        # http dates are to the second.
+        return game['modified'].replace(tzinfo=datetime.timezone.utc,microsecond=0) <= since
+    return False
+
+# add the game cache headers to a response, or answer with a 304 if the client has the current version.
+def __with_game_cache(resp,game):
+    resp.headers.update(game_cache_headers(game))
+    return resp
+
+def __not_modified(game):
+    if not game_not_modified(game,request.headers.get('If-None-Match'),request.headers.get('If-Modified-Since')):
+        return None
+    g.log_status = 'ok'
+    resp = Response(status=304)
+    resp.headers['Access-Control-Allow-Origin'] = os.environ.get('XSS-Origin','*')
+    return __with_game_cache(resp,game)
+
+# get the credentials to pass on, a valid signed token is used in place of the session secret.
+def session_credentials(post_data):
+    if 'token' in post_data:
+        identity = santatokens.verify_token(post_data['token'],post_data['session'])
+        if identity is not None:
+            return identity,post_data['secret']
+    return post_data['session'],post_data['secret']
+
 # endpoints
 
 # /game  :
@@ -65,10 +222,11 @@ def game():
     if request.method == 'GET':
         try: 
             game_result = santalogic.get_game(request.args.get('code'))
-            # id is internal so we should remove it from a public response.
-            if 'id' in game_result:
-                del game_result['id']
-            return json_ok( game_result )
+            not_modified = __not_modified(game_result)
+            if not_modified is not None:
+                return not_modified
+            # id and the version are internal so we should remove them from a public response.
+            return __with_game_cache(json_ok({'name':game_result['name'],'state':game_result['state']}),game_result)
         except Exception as e:
             return json_error(str(e))
     # post to update a game status.
@@ -86,7 +244,10 @@ def game():
             return json_error("A required Key is missing {}".format(missing_keys))
 
         try:
-            santalogic.update_game_state(post_data['code'],post_data['session'],post_data['secret'],post_data['state'])
+            result = santalogic.update_game_state(post_data['code'],*session_credentials(post_data),post_data['state'])
+            # queued draws return a job id that can be checked with /game/draw_job.
+            if isinstance(result,dict) and 'job' in result:
+                return json_ok(result)
             return json_ok({})
         except SantaErrors.PublicError as e:
             return json_error(str(e))
@@ -98,6 +259,18 @@ def game():
     # we shouldn't get here, but return a message just incase we do
     return json_error("No sure what to do")
 
+# /game/draw_job :
+# check on a queued draw.
+# GET /game/draw_job?job=<jobid>
+@app.route('/game/draw_job', methods=['GET'])
+def game_draw_job():
+    try:
+        return json_ok(santalogic.get_draw_job(request.args.get('job')))
+    except SantaErrors.PublicError as e:
+        return json_error(str(e))
+    except Exception as e:
+        return json_error("Internal Error","Draw job Error: {}".format(exception_as_string(e)))
+
 #/game/joined
 # get a list of groups that a user is a member of
 # POST /game/joined
@@ -118,7 +291,7 @@ def list_joined_games():
         if (len(missing_keys) > 0):
             return json_error("A required Key is missing {}".format(missing_keys))
         try:
-            result = santalogic.list_user_games(post_data['session'],post_data['secret'])
+            result = santalogic.list_user_games(*session_credentials(post_data))
             return json_ok(result)
         except SantaErrors.PublicError as e:
             return json_error("{}".format(str(e)))
@@ -148,7 +321,7 @@ def list_owned_games():
         if (len(missing_keys) > 0):
             return json_error("A required Key is missing {}".format(missing_keys))
         try:
-            result = santalogic.list_owned_games(post_data['session'],post_data['secret'])
+            result = santalogic.list_owned_games(*session_credentials(post_data))
             return json_ok(result)
         except SantaErrors.PublicError as e:
             return json_error("{}".format(str(e)))
@@ -180,7 +353,7 @@ def game_sum():
 
         # get info:
         try:
-            results = database.get_game_sum(post_data['code'],post_data['session'],post_data['secret'])
+            results = database.get_game_sum(post_data['code'],*session_credentials(post_data))
             if len(results) == 0:
                 return json_error("Not found, or bad secret.")
             
@@ -190,6 +363,91 @@ def game_sum():
         except Exception as e:
             return json_error("failed to get game","Error getting game: {}".format(exception_as_string(e)))
 
+# /game/notify :
+# email everyone in a drawn game their results, calling again reports the progress.
+# POST /game/notify
+#    {code: <gamecode>, session: <sessionid>, secret: <sessionsecret>}
+@app.route('/game/notify', methods=['POST'])
+def game_notify():
+    try:
+        try:
+            post_data = request.get_json(force=True)
+        except:
+            return json_error("POST data was not json or malformed.")
+        required_keys = ['code','session','secret']
+        missing_keys = [x for x in required_keys if x not in post_data]
+        if (len(missing_keys) > 0):
+            return json_error("A required Key is missing {}".format(missing_keys))
+        try:
+            progress = santalogic.notify_game_results(post_data['code'],*session_credentials(post_data))
+            return json_ok({'notify':progress})
+        except SantaErrors.PublicError as e:
+            return json_error(str(e))
+        except SantaErrors.PrivateError as e:
+            return json_error("Unable to send results.","Notify issue: {game} , {exception}".format(exception=str(e),game=post_data['code']))
+        except Exception as e:
+            return json_error("Internal Error","Notify Error: {}".format(exception_as_string(e)))
+    except Exception as e:
+        return json_error("Internal Error","Notify Error: {}".format(exception_as_string(e)))
+
+# /game/exclusions :
+# set who can't be drawn for who in an open game, replaces any set before.
+# POST /game/exclusions
+#    {code: <gamecode>, pairs: [[<name>,<name>]], groups: [[<name>,...]], previous_code: <gamecode>, session: <sessionid>, secret: <sessionsecret>}
+@app.route('/game/exclusions', methods=['POST'])
+def game_exclusions():
+    try:
+        try:
+            post_data = request.get_json(force=True)
+        except:
+            return json_error("POST data was not json or malformed.")
+        required_keys = ['code','session','secret']
+        missing_keys = [x for x in required_keys if x not in post_data]
+        if (len(missing_keys) > 0):
+            return json_error("A required Key is missing {}".format(missing_keys))
+        try:
+            result = santalogic.set_game_exclusions(
+                post_data['code'],
+                post_data.get('pairs',[]),
+                post_data.get('groups',[]),
+                post_data.get('previous_code',''),
+                *session_credentials(post_data)
+            )
+            return json_ok(result)
+        except SantaErrors.PublicError as e:
+            return json_error(str(e))
+        except SantaErrors.PrivateError as e:
+            return json_error("Unable to set exclusions.","Exclusion issue: {game} , {exception}".format(exception=str(e),game=post_data['code']))
+        except Exception as e:
+            return json_error("Internal Error","Exclusion Error: {}".format(exception_as_string(e)))
+    except Exception as e:
+        return json_error("Internal Error","Exclusion Error: {}".format(exception_as_string(e)))
+
+# /game/schedule :
+# set when an open game should be drawn by the admin bulk draw.
+# POST /game/schedule
+#    {code: <gamecode>, draw_date: <iso date or empty>, session: <sessionid>, secret: <sessionsecret>}
+@app.route('/game/schedule', methods=['POST'])
+def game_schedule():
+    try:
+        try:
+            post_data = request.get_json(force=True)
+        except:
+            return json_error("POST data was not json or malformed.")
+        required_keys = ['code','draw_date','session','secret']
+        missing_keys = [x for x in required_keys if x not in post_data]
+        if (len(missing_keys) > 0):
+            return json_error("A required Key is missing {}".format(missing_keys))
+        try:
+            result = santalogic.schedule_game(post_data['code'],post_data['draw_date'],*session_credentials(post_data))
+            return json_ok(result)
+        except SantaErrors.PublicError as e:
+            return json_error(str(e))
+        except Exception as e:
+            return json_error("Internal Error","Schedule Error: {}".format(exception_as_string(e)))
+    except Exception as e:
+        return json_error("Internal Error","Schedule Error: {}".format(exception_as_string(e)))
+
 # submit ideas
 # submit ideas for a game to allow for the draw.
 # POST
@@ -209,7 +467,7 @@ def idea():
             if (len(missing_keys) > 0):
                 return json_error("A required Key is missing {}".format(missing_keys))
             try:
-                idea_results = santalogic.add_idea(post_data['code'],post_data['idea'],post_data['session'],post_data['secret'])
+                idea_results = santalogic.add_idea(post_data['code'],post_data['idea'],*session_credentials(post_data))
                 return json_ok( idea_results )
             except FileNotFoundError as e:
                 return json_error(str(e))
@@ -227,6 +485,11 @@ def idea():
         except Exception as e:
             return json_error(str(e))
 
+        # left over ideas only change with the game version, so unchanged polls don't need the ideas table.
+        not_modified = __not_modified(game_result)
+        if not_modified is not None:
+            return not_modified
+
         # test if group is "rolled"
         if game_result['state'] == 1:
             try:
@@ -236,15 +499,15 @@ def idea():
                 },properties=['idea'])
 
                 if len(idea_results) == 0:
-                    return json_ok({'ideas':['All ideas were used!']})
+                    return __with_game_cache(json_ok({'ideas':['All ideas were used!']}),game_result)
 
-                return json_ok({'ideas':[ x['idea'] for x in idea_results]})
+                return __with_game_cache(json_ok({'ideas':[ x['idea'] for x in idea_results]}),game_result)
             except Exception as e:
                 return json_error("Error getting ideas.","Error getting ideas: {}".format(str(e)))
         
         # state is not 1
         else:
-            return json_error("Group has not been rolled yet, nothing to get.")
+            return __with_game_cache(json_error("Group has not been rolled yet, nothing to get."),game_result)
     return json_error("Not sure what to do.")
 
 
@@ -265,7 +528,7 @@ def join_game():
         if (len(missing_keys) > 0):
             return json_error("A required Key is missing {}".format(missing_keys))
         try:
-            result = santalogic.join_game(post_data['name'],post_data['code'],post_data['session'],post_data['secret'])
+            result = santalogic.join_game(post_data['name'],post_data['code'],*session_credentials(post_data))
             if len(result) == 0:
                 return json_error("Internal Error","Join Error: No results from join function")
             return json_ok (result)
@@ -294,7 +557,7 @@ def results():
         if (len(missing_keys) > 0):
             return json_error("A required Key is missing {}".format(missing_keys))
 
-        result = santalogic.get_game_results(post_data['code'],post_data['session'],post_data['secret'])
+        result = santalogic.get_game_results(post_data['code'],*session_credentials(post_data))
         return json_ok( result )
     except SantaErrors.PublicError as e:
         return json_error(str(e))
@@ -321,7 +584,7 @@ def list_user():
         if (len(missing_keys) > 0):
             return json_error("A required Key is missing {}".format(missing_keys))
 
-        user_list = database.get_users_in_game(post_data['code'],post_data['session'],post_data['secret'])
+        user_list = database.get_users_in_game(post_data['code'],*session_credentials(post_data))
         if len(user_list) == 0:
             return json_error("No results, or not group owner.")
 
@@ -353,7 +616,7 @@ def new():
             try:
                 # trim name
                 trimed_name = post_data['name']
-                game_sig = santalogic.create_game(trimed_name,post_data['session'],post_data['secret'])
+                game_sig = santalogic.create_game(trimed_name,*session_credentials(post_data))
                 if len(game_sig) == 0:
                     return json_error("No game returned")
                 else:
@@ -389,6 +652,8 @@ def get_games():
         missing_keys = [x for x in required_keys if x not in post_data]
         if (len(missing_keys) > 0):
             return json_error("","A required Key is missing {}".format(missing_keys))
+        elif any(key in post_data for key in ['after','limit','state','ownerid','stream']):
+            return __game_list(post_data)
         else:
             if 'view' in post_data:
                 ## prebuild views
@@ -408,6 +673,152 @@ def get_games():
     except Exception as e:
         return json_error("",internal_message="Get_Games Error: {}".format(str(e)))
 
+# pages of the game list, or the whole list streamed from a server side cursor.
+__games_page_default = 100
+__games_page_max = 1000
+__games_stream_batch = int(os.environ.get('GAMES_STREAM_BATCH',1000))
+__game_views = {'open':0,'complete':1,'closed':2}
+
+def __optional_int(post_data,key,default=None):
+    if post_data.get(key) is None:
+        return default
+    value = post_data[key]
+    if isinstance(value,bool) or not isinstance(value,int):
+        raise ValueError("{} must be a whole number.".format(key))
+    return value
+
+def __game_list(post_data):
+    try:
+        after_id = __optional_int(post_data,'after',0)
+        limit = __optional_int(post_data,'limit',__games_page_default)
+        state = __optional_int(post_data,'state')
+        ownerid = __optional_int(post_data,'ownerid')
+    except ValueError as e:
+        return json_error(str(e))
+    if 'view' in post_data:
+        if post_data['view'] not in __game_views:
+            return json_error("","Unknown view: {}".format(post_data['view']))
+        state = __game_views[post_data['view']]
+    if limit < 1 or limit > __games_page_max:
+        return json_error("limit must be between 1 and {}.".format(__games_page_max))
+
+    database.check_admin_key(post_data['admin_key'])
+    if post_data.get('stream',False):
+        g.log_status = 'ok'
+        resp = Response(stream_with_context(__stream_games(post_data['admin_key'],state,ownerid)))
+        resp.headers['Access-Control-Allow-Origin'] = os.environ.get('XSS-Origin','*')
+        resp.headers['Content-Type'] = 'application/json'
+        return resp
+
+    gamelist = database.get_games_page(post_data['admin_key'],after_id,limit,state,ownerid)
+    return json_ok({
+        'gamelist': gamelist,
+        # the after value for the next page, null on the last page.
+        'next_after': gamelist[-1]['id'] if len(gamelist) == limit else None,
+    })
+
+def __stream_games(admin_key,state,ownerid):
+    """Write the game list as json a chunk at a time, errors part way can't change the http status
+    so they end the list with an error status.
+    """
+    yield '{"gamelist":['
+    count = 0
+    chunk = []
+    chunk_size = 0
+    try:
+        for game in database.iter_games(admin_key,state=state,ownerid=ownerid,batch_size=__games_stream_batch):
+            line = json.dumps(game)
+            chunk.append(line)
+            chunk_size += len(line)
+            count += 1
+            if chunk_size >= 65536:
+                yield (',' if count > len(chunk) else '') + ','.join(chunk)
+                chunk = []
+                chunk_size = 0
+        if chunk:
+            yield (',' if count > len(chunk) else '') + ','.join(chunk)
+        yield '],"count":{},"status":"ok"}}'.format(count)
+    except Exception as e:
+        print("Get_Games Error: stream stopped after {} games {}".format(count,exception_as_string(e)))
+        if chunk:
+            yield (',' if count > len(chunk) else '') + ','.join(chunk)
+        yield '],"count":{},"status":"error","statusdetail":"Internal Error"}}'.format(count)
+
+# export a table as ndjson or csv, admin only
+# POST /export
+#   {"admin_key":<key>, "table":<games|users|ideas|identities>, "format":<ndjson|csv>, "redact":<true to hash emails and names>}
+@app.route('/export',methods=['POST'])
+def export():
+    try:
+        try:
+            post_data = request.get_json(force=True)
+        except:
+            return json_error("Post Data malformed")
+        required_keys = ['admin_key','table']
+        missing_keys = [x for x in required_keys if x not in post_data]
+        if (len(missing_keys) > 0):
+            return json_error("A required Key is missing {}".format(missing_keys))
+        file_format = post_data.get('format','ndjson')
+        if file_format not in santaexport.formats:
+            return json_error("Unknown format {}, use ndjson or csv.".format(file_format))
+        if post_data['table'] not in santaexport.tables:
+            return json_error("Unknown table {}.".format(post_data['table']))
+        database.check_admin_key(post_data['admin_key'])
+
+        g.log_status = 'ok'
+        resp = Response(stream_with_context(__stream_export(post_data['admin_key'],post_data['table'],file_format,bool(post_data.get('redact',False)))))
+        resp.headers['Access-Control-Allow-Origin'] = os.environ.get('XSS-Origin','*')
+        resp.headers['Content-Type'] = santaexport.formats[file_format][0]
+        resp.headers['Content-Disposition'] = 'attachment; filename="{}.{}"'.format(post_data['table'],santaexport.formats[file_format][1])
+        return resp
+    except SantaErrors.PublicError as e:
+        return json_error("Unable to export: {}".format(str(e)))
+    except Exception as e:
+        return json_error("Internal Error","Export Error: {}".format(exception_as_string(e)))
+
+def __stream_export(admin_key,table,file_format,redact):
+    """Write the export and log its row rate, errors part way add an error line to ndjson exports.
+    """
+    stats = santaexport.ExportStats()
+    try:
+        for chunk in santaexport.export_table(admin_key,table,file_format,redact,stats):
+            yield chunk
+    except Exception as e:
+        print("Export Error: {} stopped after {} rows {}".format(table,stats.summary()['rows'],exception_as_string(e)))
+        if file_format == 'ndjson':
+            yield json.dumps({"status":"error","statusdetail":"Internal Error"}) + '\n'
+        return
+    summary = stats.summary()
+    print("Export: {table} {rows} rows in {seconds}s, {rows_per_second} rows/s".format(table=table,**summary))
+
+# draw many open games at once, admin only
+# POST /draw_games
+#   {"admin_key":<key>, "codes":[<gamecode>], "ids":[<gameid>], "due":<true to draw scheduled games>}
+@app.route('/draw_games',methods=['POST'])
+def draw_games():
+    try:
+        try:
+            post_data = request.get_json(force=True)
+        except:
+            return json_error("Post Data malformed")
+        required_keys = ['admin_key']
+        missing_keys = [x for x in required_keys if x not in post_data]
+        if (len(missing_keys) > 0):
+            return json_error("","A required Key is missing {}".format(missing_keys))
+        if not (post_data.get('codes') or post_data.get('ids') or post_data.get('due')):
+            return json_error("One of codes, ids or due is needed.")
+        result = santalogic.draw_games(
+            post_data['admin_key'],
+            codes=post_data.get('codes'),
+            ids=post_data.get('ids'),
+            due=bool(post_data.get('due',False)),
+        )
+        return json_ok(result)
+    except SantaErrors.PublicError as e:
+        return json_error("Unable to draw games: {}".format(str(e)))
+    except Exception as e:
+        return json_error("",internal_message="Draw_Games Error: {}".format(exception_as_string(e)))
+
 # reset/create db
 # resets the databases, it's important that you keep the globalsecret safe and long.
 # POST
@@ -432,7 +843,7 @@ def reset():
 
 # create/update database schema
 # POST
-#    {"admin_key": <globalsecret>}
+#    {"admin_key": <globalsecret>, "check_only": <optional true to only list pending migrations>}
 @app.route('/init_db_tables', methods=['POST'])
 def init_db_tables():
     try:
@@ -441,7 +852,7 @@ def init_db_tables():
         except Exception as e:
             return json_error("Post Data malformed.")
         if 'admin_key' in post_data:
-            init_result = database.init_tables(post_data['admin_key'])
+            init_result = database.init_tables(post_data['admin_key'],check_only=bool(post_data.get('check_only',False)))
             return json_ok( init_result )
         else:
             return json_error("",internal_message="Opportunistic init attempt")
@@ -451,6 +862,31 @@ def init_db_tables():
     return json_error("Not Implemented")
 
 
+# prometheus metrics, needs the admin key as a bearer token.
+# GET /metrics
+#    Authorization: Bearer <globalsecret>
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    auth_header = request.headers.get('Authorization','')
+    try:
+        if not auth_header.startswith('Bearer '):
+            raise SantaErrors.AuthorizationError("Not Authorized.")
+        database.check_admin_key(auth_header[len('Bearer '):])
+    except SantaErrors.PublicError as e:
+        g.log_status = 'error'
+        g.log_error = "Metrics: {}".format(str(e))
+        g.error_class = 'public'
+        return Response("Not Authorized.\n",status=401,mimetype='text/plain')
+    except Exception as e:
+        g.log_status = 'error'
+        g.log_error = "Metrics Error: {}".format(exception_as_string(e))
+        g.error_class = __error_class(e)
+        return Response("Metrics unavailable.\n",status=503,mimetype='text/plain')
+    g.log_status = 'ok'
+    resp = Response(metrics.render(),mimetype='text/plain')
+    resp.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return resp
+
 #########################
 # Login endpoints
 #########################
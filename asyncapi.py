@@ -0,0 +1,444 @@
+# Async serving mode for the santa api, run with an ASGI server:
+#
+#   uvicorn asyncapi:app --host 0.0.0.0 --port $PORT
+#
+# The read heavy routes are served natively with asyncdb on an asyncpg pool, every other
+# route is passed to the flask app in api.py on a thread pool. Routes, json and headers are
+# the same in both modes.
+
+import asyncio
+import datetime
+import io
+import json
+import os
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import api
+import database
+import SantaErrors
+from dbcommon import Identity
+from SantaErrors import exception_as_string
+
+# native routes need postgres and asyncpg, otherwise everything goes to the flask app.
+try:
+    import asyncdb
+except ImportError:
+    print("asyncpg not found, all routes will be served by the flask app.")
+    asyncdb = None
+__native = asyncdb is not None and database.backend.__name__ == 'postgresdb'
+
+# threads for the flask routes, each can hold a database connection so keep it near DB_POOL_MAX.
+__wsgi_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('ASYNC_WSGI_THREADS',8)),
+    thread_name_prefix='wsgi',
+)
+
+if asyncdb is not None:
+    api.metrics.register_gauges('async_db_pool',"Async database connection pool usage.",asyncdb.pool_stats)
+
+class Request:
+    """
+    Request details for a native route, and what to write in the access log.
+    """
+
+    def __init__(self,scope:dict,body:bytes):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.args = {key:values[0] for key,values in urllib.parse.parse_qs(scope.get('query_string',b'').decode('latin1')).items()}
+        self.headers = {key.decode('latin1').lower():value.decode('latin1') for key,value in scope.get('headers',[])}
+        self.remote_addr = scope['client'][0] if scope.get('client') else None
+        self.body = body
+        self.start = time.perf_counter()
+        self.log_status = 'ok'
+        self.log_error = None
+        self.error_class = ''
+
+    def get_json(self):
+        return json.loads(self.body)
+
+# helper functions, these match json_error and json_ok in api.py.
+
+def __error_class(exception):
+    if exception is None:
+        return 'validation'
+    if isinstance(exception,SantaErrors.PublicError):
+        return 'public'
+    if isinstance(exception,SantaErrors.PrivateError):
+        return 'private'
+    return 'internal'
+
+def __response(body:bytes,status:int=200,content_type:str='application/json'):
+    return status,[
+        (b'content-type',content_type.encode('latin1')),
+        (b'content-length',str(len(body)).encode('latin1')),
+        (b'access-control-allow-origin',os.environ.get('XSS-Origin','*').encode('latin1')),
+    ],body
+
+# add the game cache headers to a response, or answer with a 304 if the client has the current version.
+def __with_game_cache(response,game):
+    status,headers,body = response
+    return status,headers + [(key.lower().encode('latin1'),value.encode('latin1')) for key,value in api.game_cache_headers(game).items()],body
+
+def __not_modified(request:Request,game):
+    if not api.game_not_modified(game,request.headers.get('if-none-match'),request.headers.get('if-modified-since')):
+        return None
+    request.log_status = 'ok'
+    return __with_game_cache((304,[(b'access-control-allow-origin',os.environ.get('XSS-Origin','*').encode('latin1'))],b''),game)
+
+def json_error(request:Request,message,internal_message='',exception=None):
+    result = {
+        "status": 'error',
+        "statusdetail": message
+    }
+    if (internal_message == ''):
+        internal_message = message
+    request.log_status = 'error'
+    request.log_error = internal_message
+    request.error_class = __error_class(exception)
+    return __response(json.dumps(result).encode('utf-8'))
+
+def json_ok(request:Request,data_dict):
+    request.log_status = 'ok'
+    data_dict['status'] = 'ok'
+    return __response(json.dumps(data_dict).encode('utf-8'))
+
+def __assert_session_id(sessionid):
+    """
+    Check a session id is a uuid, identities have already been checked.
+    """
+    if isinstance(sessionid,Identity):
+        return
+    try:
+        uuid.UUID(sessionid)
+    except ValueError:
+        raise SantaErrors.SessionError("Session ids must be a uuid format")
+
+async def __get_game(code):
+    if not code:
+        raise SantaErrors.EmptyValue('Property code is missing or empty.')
+    game_list = await asyncdb.get_game_by_code(code)
+    if len(game_list) == 0:
+        raise SantaErrors.NotFound("Group id was Not Found.")
+    return game_list[0]
+
+def __missing_keys(post_data,required_keys):
+    return [x for x in required_keys if x not in post_data]
+
+# native routes
+
+async def game(request:Request):
+    try:
+        game_result = await __get_game(request.args.get('code'))
+        not_modified = __not_modified(request,game_result)
+        if not_modified is not None:
+            return not_modified
+        # id and the version are internal so we should remove them from a public response.
+        return __with_game_cache(json_ok(request,{'name':game_result['name'],'state':game_result['state']}),game_result)
+    except Exception as e:
+        return json_error(request,str(e),exception=e)
+
+async def idea(request:Request):
+    try:
+        game_result = await __get_game(request.args.get('code'))
+    except Exception as e:
+        return json_error(request,str(e),exception=e)
+
+    not_modified = __not_modified(request,game_result)
+    if not_modified is not None:
+        return not_modified
+
+    # test if group is "rolled"
+    if game_result['state'] == 1:
+        try:
+            idea_results = await asyncdb.get_leftover_ideas(game_result['id'])
+            if len(idea_results) == 0:
+                return __with_game_cache(json_ok(request,{'ideas':['All ideas were used!']}),game_result)
+            return __with_game_cache(json_ok(request,{'ideas':[ x['idea'] for x in idea_results]}),game_result)
+        except Exception as e:
+            return json_error(request,"Error getting ideas.","Error getting ideas: {}".format(str(e)),exception=e)
+    return __with_game_cache(json_error(request,"Group has not been rolled yet, nothing to get."),game_result)
+
+async def game_sum(request:Request):
+    try:
+        post_data = request.get_json()
+    except Exception:
+        return json_error(request,"invalid json data.")
+    if len(post_data) == 0:
+        return json_error(request,"No Data sent in request")
+    missing_keys = __missing_keys(post_data,['code','session','secret'])
+    if (len(missing_keys) > 0):
+        return json_error(request,"A required Key is missing {}".format(missing_keys))
+
+    try:
+        results = await asyncdb.get_game_sum(post_data['code'],*api.session_credentials(post_data))
+        if len(results) == 0:
+            return json_error(request,"Not found, or bad secret.")
+        return json_ok(request,results[0])
+    except SantaErrors.PublicError as e:
+        return json_error(request,"Failed to get game: {}".format(str(e)),exception=e)
+    except Exception as e:
+        return json_error(request,"failed to get game","Error getting game: {}".format(exception_as_string(e)),exception=e)
+
+async def __list_games(request:Request,list_function,error_name:str):
+    try:
+        try:
+            post_data = request.get_json()
+        except Exception:
+            return json_error(request,"POST data was not json or malformed.")
+        missing_keys = __missing_keys(post_data,['session','secret'])
+        if (len(missing_keys) > 0):
+            return json_error(request,"A required Key is missing {}".format(missing_keys))
+        try:
+            sessionid,secret = api.session_credentials(post_data)
+            __assert_session_id(sessionid)
+            return json_ok(request,{'grouplist':await list_function(sessionid,secret)})
+        except SantaErrors.PublicError as e:
+            return json_error(request,"{}".format(str(e)),exception=e)
+        except Exception as e:
+            return json_error(request,"Internal error occurred","{} Error: {}".format(error_name,exception_as_string(e)),exception=e)
+    except Exception as e:
+        return json_error(request,"Internal Error Has Occurred.","{} Error: {}".format(error_name,exception_as_string(e)),exception=e)
+
+async def list_joined_games(request:Request):
+    return await __list_games(request,asyncdb.list_user_games,'joined')
+
+async def list_owned_games(request:Request):
+    return await __list_games(request,asyncdb.list_owned_games,'Register')
+
+async def results(request:Request):
+    try:
+        try:
+            post_data = request.get_json()
+        except Exception:
+            return json_error(request,"POST data was not json or malformed.")
+        missing_keys = __missing_keys(post_data,['code','session','secret'])
+        if (len(missing_keys) > 0):
+            return json_error(request,"A required Key is missing {}".format(missing_keys))
+
+        code = post_data['code']
+        if (len(code) == 0):
+            raise SantaErrors.EmptyValue("Group code is empty.")
+        game = (await asyncdb.get_game_by_code(code))[0]
+        if game['state'] == 0:
+            raise SantaErrors.GameStateError("Game not rolled, can't get results yet.")
+        if game['state'] == 2:
+            raise SantaErrors.GameStateError("Game is closed.")
+        if game['state'] != 1:
+            print("Error: Game {} in invalid game state {}".format(code,game['state']))
+            raise SantaErrors.GameStateError("Unknown game state.")
+
+        user = await asyncdb.authenticate(*api.session_credentials(post_data))
+        giftee = (await asyncdb.get_user_giftee(user['id'],code))[0]
+        ideas = await asyncdb.get_user_ideas(user['id'],code)
+        return json_ok(request,{
+            'giftee': giftee['giftee'],
+            'ideas': [x['idea'] for x in ideas],
+            'code': code,
+        })
+    except SantaErrors.PublicError as e:
+        return json_error(request,str(e),exception=e)
+    except Exception as e:
+        return json_error(request,"Internal Error","Internal Error {}".format(exception_as_string(e)),exception=e)
+
+__native_routes = {
+    ('GET','/game'): game,
+    ('GET','/idea'): idea,
+    ('POST','/game_sum'): game_sum,
+    ('POST','/game/joined'): list_joined_games,
+    ('POST','/game/owned'): list_owned_games,
+    ('POST','/results'): results,
+}
+
+async def __serve_native(handler,scope:dict,body:bytes):
+    request = Request(scope,body)
+    api.metrics.request_started()
+    asyncdb.begin_request()
+    try:
+        try:
+            status,headers,response_body = await handler(request)
+        except Exception as e:
+            print("Async Error: {} {}".format(request.path,exception_as_string(e)))
+            request.log_status = 'error'
+            request.log_error = "Unhandled error: {}".format(str(e))
+            request.error_class = 'internal'
+            status,headers,response_body = __response(b'Internal Server Error',500,'text/plain')
+
+        timings = asyncdb.request_timings()
+        record = {
+            'time': datetime.datetime.utcnow().isoformat(),
+            'ip': request.remote_addr,
+            'agent': request.headers.get('user-agent',''),
+            'method': request.method,
+            'route': request.path,
+            'path': request.path,
+            'status': request.log_status,
+            'http_status': status,
+            'latency_ms': round((time.perf_counter() - request.start) * 1000,3),
+            'db_ms': round(timings['db_time'] * 1000,3),
+            'auth_ms': round(timings['auth_time'] * 1000,3),
+            'auth_count': timings['auth_count'],
+            'db_queries': timings['queries'],
+        }
+        if request.log_status != 'ok':
+            record['error'] = request.log_error
+        api.access_log.log(record,success=(request.log_status == 'ok'))
+        api.metrics.record_request(
+            record['route'],
+            request.method,
+            request.log_status,
+            request.error_class,
+            record['latency_ms'] / 1000,
+            timings['auth_time'],
+            timings['db_time'],
+            timings['auth_count'] > 0,
+        )
+    finally:
+        api.metrics.request_finished()
+    return status,headers,response_body
+
+# flask routes
+
+def __wsgi_environ(scope:dict,body:bytes):
+    server = scope.get('server') or ('localhost',80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path','').encode('utf-8').decode('latin1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin1'),
+        'QUERY_STRING': scope.get('query_string',b'').decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version','1.1')),
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'wsgi.version': (1,0),
+        'wsgi.url_scheme': scope.get('scheme','http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for key,value in scope.get('headers',[]):
+        name = key.decode('latin1').upper().replace('-','_')
+        if name == 'CONTENT_TYPE' or name == 'CONTENT_LENGTH':
+            environ[name] = value.decode('latin1')
+            continue
+        name = 'HTTP_' + name
+        if name in environ:
+            environ[name] += ',' + value.decode('latin1')
+        else:
+            environ[name] = value.decode('latin1')
+    return environ
+
+def __run_wsgi(environ:dict,loop,chunks:asyncio.Queue,stopped:threading.Event):
+    """
+    Run the flask app on a worker thread, passing the response to the event loop a chunk at a time.
+    The whole response is read on this thread as streamed responses keep the request's context
+    and database connection, and waits while the queue is full so a slow client holds back the reading.
+    """
+    def put(item):
+        asyncio.run_coroutine_threadsafe(chunks.put(item),loop).result()
+    response = {}
+    def start_response(status,headers,exc_info=None):
+        response['status'] = int(status.split(' ',1)[0])
+        response['headers'] = [(key.lower().encode('latin1'),value.encode('latin1')) for key,value in headers]
+    try:
+        result = api.app(environ,start_response)
+    except Exception as e:
+        put(('error',e))
+        return
+    try:
+        put(('start',response['status'],response['headers']))
+        for chunk in result:
+            if stopped.is_set():
+                return
+            if chunk:
+                put(('body',chunk))
+    except Exception as e:
+        put(('error',e))
+        return
+    finally:
+        if hasattr(result,'close'):
+            result.close()
+    put(('end',))
+
+async def __serve_wsgi(scope:dict,body:bytes,send):
+    loop = asyncio.get_event_loop()
+    chunks = asyncio.Queue(maxsize=8)
+    stopped = threading.Event()
+    worker = loop.run_in_executor(__wsgi_executor,__run_wsgi,__wsgi_environ(scope,body),loop,chunks,stopped)
+    try:
+        while True:
+            item = await chunks.get()
+            if item[0] == 'error':
+                raise item[1]
+            if item[0] == 'start':
+                await send({'type':'http.response.start','status':item[1],'headers':item[2]})
+            elif item[0] == 'body':
+                await send({'type':'http.response.body','body':item[1],'more_body':True})
+            else:
+                await send({'type':'http.response.body','body':b''})
+                break
+    finally:
+        # the client may have gone, let the worker finish so the response is closed.
+        stopped.set()
+        while not worker.done():
+            try:
+                chunks.get_nowait()
+            except asyncio.QueueEmpty:
+                await asyncio.sleep(0.01)
+
+# asgi entry point
+
+async def __read_body(receive):
+    body = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        body.append(message.get('body',b''))
+        if not message.get('more_body',False):
+            break
+    return b''.join(body)
+
+async def __lifespan(receive,send):
+    global __native
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            if __native:
+                try:
+                    await asyncdb.open_pool()
+                except Exception as e:
+                    # keep serving, the flask app can still answer with its own pool.
+                    print("Async pool failed to open, all routes will be served by the flask app: {}".format(exception_as_string(e)))
+                    __native = False
+            await send({'type':'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if asyncdb is not None:
+                await asyncdb.close_pool()
+            __wsgi_executor.shutdown(wait=False)
+            await send({'type':'lifespan.shutdown.complete'})
+            return
+
+async def app(scope,receive,send):
+    if scope['type'] == 'lifespan':
+        await __lifespan(receive,send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    body = await __read_body(receive)
+    handler = __native_routes.get((scope['method'],scope['path'])) if __native else None
+    if handler is None:
+        # flask responses are sent as they are made, streamed lists and exports aren't held in memory.
+        await __serve_wsgi(scope,body,send)
+        return
+
+    status,headers,response_body = await __serve_native(handler,scope,body)
+    await send({'type':'http.response.start','status':status,'headers':headers})
+    await send({'type':'http.response.body','body':response_body})
@@ -0,0 +1,226 @@
+"""
+Async postgres queries for the read heavy routes served natively by asyncapi.py.
+
+Queries run on an asyncpg pool and are recorded in the same named query stats as
+postgresdb, sessions are checked against the same session cache so a logout in either
+mode is seen by both.
+"""
+
+import contextvars
+import os
+import re
+import time
+
+import asyncpg
+
+import postgresdb
+import SantaErrors
+from dbcommon import Identity
+
+__pool = None
+
+# timings for the current request, each asyncio task has its own copy.
+__request_timings = contextvars.ContextVar('request_timings',default=None)
+
+# psycopg2 style %(name)s parameters, converted to $n for asyncpg.
+__param_pattern = re.compile(r'%\((\w+)\)s')
+__prepared = {}
+
+async def open_pool():
+    """
+    Open the connection pool, called when the server starts.
+    """
+    global __pool
+    if __pool is not None:
+        return __pool
+    if 'DATABASE_URL' not in os.environ:
+        raise SantaErrors.ConfigurationError("DATABASE_URL not set, no database connection available.")
+    __pool = await asyncpg.create_pool(
+        dsn=os.environ['DATABASE_URL'],
+        min_size=int(os.environ.get('ASYNC_DB_POOL_MIN',1)),
+        max_size=int(os.environ.get('ASYNC_DB_POOL_MAX',10)),
+        command_timeout=float(os.environ.get('DB_POOL_TIMEOUT',30)),
+    )
+    return __pool
+
+async def close_pool():
+    global __pool
+    if __pool is not None:
+        await __pool.close()
+        __pool = None
+
+def pool_stats():
+    """
+    Connection counts for /metrics, in the same shape as the psycopg2 pool.
+    """
+    if __pool is None:
+        return {}
+    size = __pool.get_size()
+    idle = __pool.get_idle_size()
+    return {
+        'size': size,
+        'in_use': size - idle,
+        'idle': idle,
+        'minconn': __pool.get_min_size(),
+        'maxconn': __pool.get_max_size(),
+    }
+
+def begin_request():
+    __request_timings.set({'db_time':0.0,'auth_time':0.0,'auth_count':0,'queries':0,'identities':{}})
+
+def request_timings():
+    """
+    Time spent in the database and checking sessions during the current request, the same keys as postgresdb.request_timings.
+    """
+    timings = __request_timings.get()
+    if timings is None:
+        return {'db_time':0.0,'auth_time':0.0,'auth_count':0,'queries':0}
+    return {key:timings[key] for key in ['db_time','auth_time','auth_count','queries']}
+
+def __prepare(query:str,params:dict):
+    """
+    Convert a query with named parameters to asyncpg positional parameters, conversions are cached per query text.
+    """
+    converted = __prepared.get(query)
+    if converted is None:
+        names = []
+        def number(match):
+            if match.group(1) not in names:
+                names.append(match.group(1))
+            return "${}".format(names.index(match.group(1)) + 1)
+        converted = __prepared[query] = (__param_pattern.sub(number,query),names)
+    sql,names = converted
+    return sql,[params[name] for name in names]
+
+async def __fetch(query_name:str,query:str,params:dict):
+    """
+    Run a query on a pooled connection, recording its time under query_name.
+    """
+    if __pool is None:
+        raise SantaErrors.ConfigurationError("Async database pool is not open.")
+    sql,args = __prepare(query,params)
+    start = time.perf_counter()
+    async with __pool.acquire() as conn:
+        rows = await conn.fetch(sql,*args)
+    duration = time.perf_counter() - start
+    postgresdb.record_query(query_name,duration,len(rows),len(rows))
+    timings = __request_timings.get()
+    if timings is not None:
+        timings['db_time'] += duration
+        timings['queries'] += 1
+    return [dict(row) for row in rows]
+
+async def authenticate(sessionid,sessionpassword:str):
+    """
+    Check session credentials, identities from a signed token are passed straight back.
+    Each session is only checked once per request.
+    """
+    if isinstance(sessionid,Identity):
+        return sessionid
+
+    timings = __request_timings.get()
+    if timings is not None:
+        known_identity = timings['identities'].get((sessionid,sessionpassword))
+        if known_identity is not None:
+            return known_identity
+        timings['auth_count'] += 1
+
+    start = time.perf_counter()
+    try:
+        identity = await __check_session(sessionid,sessionpassword)
+    finally:
+        if timings is not None:
+            timings['auth_time'] += time.perf_counter() - start
+    if timings is not None:
+        timings['identities'][(sessionid,sessionpassword)] = identity
+    return identity
+
+async def __check_session(sessionid:str,sessionpassword:str):
+    cache = postgresdb.session_cache()
+    cached_user = cache.get(sessionid,sessionpassword)
+    if cached_user is not None:
+        return Identity(cached_user,sessionid)
+
+    get_user = """
+    SELECT {identity}.id,{identity}.name,{identity}.email
+    FROM {identity}
+        INNER JOIN {session}
+        ON {session}.identity_id = {identity}.id
+        WHERE {session}.id = %(uuid)s::uuid AND secret_hash = crypt(%(password)s,secret_hash)
+    """.format(identity=postgresdb.true_tablename('identities'),session=postgresdb.true_tablename('sessions'))
+    rows = await __fetch('authenticate_user',get_user,{'uuid':str(sessionid),'password':sessionpassword})
+    if len(rows) == 0:
+        raise SantaErrors.SessionError("Session not found or wrong password.")
+    cache.put(sessionid,sessionpassword,rows[0])
+    return Identity(rows[0],sessionid)
+
+async def get_game_by_code(code:str):
+    """
+    Gets the id, name, state and version of a game from its code.
+    """
+    query = "SELECT id,name,state,version,modified FROM {games} WHERE code = %(code)s;".format(games=postgresdb.true_tablename('games'))
+    return await __fetch('get_games',query,{'code':code})
+
+async def get_leftover_ideas(game_id:int):
+    """
+    Ideas in a game that were not given to anyone in the draw.
+    """
+    query = "SELECT idea FROM {ideas} WHERE game = %(game)s AND userid = -1;".format(ideas=postgresdb.true_tablename('ideas'))
+    return await __fetch('get_ideas',query,{'game':game_id})
+
+async def get_game_sum(code:str,sessionid,sessionpassword:str):
+    user = await authenticate(sessionid,sessionpassword)
+
+    get_summary_query = """
+    SELECT {games}.state,{games}.name,
+    (
+        SELECT COUNT({users}.game) From {users} WHERE {users}.game = {games}.id
+    ) As santas,
+    (
+        SELECT COUNT({ideas}.game) From {ideas} WHERE {ideas}.game = {games}.id
+    ) AS ideas
+    FROM {games}
+    WHERE {games}.ownerid = %(userid)s AND {games}.code = %(code)s;
+    """.format(games=postgresdb.true_tablename('games'),users=postgresdb.true_tablename('users'),ideas=postgresdb.true_tablename('ideas'))
+    return await __fetch('get_game_sum',get_summary_query,{'code':code,'userid':user['id']})
+
+async def list_user_games(sessionid,sessionpassword:str):
+    user = await authenticate(sessionid,sessionpassword)
+
+    list_query = """
+    SELECT games.name,games.code,games.state,users.name as joinname
+    FROM {games} as games
+        INNER JOIN {users} as users
+        ON games.id = users.game
+    WHERE users.account_id = %(userid)s AND games.state IN (0,1);
+    """.format(games=postgresdb.true_tablename('games'),users=postgresdb.true_tablename('users'))
+    return await __fetch('list_user_games',list_query,{'userid':user['id']})
+
+async def list_owned_games(sessionid,sessionpassword:str):
+    user = await authenticate(sessionid,sessionpassword)
+
+    list_query = """
+    SELECT name,code,state
+    FROM {games} as games
+    Where games.ownerid = %(userid)s;
+    """.format(games=postgresdb.true_tablename('games'))
+    return await __fetch('list_owned_games',list_query,{'userid':user['id']})
+
+async def get_user_giftee(user_id:int,game_code:str):
+    get_santainfo_query = """
+    SELECT santa.name as name,giftees.name as giftee
+    FROM {users} as santa
+        INNER JOIN {users} as giftees ON santa.santa = giftees.id
+        INNER JOIN {games} as game On santa.game = game.id
+    WHERE santa.account_id = %(userid)s AND game.code = %(gameid)s;
+    """.format(users=postgresdb.true_tablename('users'),games=postgresdb.true_tablename('games'))
+    return await __fetch('get_user_giftee',get_santainfo_query,{'userid':user_id,'gameid':game_code})
+
+async def get_user_ideas(user_id:int,game_code:str):
+    get_idea_query = """
+    SELECT idea FROM {ideas}
+        INNER JOIN {users} ON {ideas}.userid = {users}.id
+        INNER JOIN {games} ON {users}.game = {games}.id
+    WHERE {users}.account_id = %(userid)s AND {games}.code = %(gameid)s;
+    """.format(users=postgresdb.true_tablename('users'),ideas=postgresdb.true_tablename('ideas'),games=postgresdb.true_tablename('games'))
+    return await __fetch('get_user_ideas',get_idea_query,{'userid':user_id,'gameid':game_code})
@@ -0,0 +1,126 @@
+"""
+Cache of recently verified sessions, so a session that has just passed the bcrypt
+check in the database does not need to be checked again for every call.
+"""
+
+import hmac
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+class SessionCache:
+    """
+    LRU cache of verified sessions with a time to live.
+
+    Keys are a keyed hash of the session id and secret, using a random key made at
+    startup, so the cache never holds secrets and a key can't be built without the secret.
+
+    :param ttl: Seconds a verified session is trusted without checking the database, 0 disables the cache.
+    :param max_size: Most sessions kept, the least recently used are dropped first.
+    """
+
+    def __init__(self,ttl:float=60,max_size:int=1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._hash_key = os.urandom(32)
+        self._lock = threading.Lock()
+        # cache key -> (sessionid, identity, expiry time)
+        self._entries = OrderedDict()
+        # sessionid -> set of cache keys, so a session can be dropped without knowing the secret.
+        self._by_session = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self):
+        return self.ttl > 0 and self.max_size > 0
+
+    def _key(self,sessionid:str,secret:str):
+        message = "{}\0{}".format(sessionid,secret).encode('utf-8')
+        return hmac.new(self._hash_key,message,hashlib.sha256).digest()
+
+    def _remove(self,key):
+        """
+        Must be called holding the lock.
+        """
+        sessionid,_,_ = self._entries.pop(key)
+        keys = self._by_session.get(sessionid)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_session[sessionid]
+
+    def get(self,sessionid:str,secret:str):
+        """
+        Get the cached identity of a session, or None if it needs checking.
+        """
+        if not self.enabled:
+            return None
+        key = self._key(sessionid,secret)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[2] < time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            # copy so callers can't change the cached value.
+            return dict(entry[1])
+
+    def put(self,sessionid:str,secret:str,identity:dict):
+        """
+        Store a session that was verified against the database.
+        """
+        if not self.enabled:
+            return
+        key = self._key(sessionid,secret)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (sessionid,dict(identity),time.monotonic() + self.ttl)
+            self._by_session.setdefault(sessionid,set()).add(key)
+            while len(self._entries) > self.max_size:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate(self,sessionid:str):
+        """
+        Drop all entries for a session, used when it is logged out or changed.
+        """
+        with self._lock:
+            for key in list(self._by_session.get(sessionid,())):
+                self._remove(key)
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_session.clear()
+
+    def stats(self):
+        """
+        Counters for sizing the cache.
+        """
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+            }
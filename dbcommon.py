@@ -0,0 +1,54 @@
+"""
+Parts shared by the database backends.
+"""
+
+import os
+
+import SantaErrors
+
+class Identity(dict):
+    """An authenticated user, with the same keys as an identities row (id,name,email.)
+
+    Functions that take sessionid and sessionpassword will also accept an Identity in place of
+    the sessionid, the password is then ignored and no further authentication is done.
+    """
+    def __init__(self,user:dict,sessionid:str):
+        super().__init__(user)
+        self.sessionid = sessionid
+
+# tables and columns that can be exported, sessions and outbox mail are never exported.
+export_columns = {
+    'identities': ['id','email','name','register_date','verify_date'],
+    'games': ['id','name','code','state','ownerid','draw_date','version','modified'],
+    'users': ['id','game','name','santa','account_id','draw_group'],
+    'ideas': ['id','game','idea','userid','account_id'],
+}
+
+# personal columns that are replaced in a redacted export.
+redacted_columns = {
+    'identities': ['email','name'],
+    'users': ['name'],
+}
+
+def assert_admin_key(admin_key:str):
+    """Test if the admin key matches configured key.
+    """
+    if 'AdminSecret' not in os.environ:
+        raise SantaErrors.ConfigurationError("Admin Secret not set, admin functions cannot be used until set.")
+    if len(os.environ['AdminSecret']) < 10:
+        raise SantaErrors.ConfigurationError("Admin Secret too short, admin functions cannot be used until set.")
+    if admin_key == os.environ['AdminSecret']:
+        return 0
+    raise SantaErrors.AuthorizationError("Not Authorized.")
+
+def assert_can_do_major_db_changes():
+    """
+    Checks that table changes and resets are enabled sys vars
+    """
+    if 'AllowTableTruncates' not in os.environ:
+        raise SantaErrors.AuthorizationError("Table Truncation setting missing, default is disabled.")
+    if len(os.environ['AllowTableTruncates']) == 0:
+        raise SantaErrors.AuthorizationError("Table Truncation setting empty, default is disabled.")
+    if os.environ['AllowTableTruncates'] == 'AllowTruncates':
+        return 0
+    raise SantaErrors.AuthorizationError("table Truncation settings is not 'AllowTruncates', value is disabled.")
@@ -0,0 +1,199 @@
+"""
+Thread safe pool of database connections, so each request can get its own
+connection instead of every thread sharing one.
+"""
+
+import threading
+import time
+
+import psycopg2
+
+import SantaErrors
+
+class ConnectionPool:
+    """
+    A pool of connections that grows up to maxconn when busy and shrinks back
+    to minconn when connections have been idle for a while.
+
+    :param connect: Function that returns a new connection.
+    :param minconn: Number of connections to keep open when idle.
+    :param maxconn: Most connections that can be checked out at once.
+    :param idle_timeout: Seconds a spare connection can sit idle before it is closed.
+    :param checkout_timeout: Seconds a caller will wait for a free connection.
+    :param health_check_interval: Seconds a connection can be idle before it is tested on checkout.
+    """
+
+    def __init__(self,connect,minconn:int=1,maxconn:int=10,idle_timeout:float=300,checkout_timeout:float=30,health_check_interval:float=30):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise SantaErrors.ConfigurationError("Invalid pool size min={} max={}".format(minconn,maxconn))
+        self._connect = connect
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self.health_check_interval = health_check_interval
+
+        self._lock = threading.Condition()
+        # idle connections as (connection, time returned), newest at the end.
+        self._idle = []
+        self._in_use = set()
+        # connections being opened, counted against maxconn
+        self._opening = 0
+
+        # stats
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
+        self._reconnects = 0
+        self._failed_checks = 0
+
+    def _size(self):
+        return len(self._idle) + len(self._in_use) + self._opening
+
+    def _new_connection(self):
+        """
+        Open a new connection outside the lock, the slot is reserved by the caller.
+        """
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._lock:
+                self._opening -= 1
+                self._lock.notify()
+            raise
+        with self._lock:
+            self._opening -= 1
+            self._in_use.add(conn)
+        return conn
+
+    def _is_healthy(self,conn,idle_since:float):
+        """
+        Test a connection that has been sitting in the pool.
+        """
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1;")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _close(self,conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def getconn(self):
+        """
+        Check out a connection, waiting for one to be returned if the pool is full.
+        """
+        start = time.monotonic()
+        waited = False
+        while True:
+            with self._lock:
+                while not self._idle and self._size() >= self.maxconn:
+                    remaining = self.checkout_timeout - (time.monotonic() - start)
+                    if remaining <= 0:
+                        raise SantaErrors.DatabaseChangeError("Timed out waiting for a database connection.")
+                    waited = True
+                    self._lock.wait(remaining)
+                self._checkouts += 1
+                if waited:
+                    wait_time = time.monotonic() - start
+                    self._waits += 1
+                    self._wait_time_total += wait_time
+                    self._wait_time_max = max(self._wait_time_max,wait_time)
+                    waited = False
+                if self._idle:
+                    conn,idle_since = self._idle.pop()
+                    self._in_use.add(conn)
+                else:
+                    self._opening += 1
+                    conn = None
+            if conn is None:
+                return self._new_connection()
+            if self._is_healthy(conn,idle_since):
+                return conn
+            # dead connection, drop it and try again with a fresh one.
+            with self._lock:
+                self._failed_checks += 1
+                self._reconnects += 1
+                self._checkouts -= 1
+            self.putconn(conn,close=True)
+
+    def putconn(self,conn,close:bool=False):
+        """
+        Return a connection to the pool, close it if it is known to be broken.
+        """
+        if not close and not conn.closed:
+            try:
+                # never hand out a connection with a transaction left open.
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                close = True
+        to_close = []
+        with self._lock:
+            self._in_use.discard(conn)
+            if close or conn.closed:
+                to_close.append(conn)
+            else:
+                self._idle.append((conn,time.monotonic()))
+            to_close.extend(self._shrink())
+            self._lock.notify()
+        for old in to_close:
+            self._close(old)
+
+    def _shrink(self):
+        """
+        Remove connections that have been idle too long, keeping minconn open.
+        Must be called holding the lock.
+        """
+        now = time.monotonic()
+        removed = []
+        # oldest are at the start
+        while self._idle and self._size() > self.minconn and now - self._idle[0][1] > self.idle_timeout:
+            removed.append(self._idle.pop(0)[0])
+        return removed
+
+    def mark_reconnect(self):
+        """
+        Count a reconnect caused by a connection failing while in use.
+        """
+        with self._lock:
+            self._reconnects += 1
+
+    def closeall(self):
+        """
+        Close all idle connections, connections in use are closed when returned.
+        """
+        with self._lock:
+            idle = [conn for conn,_ in self._idle]
+            self._idle = []
+        for conn in idle:
+            self._close(conn)
+
+    def stats(self):
+        """
+        Current pool usage and wait times.
+        """
+        with self._lock:
+            return {
+                'size': self._size(),
+                'in_use': len(self._in_use),
+                'idle': len(self._idle),
+                'minconn': self.minconn,
+                'maxconn': self.maxconn,
+                'checkouts': self._checkouts,
+                'waits': self._waits,
+                'wait_time_total': self._wait_time_total,
+                'wait_time_max': self._wait_time_max,
+                'reconnects': self._reconnects,
+                'failed_health_checks': self._failed_checks,
+            }
@@ -0,0 +1,58 @@
+"""
+Benchmark of a whole draw by group size, from reading the group through the draw engine to
+saving the results, on the in memory database backend:
+
+    python drawbench.py [people ...]
+
+Each size gets a new group with two ideas per person, then the group is rolled with
+santalogic.update_game_state as the owner would. The draw runs during the call
+(DRAW_JOBS=off) so the time is the draw itself, not time waiting in the queue.
+"""
+
+import os
+import sys
+import time
+
+# before the database module is loaded, this never touches a real database.
+os.environ['DATABASE_BACKEND'] = 'memory'
+os.environ['DRAW_JOBS'] = 'off'
+
+import database
+import santalogic
+from dbcommon import Identity
+
+def __identity(email:str,name:str):
+    identity = database.register_user(email,name)[0]
+    return Identity(identity,None)
+
+def benchmark(people:int,ideas_per_person:int=2):
+    """
+    Roll a new group of people, returns the time to set it up and to draw it.
+    """
+    start = time.perf_counter()
+    owner = __identity("owner{}@bench".format(people),"Owner")
+    code = santalogic.create_game("Bench {}".format(people),owner,None)['pubkey']
+    for i in range(people):
+        player = __identity("player{}.{}@bench".format(people,i),"Player {}".format(i))
+        database.join_game("Player {}".format(i),code,player,None)
+        for idea in range(ideas_per_person):
+            database.new_idea(code,"Idea {} from {}".format(idea,i),player,None)
+    setup_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    santalogic.update_game_state(code,owner,None,1)
+    draw_time = time.perf_counter() - start
+    return {
+        'people': people,
+        'ideas': people * ideas_per_person,
+        'setup_time': setup_time,
+        'draw_time': draw_time,
+    }
+
+if __name__ == '__main__':
+    sizes = [int(x) for x in sys.argv[1:]] or [10,100,1000,10000,50000]
+    results = [benchmark(size) for size in sizes]
+    print("{:>8} {:>8} {:>10} {:>10} {:>12}".format('people','ideas','setup s','draw s','people/s'))
+    for result in results:
+        print("{people:>8} {ideas:>8} {setup_time:>10.3f} {draw_time:>10.3f} {rate:>12.0f}".format(
+            rate=result['people'] / result['draw_time'] if result['draw_time'] else 0.0,**result))
@@ -0,0 +1,278 @@
+"""
+Queue for draws, a draw request returns a job id straight away and the draw is run
+by background workers. The job can be checked with the id until it is done or failed.
+
+Two stores are available:
+    database - recorded in the draw jobs table, survives restarts and can be run by a
+               separate worker process (drawworker.py.) The default.
+    memory   - queued in this process, lost on restart and only known to this process.
+"""
+
+import threading
+import time
+from collections import OrderedDict, deque
+
+import database
+import SantaErrors
+from SantaErrors import exception_as_string
+
+class MemoryStore:
+    """
+    Jobs held in this process, the newest finished jobs are kept for status checks.
+    """
+
+    def __init__(self,history_size:int=1000):
+        self._lock = threading.Condition()
+        self._jobs = OrderedDict()
+        self._queue = deque()
+        self._active = {}
+        self.history_size = history_size
+
+    def put(self,job_id:str,code:str,ownerid:int,wake):
+        with self._lock:
+            active = self._active.get(code)
+            if active is not None:
+                return dict(self._jobs[active])
+            job = {
+                'id': job_id,
+                'code': code,
+                'ownerid': ownerid,
+                'state': 'queued',
+                'attempts': 0,
+                'error': None,
+                'users': None,
+                'ideas': None,
+                'queued_time': time.time(),
+                'started_time': None,
+                'finished_time': None,
+            }
+            self._jobs[job_id] = job
+            self._queue.append(job_id)
+            self._active[code] = job_id
+            self._lock.notify()
+            return dict(job)
+
+    def claim(self,timeout:float):
+        """
+        Get the next waiting job, or None after timeout.
+        """
+        with self._lock:
+            if not self._queue:
+                self._lock.wait(timeout)
+            if not self._queue:
+                return None
+            job = self._jobs[self._queue.popleft()]
+            job['state'] = 'running'
+            job['attempts'] += 1
+            job['started_time'] = time.time()
+            return dict(job)
+
+    def heartbeat(self,job_id:str,attempt:int):
+        # jobs in this process are never picked up by another worker.
+        pass
+
+    def finish(self,job_id:str,state:str,error:str=None,users:int=None,ideas:int=None,attempt:int=None):
+        with self._lock:
+            job = self._jobs[job_id]
+            job.update({'state':state,'error':error,'users':users,'ideas':ideas,'finished_time':time.time()})
+            if self._active.get(job['code']) == job_id:
+                del self._active[job['code']]
+            # forget the oldest finished jobs.
+            while len(self._jobs) > self.history_size:
+                oldest_id,oldest = next(iter(self._jobs.items()))
+                if oldest['state'] not in ('done','failed'):
+                    break
+                del self._jobs[oldest_id]
+
+    def get(self,job_id:str):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def depth(self):
+        with self._lock:
+            return len(self._active)
+
+class DatabaseStore:
+    """
+    Jobs recorded in the database draw jobs table.
+    """
+
+    def put(self,job_id:str,code:str,ownerid:int,wake):
+        job = database.queue_draw_job(job_id,code,ownerid)
+        if job is None:
+            # another request queued a draw for the game at the same moment.
+            raise SantaErrors.Exists("A draw is already queued for this group.")
+        wake()
+        return job
+
+    def claim(self,timeout:float):
+        return database.claim_draw_job()
+
+    def heartbeat(self,job_id:str,attempt:int):
+        database.heartbeat_draw_job(job_id,attempt)
+
+    def finish(self,job_id:str,state:str,error:str=None,users:int=None,ideas:int=None,attempt:int=None):
+        database.finish_draw_job(job_id,state,error=error,users=users,ideas=ideas,attempt=attempt)
+
+    def get(self,job_id:str):
+        return database.get_draw_job(job_id)
+
+    def depth(self):
+        return database.draw_job_depth()
+
+class DrawQueue:
+    """
+    Runs queued draws on a pool of worker threads.
+
+    :param run: Function taking a job dict that runs the draw, returns a dict with users and ideas counts.
+        Public errors are shown in the job, other errors are logged and shown as an internal error.
+    :param store: MemoryStore or DatabaseStore.
+    :param workers: Number of draw threads in this process, 0 to only queue jobs for another process.
+    :param poll_interval: Seconds between checks for new jobs from other processes.
+    :param heartbeat_interval: Seconds between heartbeats of a running draw, well under the store's stale time
+        so a slow draw isn't picked up again while it is still running.
+    """
+
+    def __init__(self,run,store,workers:int=2,poll_interval:float=5,heartbeat_interval:float=60):
+        self._run_draw = run
+        self.store = store
+        self.worker_count = workers
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval
+
+        self._wake_event = threading.Event()
+        self._start_lock = threading.Lock()
+        self._workers = []
+        self._stopping = False
+
+        self._stats_lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._done = 0
+        self._failed = 0
+        self._draw_time_total = 0.0
+        self._draw_time_max = 0.0
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
+
+    def start(self):
+        with self._start_lock:
+            if self._workers:
+                return
+            for i in range(self.worker_count):
+                worker = threading.Thread(target=self._run,name="draw-job-{}".format(i),daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+    def _wake(self):
+        self._wake_event.set()
+
+    def submit(self,job_id:str,code:str,ownerid:int):
+        """
+        Queue a draw, returns the job. If the game already has a waiting or running draw that job is returned.
+        """
+        self.start()
+        job = self.store.put(job_id,code,ownerid,self._wake)
+        if job['id'] == job_id:
+            with self._stats_lock:
+                self._queued += 1
+        return job
+
+    def status(self,job_id:str):
+        return self.store.get(job_id)
+
+    def run_forever(self):
+        """
+        Run the workers in the foreground, for a worker process.
+        """
+        self.start()
+        for worker in self._workers:
+            worker.join()
+
+    def _run(self):
+        while not self._stopping:
+            try:
+                job = self.store.claim(self.poll_interval)
+            except Exception as e:
+                print("Draw Job Error: unable to get jobs {}".format(exception_as_string(e)))
+                job = None
+                time.sleep(self.poll_interval)
+            if job is None:
+                # the database store doesn't block, wait for a new job or the poll interval.
+                if isinstance(self.store,DatabaseStore):
+                    self._wake_event.wait(self.poll_interval)
+                    self._wake_event.clear()
+                continue
+            self._process(job)
+
+    def _process(self,job:dict):
+        with self._stats_lock:
+            self._running += 1
+            wait_time = time.time() - job['queued_time']
+            self._wait_time_total += wait_time
+            self._wait_time_max = max(self._wait_time_max,wait_time)
+        start = time.perf_counter()
+        state = 'done'
+        error = None
+        result = {}
+        running = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat,args=(job,running),name="draw-job-heartbeat",daemon=True)
+        heartbeat.start()
+        try:
+            result = self._run_draw(job) or {}
+        except SantaErrors.PublicError as e:
+            state = 'failed'
+            error = str(e)
+        except Exception as e:
+            print("Draw Job Error: {} for {}: {}".format(job['id'],job['code'],exception_as_string(e)))
+            state = 'failed'
+            error = "Internal Error"
+        finally:
+            running.set()
+        draw_time = time.perf_counter() - start
+        try:
+            self.store.finish(job['id'],state,error=error,users=result.get('users'),ideas=result.get('ideas'),attempt=job['attempts'])
+        except Exception as e:
+            print("Draw Job Error: unable to record result of {}: {}".format(job['id'],exception_as_string(e)))
+        with self._stats_lock:
+            self._running -= 1
+            if state == 'done':
+                self._done += 1
+            else:
+                self._failed += 1
+            self._draw_time_total += draw_time
+            self._draw_time_max = max(self._draw_time_max,draw_time)
+
+    def _heartbeat(self,job:dict,finished:threading.Event):
+        while not finished.wait(self.heartbeat_interval):
+            try:
+                self.store.heartbeat(job['id'],job['attempts'])
+            except Exception as e:
+                print("Draw Job Error: unable to record heartbeat of {}: {}".format(job['id'],exception_as_string(e)))
+
+    def stop(self):
+        self._stopping = True
+        self._wake()
+
+    def stats(self):
+        """
+        Queue depth and draw timings.
+        """
+        try:
+            depth = self.store.depth()
+        except Exception:
+            depth = None
+        with self._stats_lock:
+            finished = self._done + self._failed
+            return {
+                'depth': depth,
+                'running': self._running,
+                'queued': self._queued,
+                'done': self._done,
+                'failed': self._failed,
+                'draw_time_avg': self._draw_time_total / finished if finished else 0.0,
+                'draw_time_max': self._draw_time_max,
+                'wait_time_avg': self._wait_time_total / finished if finished else 0.0,
+                'wait_time_max': self._wait_time_max,
+            }
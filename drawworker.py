@@ -0,0 +1,20 @@
+"""
+Worker process for queued draws, runs draws from the draw jobs table so web
+processes only have to queue them, see the Procfile. Needs DRAW_JOBS=database (the default.)
+"""
+
+import os
+import sys
+
+import database
+import santalogic
+
+if __name__ == '__main__':
+    if os.environ.get('DRAW_JOBS','database').lower() != 'database':
+        print("Draw worker: DRAW_JOBS must be database for a separate worker process.")
+        sys.exit(1)
+    threads = int(os.environ.get('DRAW_WORKER_THREADS',2))
+    print("Draw worker: running {} draw threads.".format(threads))
+    santalogic.draw_queue.worker_count = threads
+    database.start_game_change_listener()
+    santalogic.draw_queue.run_forever()
@@ -0,0 +1,204 @@
+"""
+Cache of games by code, games are looked up on almost every call but only change a
+few times in their life.
+
+The database backend drops a game from the cache whenever it changes it, and can
+listen for changes made by other processes (see GameChangeListener.)
+"""
+
+import select
+import threading
+import time
+from collections import OrderedDict
+
+from SantaErrors import exception_as_string
+
+class _Load:
+    """
+    A lookup in progress, other threads missing the same code wait for it instead of running their own query.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        # set if the game changed while loading, the result is returned but not cached.
+        self.stale = False
+
+class GameCache:
+    """
+    LRU cache of games by code with a time to live.
+
+    Only games that exist are cached, so a new game is never hidden by an earlier miss.
+
+    :param ttl: Seconds a game is used without checking the database, 0 disables the cache.
+    :param max_size: Most games kept, the least recently used are dropped first.
+    """
+
+    def __init__(self,ttl:float=30,max_size:int=4096):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # code -> (game, expiry time)
+        self._entries = OrderedDict()
+        # code -> _Load
+        self._loading = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self):
+        return self.ttl > 0 and self.max_size > 0
+
+    def get(self,code:str,load):
+        """
+        Get a game by code, calling load(code) on a miss. load returns the game dict or None if there is no game.
+        Returns a copy of the game, or None.
+        """
+        if not self.enabled:
+            return load(code)
+        with self._lock:
+            entry = self._entries.get(code)
+            if entry is not None:
+                if entry[1] >= time.monotonic():
+                    self._entries.move_to_end(code)
+                    self.hits += 1
+                    return dict(entry[0])
+                del self._entries[code]
+                self.expirations += 1
+            self.misses += 1
+            loading = self._loading.get(code)
+            if loading is None:
+                loading = self._loading[code] = _Load()
+                owner = True
+            else:
+                self.coalesced += 1
+                owner = False
+
+        if not owner:
+            loading.done.wait()
+            if loading.error is not None:
+                raise loading.error
+            return dict(loading.value) if loading.value is not None else None
+
+        try:
+            loading.value = load(code)
+        except Exception as e:
+            loading.error = e
+            raise
+        finally:
+            with self._lock:
+                if self._loading.get(code) is loading:
+                    del self._loading[code]
+                if loading.error is None and loading.value is not None and not loading.stale:
+                    self._entries[code] = (dict(loading.value),time.monotonic() + self.ttl)
+                    self._entries.move_to_end(code)
+                    while len(self._entries) > self.max_size:
+                        self._entries.popitem(last=False)
+                        self.evictions += 1
+            loading.done.set()
+        return dict(loading.value) if loading.value is not None else None
+
+    def invalidate(self,code:str):
+        """
+        Drop a game that has changed, a lookup already running for it will not be cached.
+        """
+        with self._lock:
+            if self._entries.pop(code,None) is not None:
+                self.invalidations += 1
+            loading = self._loading.pop(code,None)
+            if loading is not None:
+                loading.stale = True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            for loading in self._loading.values():
+                loading.stale = True
+            self._loading.clear()
+
+    def stats(self):
+        """
+        Counters for sizing the cache.
+        """
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+            }
+
+class GameChangeListener:
+    """
+    Listens on a postgres notify channel for games changed by other processes and drops them from the cache.
+    A payload of * clears the whole cache. The cache is also cleared whenever the connection is lost,
+    as changes may have been missed.
+
+    :param connect: Function returning a new psycopg2 connection, it is kept open for listening.
+    :param channel: Notify channel name.
+    :param cache: GameCache to invalidate.
+    :param retry_interval: Seconds to wait before reconnecting.
+    """
+
+    def __init__(self,connect,channel:str,cache:GameCache,retry_interval:float=5):
+        self._connect = connect
+        self.channel = channel
+        self.cache = cache
+        self.retry_interval = retry_interval
+        self._thread = None
+        self._stopping = False
+        self.notifications = 0
+        self.reconnects = 0
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run,name="game-cache-listener",daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping = True
+
+    def _run(self):
+        while not self._stopping:
+            conn = None
+            try:
+                conn = self._connect()
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute("LISTEN {};".format(self.channel))
+                # anything may have changed while we weren't listening.
+                self.cache.clear()
+                while not self._stopping:
+                    if select.select([conn],[],[],self.retry_interval) == ([],[],[]):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        self.notifications += 1
+                        if notify.payload == '*':
+                            self.cache.clear()
+                        else:
+                            self.cache.invalidate(notify.payload)
+            except Exception as e:
+                print("Game Cache Error: listener lost connection {}".format(exception_as_string(e)))
+                self.cache.clear()
+                self.reconnects += 1
+                time.sleep(self.retry_interval)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
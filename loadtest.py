@@ -0,0 +1,148 @@
+"""
+Load test for comparing serving modes, sends the same requests to each server and reports
+the throughput and latency percentiles side by side.
+
+Start the app both ways on different ports, for example:
+
+    python api.py                                   (waitress on PORT 5000)
+    uvicorn asyncapi:app --port 5001
+
+then run:
+
+    python loadtest.py <game code> <requests> <concurrency> http://localhost:5000 http://localhost:5001
+
+GET /game and GET /idea are sent for the game code. Set LOADTEST_SESSION and LOADTEST_SECRET to a
+session that owns the game to also send POST /game_sum and /game/owned.
+"""
+
+import asyncio
+import json
+import os
+import sys
+import time
+import urllib.parse
+
+class Connection:
+    """
+    A keep alive HTTP/1.1 connection, reconnects if the server closes it.
+    """
+
+    def __init__(self,host:str,port:int):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def request(self,method:str,path:str,body:bytes=b''):
+        if self.writer is None:
+            self.reader,self.writer = await asyncio.open_connection(self.host,self.port)
+        head = "{} {} HTTP/1.1\r\nHost: {}:{}\r\nContent-Length: {}\r\n".format(method,path,self.host,self.port,len(body))
+        if body:
+            head += "Content-Type: application/json\r\n"
+        self.writer.write(head.encode('latin1') + b"\r\n" + body)
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError("Connection closed by server.")
+        status = int(status_line.split(b' ')[1])
+        length = None
+        close = False
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n",b"\n",b""):
+                break
+            name,_,value = line.decode('latin1').partition(':')
+            name = name.strip().lower()
+            if name == 'content-length':
+                length = int(value.strip())
+            elif name == 'connection' and value.strip().lower() == 'close':
+                close = True
+        if length is None:
+            response_body = await self.reader.read()
+            close = True
+        else:
+            response_body = await self.reader.readexactly(length)
+        if close:
+            self.close()
+        return status,response_body
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+
+def __requests(code:str):
+    """
+    The requests to send in turn.
+    """
+    requests = [
+        ('GET','/game?code={}'.format(urllib.parse.quote(code)),b''),
+        ('GET','/idea?code={}'.format(urllib.parse.quote(code)),b''),
+    ]
+    if 'LOADTEST_SESSION' in os.environ:
+        credentials = {'session':os.environ['LOADTEST_SESSION'],'secret':os.environ.get('LOADTEST_SECRET','')}
+        requests.append(('POST','/game_sum',json.dumps(dict(credentials,code=code)).encode('utf-8')))
+        requests.append(('POST','/game/owned',json.dumps(credentials).encode('utf-8')))
+    return requests
+
+async def __worker(url,requests:list,counter:list,total:int,latencies:list,errors:list):
+    connection = Connection(url.hostname,url.port or 80)
+    try:
+        while counter[0] < total:
+            index = counter[0]
+            counter[0] += 1
+            method,path,body = requests[index % len(requests)]
+            start = time.perf_counter()
+            try:
+                status,response_body = await connection.request(method,url.path.rstrip('/') + path,body)
+                if status != 200:
+                    errors.append(status)
+            except (OSError,ConnectionError,asyncio.IncompleteReadError) as e:
+                connection.close()
+                errors.append(type(e).__name__)
+                continue
+            latencies.append(time.perf_counter() - start)
+    finally:
+        connection.close()
+
+def __percentile(sorted_values:list,fraction:float):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1,int(len(sorted_values) * fraction))]
+
+async def run(base_url:str,code:str,total:int,concurrency:int):
+    """
+    Send total requests to a server from concurrency connections, returns the throughput and latencies in ms.
+    """
+    url = urllib.parse.urlparse(base_url)
+    requests = __requests(code)
+    latencies = []
+    errors = []
+    counter = [0]
+    start = time.perf_counter()
+    await asyncio.gather(*[__worker(url,requests,counter,total,latencies,errors) for i in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'url': base_url,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'requests_per_second': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': __percentile(latencies,0.50) * 1000,
+        'p99_ms': __percentile(latencies,0.99) * 1000,
+        'max_ms': latencies[-1] * 1000 if latencies else 0.0,
+    }
+
+if __name__ == '__main__':
+    if len(sys.argv) < 5:
+        print("usage: python loadtest.py <game code> <requests> <concurrency> <url> [<url> ...]")
+        sys.exit(1)
+    code = sys.argv[1]
+    total = int(sys.argv[2])
+    concurrency = int(sys.argv[3])
+    print("{:<32} {:>8} {:>7} {:>10} {:>9} {:>9} {:>9}".format('url','requests','errors','req/s','p50 ms','p99 ms','max ms'))
+    for base_url in sys.argv[4:]:
+        result = asyncio.get_event_loop().run_until_complete(run(base_url,code,total,concurrency))
+        print("{url:<32} {requests:>8} {errors:>7} {requests_per_second:>10.1f} {p50_ms:>9.2f} {p99_ms:>9.2f} {max_ms:>9.2f}".format(**result))
@@ -0,0 +1,88 @@
+"""
+Benchmark of the SendGrid transport with and without connection reuse, against a local
+stand in server so no mail is sent:
+
+    python mailbench.py [messages] [threads] [server delay ms]
+
+The stand in accepts every post like the mail send api does. It is plain http, so the
+difference measured is the TCP setup per message, against SendGrid each new connection
+also pays for a TLS handshake and the gap is bigger.
+"""
+
+import http.server
+import sys
+import threading
+import time
+
+import mailtransport
+
+class _StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    delay = 0.0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length',0)))
+        if self.delay:
+            time.sleep(self.delay)
+        self.send_response(202)
+        self.send_header('Content-Length','0')
+        if self.headers.get('Connection','').lower() == 'close':
+            self.send_header('Connection','close')
+            self.close_connection = True
+        self.end_headers()
+
+    def log_message(self,format,*args):
+        pass
+
+def start_server(delay:float=0.0):
+    """
+    Start the stand in server on a free local port, returns the server.
+    """
+    handler = type('StandInHandler',(_StandInHandler,),{'delay':delay})
+    server = http.server.ThreadingHTTPServer(('127.0.0.1',0),handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever,name="mailbench-server",daemon=True).start()
+    return server
+
+def run(port:int,messages:int,threads:int,keep_alive:bool):
+    """
+    Send messages from threads senders, returns the sends per second and connections opened.
+    """
+    transport = mailtransport.SendGridTransport(lambda: 'benchmark',keep_alive=keep_alive,host='127.0.0.1',port=port,secure=False)
+    body = {
+        'personalizations': [{'to': [{'email':'someone@example.com'}]}],
+        'from': {'email':'santa@example.com'},
+        'subject': 'Benchmark',
+        'content': [{'type':'text/html','value':'<p>{}</p>'.format('x' * 2000)}],
+    }
+    per_thread = messages // threads
+    def sender():
+        for i in range(per_thread):
+            transport.post(body)
+    workers = [threading.Thread(target=sender) for i in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    stats = transport.stats()
+    return {
+        'keep_alive': keep_alive,
+        'sent': stats['requests_sent'],
+        'connections': stats['connections_opened'],
+        'seconds': elapsed,
+        'sends_per_second': stats['requests_sent'] / elapsed if elapsed else 0.0,
+    }
+
+if __name__ == '__main__':
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    delay = float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0.0
+    server = start_server(delay)
+    port = server.server_address[1]
+    print("{:>10} {:>8} {:>11} {:>9} {:>10}".format('keep alive','sent','connections','seconds','sends/s'))
+    for keep_alive in [False,True]:
+        result = run(port,messages,threads,keep_alive)
+        print("{keep_alive!s:>10} {sent:>8} {connections:>11} {seconds:>9.3f} {sends_per_second:>10.1f}".format(**result))
+    server.shutdown()
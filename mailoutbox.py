@@ -0,0 +1,252 @@
+"""
+Outbox for email, messages are queued and sent by background workers so a
+request doesn't have to wait for the mail service.
+
+Two stores are available:
+    database - recorded in the outbox table, survives restarts and can be shared by processes. The default.
+    memory   - queued in this process, lost on restart.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+
+import database
+from SantaErrors import exception_as_string
+
+class MemoryStore:
+    """
+    Outbox held in this process.
+    """
+
+    def __init__(self,dead_letter_size:int=100):
+        self._lock = threading.Condition()
+        # heap of (next attempt time, sequence, message)
+        self._queue = []
+        self._sequence = itertools.count()
+        self.dead_letters = deque(maxlen=dead_letter_size)
+
+    def put(self,message:dict,wake):
+        with self._lock:
+            heapq.heappush(self._queue,(time.time(),next(self._sequence),message))
+            self._lock.notify()
+
+    def claim(self,timeout:float):
+        """
+        Get the next message that is due, or None after timeout.
+        """
+        deadline = time.time() + timeout
+        with self._lock:
+            while True:
+                now = time.time()
+                if self._queue and self._queue[0][0] <= now:
+                    message = heapq.heappop(self._queue)[2]
+                    message['attempts'] += 1
+                    return message
+                if now >= deadline:
+                    return None
+                wait = deadline - now
+                if self._queue:
+                    wait = min(wait,self._queue[0][0] - now)
+                self._lock.wait(wait)
+
+    def sent(self,message:dict):
+        pass
+
+    def retry(self,message:dict,error:str,delay:float):
+        message['last_error'] = error
+        with self._lock:
+            heapq.heappush(self._queue,(time.time() + delay,next(self._sequence),message))
+            self._lock.notify()
+
+    def dead(self,message:dict,error:str):
+        message['last_error'] = error
+        # don't keep message bodies around, they contain logon codes.
+        message.pop('html',None)
+        self.dead_letters.append(message)
+
+    def depth(self):
+        with self._lock:
+            return len(self._queue)
+
+class DatabaseStore:
+    """
+    Outbox recorded in the database outbox table.
+    """
+
+    def put(self,message:dict,wake):
+        message['id'] = database.queue_mail(message['to'],message['subject'],message['html'])
+        wake()
+
+    def claim(self,timeout:float):
+        message = database.claim_mail()
+        if message is None:
+            return None
+        return {
+            'id': message['id'],
+            'to': message['to_email'],
+            'subject': message['subject'],
+            'html': message['html'],
+            'attempts': message['attempts'],
+            'queued': message['queued_time'],
+        }
+
+    def sent(self,message:dict):
+        database.mark_mail_sent(message['id'])
+
+    def retry(self,message:dict,error:str,delay:float):
+        database.mark_mail_failed(message['id'],error,retry_seconds=delay)
+
+    def dead(self,message:dict,error:str):
+        database.mark_mail_failed(message['id'],error,retry_seconds=None)
+
+    def depth(self):
+        return database.mail_queue_depth()
+
+class Outbox:
+    """
+    Queues messages and sends them on a pool of worker threads, failed sends are
+    retried with an increasing delay until max_attempts then moved to the dead letters.
+
+    :param send: Function taking (to,subject,html) that sends a message, raises on failure.
+    :param store: MemoryStore or DatabaseStore.
+    :param workers: Number of sending threads.
+    :param max_attempts: Sends to try before giving up on a message.
+    :param backoff: Seconds to wait before the first retry, doubles each attempt.
+    :param max_backoff: Longest wait between retries.
+    :param poll_interval: Seconds between checks for new messages from other processes.
+    """
+
+    def __init__(self,send,store,workers:int=2,max_attempts:int=5,backoff:float=2,max_backoff:float=300,poll_interval:float=5):
+        self._send = send
+        self.store = store
+        self.worker_count = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.poll_interval = poll_interval
+
+        self._wake_event = threading.Event()
+        self._start_lock = threading.Lock()
+        self._workers = []
+        self._stopping = False
+
+        self._stats_lock = threading.Lock()
+        self._queued = 0
+        self._sent = 0
+        self._failed_attempts = 0
+        self._dead = 0
+        self._sending = 0
+        self._send_time_total = 0.0
+        self._send_time_max = 0.0
+        self._delivery_time_total = 0.0
+        self._delivery_time_max = 0.0
+
+    def start(self):
+        """
+        Start the sending threads, called when the app starts so mail left queued before a restart is sent.
+        """
+        with self._start_lock:
+            if self._workers:
+                return
+            for i in range(self.worker_count):
+                worker = threading.Thread(target=self._run,name="mail-outbox-{}".format(i),daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+    def _wake(self):
+        self._wake_event.set()
+
+    def queue(self,to:str,subject:str,html:str):
+        """
+        Add a message to the outbox, returns as soon as it is stored.
+        """
+        self.start()
+        self.store.put({
+            'to': to,
+            'subject': subject,
+            'html': html,
+            'attempts': 0,
+            'queued': time.time(),
+        },self._wake)
+        with self._stats_lock:
+            self._queued += 1
+
+    def _run(self):
+        while not self._stopping:
+            try:
+                message = self.store.claim(self.poll_interval)
+            except Exception as e:
+                print("Outbox Error: unable to get messages {}".format(exception_as_string(e)))
+                message = None
+                time.sleep(self.poll_interval)
+            if message is None:
+                # the database store doesn't block, wait for a new message or the poll interval.
+                if isinstance(self.store,DatabaseStore):
+                    self._wake_event.wait(self.poll_interval)
+                    self._wake_event.clear()
+                continue
+            self._deliver(message)
+
+    def _deliver(self,message:dict):
+        with self._stats_lock:
+            self._sending += 1
+        start = time.perf_counter()
+        try:
+            self._send(message['to'],message['subject'],message['html'])
+            send_time = time.perf_counter() - start
+            self.store.sent(message)
+            delivery_time = time.time() - message['queued']
+            with self._stats_lock:
+                self._sent += 1
+                self._send_time_total += send_time
+                self._send_time_max = max(self._send_time_max,send_time)
+                self._delivery_time_total += delivery_time
+                self._delivery_time_max = max(self._delivery_time_max,delivery_time)
+        except Exception as e:
+            error = str(e)
+            with self._stats_lock:
+                self._failed_attempts += 1
+            try:
+                if message['attempts'] >= self.max_attempts:
+                    print("Outbox Error: giving up on message to {} after {} attempts: {}".format(message['to'],message['attempts'],error))
+                    self.store.dead(message,error)
+                    with self._stats_lock:
+                        self._dead += 1
+                else:
+                    delay = min(self.backoff * (2 ** (message['attempts'] - 1)),self.max_backoff)
+                    print("Outbox Error: send to {} failed, retry in {}s: {}".format(message['to'],delay,error))
+                    self.store.retry(message,error,delay)
+            except Exception as store_error:
+                print("Outbox Error: unable to record failure {}".format(exception_as_string(store_error)))
+        finally:
+            with self._stats_lock:
+                self._sending -= 1
+
+    def stop(self):
+        self._stopping = True
+        self._wake()
+
+    def stats(self):
+        """
+        Queue depth and send timings.
+        """
+        try:
+            depth = self.store.depth()
+        except Exception:
+            depth = None
+        with self._stats_lock:
+            return {
+                'depth': depth,
+                'sending': self._sending,
+                'queued': self._queued,
+                'sent': self._sent,
+                'failed_attempts': self._failed_attempts,
+                'dead': self._dead,
+                'send_time_avg': self._send_time_total / self._sent if self._sent else 0.0,
+                'send_time_max': self._send_time_max,
+                'delivery_time_avg': self._delivery_time_total / self._sent if self._sent else 0.0,
+                'delivery_time_max': self._delivery_time_max,
+            }
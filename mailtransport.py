@@ -0,0 +1,357 @@
+"""
+Mail transports, the ways a rendered email can be sent.
+
+    sendgrid - SendGrid web api over kept alive https connections.
+    smtp     - any SMTP server, with a pool of open connections.
+    file     - writes each message to a file in a directory, for testing.
+    memory   - keeps messages in a list, for testing and benchmarks.
+
+All transports take messages as dicts with from, to, subject and html keys.
+send_batch sends one message to many recipients, and yields the number sent after each batch.
+"""
+
+import http.client
+import json
+import os
+import queue
+import re
+import smtplib
+import threading
+import time
+import uuid
+from collections import deque
+from email.message import EmailMessage
+
+from sendgrid.helpers.mail import Mail
+
+import SantaErrors
+
+def expand_batch(message:dict,recipients:list):
+    """
+    Make the individual messages of a batch, each recipient's substitutions are replaced in the html.
+    """
+    for recipient in recipients:
+        substitutions = recipient['substitutions']
+        if substitutions:
+            # one pass, so a value that contains a token is left alone.
+            token_pattern = '|'.join(re.escape(token) for token in substitutions)
+            html = re.sub(token_pattern,lambda match: substitutions[match.group(0)],message['html'])
+        else:
+            html = message['html']
+        yield dict(message,to=recipient['to'],html=html)
+
+class SendGridTransport:
+    """
+    Sends with the SendGrid v3 api. Each thread keeps its https connection open
+    between messages, so the TLS setup is only paid once per thread.
+
+    A send is only tried again on a new connection if a kept alive connection failed before the
+    request was written. Once it is written the server may have sent the mail, so a failure
+    reading the response is passed on rather than risk sending it twice.
+
+    :param api_key: Function returning the api key, called when the first message is sent.
+    :param idle_timeout: Seconds a connection can sit unused before it is replaced instead of reused,
+        so connections the server is likely to have closed aren't written to.
+    :param keep_alive: False to open a new connection for every request, for benchmarks.
+    :param host: Server to send to, another host and port are only for benchmarks and tests.
+    :param secure: False to use plain http, for a local test server.
+    """
+
+    host = 'api.sendgrid.com'
+    path = '/v3/mail/send'
+
+    def __init__(self,api_key,timeout:float=10,idle_timeout:float=30,keep_alive:bool=True,host:str=None,port:int=None,secure:bool=True):
+        self._api_key = api_key
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.keep_alive = keep_alive
+        if host is not None:
+            self.host = host
+        self.port = port
+        self.secure = secure
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self.connections_opened = 0
+        self.requests_sent = 0
+
+    def _connection(self):
+        conn = getattr(self._local,'conn',None)
+        if conn is not None and time.monotonic() - self._local.last_used > self.idle_timeout:
+            self._reset()
+            conn = None
+        if conn is None:
+            if self.secure:
+                conn = http.client.HTTPSConnection(self.host,self.port,timeout=self.timeout)
+            else:
+                conn = http.client.HTTPConnection(self.host,self.port,timeout=self.timeout)
+            self._local.conn = conn
+            self._local.used = False
+            with self._stats_lock:
+                self.connections_opened += 1
+        return conn
+
+    def _reset(self):
+        conn = getattr(self._local,'conn',None)
+        self._local.conn = None
+        if conn is not None:
+            conn.close()
+
+    def post(self,body:dict):
+        """
+        Post a mail send request, returns the http status.
+        """
+        data = json.dumps(body).encode('utf-8')
+        headers = {
+            'Authorization': 'Bearer {}'.format(self._api_key()),
+            'Content-Type': 'application/json',
+            'Connection': 'keep-alive' if self.keep_alive else 'close',
+        }
+        while True:
+            conn = self._connection()
+            reused = self._local.used
+            try:
+                conn.request('POST',self.path,body=data,headers=headers)
+            except (http.client.HTTPException,OSError):
+                self._reset()
+                # the server closed an idle connection before the request was written, try once on a new one.
+                if reused:
+                    continue
+                raise
+            break
+        try:
+            response = conn.getresponse()
+            response_body = response.read()
+        except (http.client.HTTPException,OSError):
+            # the request was sent, so it can't be known if the mail was, don't send it again.
+            self._reset()
+            raise
+        self._local.used = True
+        self._local.last_used = time.monotonic()
+        with self._stats_lock:
+            self.requests_sent += 1
+        if response.will_close or not self.keep_alive:
+            self._reset()
+        if response.status >= 300:
+            raise SantaErrors.ConfigurationError("Mail service returned status {} {}".format(response.status,response_body[:200]))
+        return response.status
+
+    def send_batch(self,message:dict,recipients:list,batch_size:int=1000):
+        """
+        Send one message to many recipients, with per recipient substitutions in the html.
+        Up to batch_size recipients are sent as personalizations of a single request.
+
+        :param recipients: list of dicts with to and substitutions keys.
+        """
+        for start in range(0,len(recipients),batch_size):
+            batch = recipients[start:start+batch_size]
+            self.post({
+                'personalizations': [{
+                    'to': [{'email':recipient['to']}],
+                    'substitutions': recipient['substitutions'],
+                } for recipient in batch],
+                'from': {'email':message['from']},
+                'subject': message['subject'],
+                'content': [{'type':'text/html','value':message['html']}],
+            })
+            yield len(batch)
+
+    def send(self,message:dict):
+        mail = Mail(
+            from_email=message['from'],
+            to_emails=message['to'],
+            subject=message['subject'],
+            html_content=message['html'],
+        )
+        status = self.post(mail.get())
+        print("Email Send: {} {}".format(message['to'],status))
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'transport': 'sendgrid',
+                'connections_opened': self.connections_opened,
+                'requests_sent': self.requests_sent,
+            }
+
+class SMTPTransport:
+    """
+    Sends with an SMTP server, keeping up to pool_size connections open.
+    """
+
+    def __init__(self,host:str,port:int=587,username:str='',password:str='',starttls:bool=True,pool_size:int=2,timeout:float=10):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+        self._pool = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._stats_lock = threading.Lock()
+        self.connections_opened = 0
+        self.messages_sent = 0
+
+    def _connect(self):
+        smtp = smtplib.SMTP(self.host,self.port,timeout=self.timeout)
+        if self.starttls:
+            smtp.starttls()
+        if self.username:
+            smtp.login(self.username,self.password)
+        with self._stats_lock:
+            self.connections_opened += 1
+        return smtp
+
+    def _get(self):
+        self._slots.acquire()
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            try:
+                return self._connect()
+            except Exception:
+                self._slots.release()
+                raise
+
+    def _put(self,smtp,broken:bool=False):
+        if broken:
+            try:
+                smtp.close()
+            except Exception:
+                pass
+        else:
+            self._pool.put(smtp)
+        self._slots.release()
+
+    def send_many(self,messages:list):
+        """
+        Send messages down one connection, without a new connection and login per message.
+        """
+        smtp = self._get()
+        try:
+            for message in messages:
+                email = EmailMessage()
+                email['From'] = message['from']
+                email['To'] = message['to']
+                email['Subject'] = message['subject']
+                email.set_content(message['html'],subtype='html')
+                try:
+                    smtp.send_message(email)
+                except smtplib.SMTPServerDisconnected:
+                    # pooled connection timed out, replace it and try again.
+                    smtp.close()
+                    smtp = self._connect()
+                    smtp.send_message(email)
+                with self._stats_lock:
+                    self.messages_sent += 1
+        except Exception:
+            self._put(smtp,broken=True)
+            raise
+        self._put(smtp)
+
+    def send(self,message:dict):
+        self.send_many([message])
+
+    def send_batch(self,message:dict,recipients:list,batch_size:int=100):
+        """
+        Send one message to many recipients, batch_size messages per pooled connection checkout.
+        """
+        for start in range(0,len(recipients),batch_size):
+            batch = recipients[start:start+batch_size]
+            self.send_many(list(expand_batch(message,batch)))
+            yield len(batch)
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'transport': 'smtp',
+                'connections_opened': self.connections_opened,
+                'messages_sent': self.messages_sent,
+            }
+
+class MemoryTransport:
+    """
+    Keeps sent messages in memory, the oldest are dropped after max_messages.
+    """
+
+    def __init__(self,max_messages:int=1000):
+        self.messages = deque(maxlen=max_messages)
+        self.messages_sent = 0
+        self._lock = threading.Lock()
+
+    def send(self,message:dict):
+        with self._lock:
+            self.messages.append(dict(message,sent=time.time()))
+            self.messages_sent += 1
+
+    def send_batch(self,message:dict,recipients:list,batch_size:int=100):
+        for start in range(0,len(recipients),batch_size):
+            batch = recipients[start:start+batch_size]
+            for single in expand_batch(message,batch):
+                self.send(single)
+            yield len(batch)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'transport': 'memory',
+                'messages_sent': self.messages_sent,
+            }
+
+class FileTransport:
+    """
+    Writes each message to a html file in a directory.
+    """
+
+    def __init__(self,directory:str):
+        self.directory = directory
+        os.makedirs(directory,exist_ok=True)
+        self.messages_sent = 0
+        self._lock = threading.Lock()
+
+    def send(self,message:dict):
+        filename = os.path.join(self.directory,"{}-{}.html".format(int(time.time()),uuid.uuid4()))
+        with open(filename,'w',encoding='utf-8') as mail_file:
+            mail_file.write("<!-- From: {}\nTo: {}\nSubject: {} -->\n".format(message['from'],message['to'],message['subject']))
+            mail_file.write(message['html'])
+        with self._lock:
+            self.messages_sent += 1
+
+    def send_batch(self,message:dict,recipients:list,batch_size:int=100):
+        for start in range(0,len(recipients),batch_size):
+            batch = recipients[start:start+batch_size]
+            for single in expand_batch(message,batch):
+                self.send(single)
+            yield len(batch)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'transport': 'file',
+                'messages_sent': self.messages_sent,
+            }
+
+def from_environment(sendgrid_api_key):
+    """
+    Create the transport chosen by the MAIL_TRANSPORT config value.
+
+    :param sendgrid_api_key: Function returning the SendGrid key.
+    """
+    transport_name = os.environ.get('MAIL_TRANSPORT','sendgrid').lower()
+    if transport_name == 'sendgrid':
+        return SendGridTransport(sendgrid_api_key)
+    if transport_name == 'smtp':
+        if 'SMTP_HOST' not in os.environ:
+            raise SantaErrors.ConfigurationError("MAIL_TRANSPORT is smtp but SMTP_HOST is not set.")
+        return SMTPTransport(
+            os.environ['SMTP_HOST'],
+            port=int(os.environ.get('SMTP_PORT',587)),
+            username=os.environ.get('SMTP_USER',''),
+            password=os.environ.get('SMTP_PASSWORD',''),
+            starttls=os.environ.get('SMTP_STARTTLS','1') == '1',
+            pool_size=int(os.environ.get('SMTP_POOL_SIZE',2)),
+        )
+    if transport_name == 'file':
+        return FileTransport(os.environ.get('MAIL_FILE_DIR','mail_output'))
+    if transport_name == 'memory':
+        return MemoryTransport()
+    raise SantaErrors.ConfigurationError("Unknown MAIL_TRANSPORT {}".format(transport_name))
@@ -0,0 +1,1035 @@
+""" In memory backend for the database module, with the same functions and results as
+postgresdb but everything is held in dicts in this process.
+
+Data is lost when the process stops, so this is for tests, benchmarks and single node demos.
+Each function holds one lock for its whole run, which gives the same all or nothing
+behaviour as the postgres transactions.
+"""
+
+import csv
+import datetime
+import hashlib
+import heapq
+import hmac
+import os
+import threading
+import time
+
+import SantaErrors
+import dbcommon
+from dbcommon import Identity
+
+print("Using in memory database, data will be lost when the process stops.")
+
+__lock = threading.RLock()
+__request_state = threading.local()
+
+__assert_admin_key = dbcommon.assert_admin_key
+__assert_can_do_major_db_changes = dbcommon.assert_can_do_major_db_changes
+
+###############################
+# tables
+###############################
+
+class _Table:
+    """
+    Rows by id, with a serial id like a postgres serial column.
+    """
+    def __init__(self):
+        self.rows = {}
+        self._next_id = 1
+
+    def insert(self,row:dict):
+        row['id'] = self._next_id
+        self._next_id += 1
+        self.rows[row['id']] = row
+        return row
+
+    def clear(self):
+        self.rows.clear()
+        self._next_id = 1
+
+__games = _Table()
+__users = _Table()
+__ideas = _Table()
+__identities = _Table()
+__outbox = _Table()
+__sessions = {}
+
+# indexes, kept up to date by the functions that change the tables.
+__games_by_code = {}
+__users_by_game = {}        # game id -> {account id -> user id}
+__users_by_account = {}     # account id -> set of user ids
+__ideas_by_game = {}        # game id -> {(account id, idea) -> idea id}
+__ideas_by_user = {}        # user id -> set of idea ids
+__identities_by_email = {}  # lower case email -> identity id
+__exclusions_by_game = {}   # game id -> set of (user id, excluded user id)
+
+def __now():
+    return datetime.datetime.now()
+
+def __hash_secret(secret:str,salt:bytes=None):
+    """
+    Salted hash for session secrets and verify codes, like crypt() in postgres but fast.
+    """
+    if salt is None:
+        salt = os.urandom(16)
+    return salt + hashlib.sha256(salt + secret.encode('utf-8')).digest()
+
+def __check_secret(secret:str,secret_hash:bytes):
+    if secret_hash is None or secret is None:
+        return False
+    return hmac.compare_digest(__hash_secret(secret,secret_hash[:16]),secret_hash)
+
+def __lowercase_email(email:str):
+    return email.lower()
+
+def __select(row:dict,properties:list):
+    return {key:row.get(key) for key in properties}
+
+def __get_simple_table(table:_Table,columns_to_get:list,column_query:dict,valid_columns:list):
+    """Does a simple lookup against a single table, same rules as the postgres version.
+    """
+    if (len(column_query) == 0):
+        raise KeyError("Simple database lookup requires at least one column lookup.")
+    invalid_properties = [x for x in columns_to_get if x not in valid_columns]
+    if (invalid_properties):
+        raise KeyError("Invalid properties {props} for database query. The valid list of properties are: {valid}".format(props=invalid_properties,valid=valid_columns))
+    invalid_properties = [x for x in column_query.keys() if x not in valid_columns]
+    if (invalid_properties):
+        raise KeyError("Invalid query property {props} for database query. The valid list of columns are: {valid}".format(props=invalid_properties,valid=valid_columns))
+
+    with __lock:
+        # use an index for the common lookups rather than scanning.
+        if 'id' in column_query:
+            candidates = [table.rows[column_query['id']]] if column_query['id'] in table.rows else []
+        elif table is __games and 'code' in column_query:
+            game_id = __games_by_code.get(column_query['code'])
+            candidates = [__games.rows[game_id]] if game_id is not None else []
+        elif table is __ideas and 'game' in column_query:
+            candidates = [__ideas.rows[x] for x in __ideas_by_game.get(column_query['game'],{}).values()]
+        elif table is __users and 'game' in column_query:
+            candidates = [__users.rows[x] for x in __users_by_game.get(column_query['game'],{}).values()]
+        elif table is __identities and 'email' in column_query:
+            identity_id = __identities_by_email.get(column_query['email'])
+            candidates = [__identities.rows[identity_id]] if identity_id is not None else []
+        else:
+            candidates = table.rows.values()
+
+        return [__select(row,columns_to_get) for row in candidates if all(row.get(k) == v for k,v in column_query.items())]
+
+def __owned_game(code:str,owner_id:int):
+    game_id = __games_by_code.get(code)
+    if game_id is None:
+        return None
+    game = __games.rows[game_id]
+    if game['ownerid'] != owner_id:
+        return None
+    return game
+
+def __touch_game(game:dict):
+    # the game version changes with its state, players and ideas, for conditional gets.
+    game['version'] += 1
+    game['modified'] = datetime.datetime.utcnow()
+
+###############################
+# request handling
+###############################
+
+def begin_request():
+    """Start a request scope, used to count authentications per request.
+    """
+    __request_state.active = True
+    __request_state.identities = {}
+    __request_state.auth_count = 0
+    __request_state.auth_time = 0.0
+    __request_state.query_count = 0
+
+def end_request():
+    __request_state.active = False
+    __request_state.identities = {}
+
+def request_auth_count():
+    return getattr(__request_state,'auth_count',0)
+
+def request_timings():
+    return {
+        'db_time': 0.0,
+        'auth_time': getattr(__request_state,'auth_time',0.0),
+        'auth_count': getattr(__request_state,'auth_count',0),
+        'queries': getattr(__request_state,'query_count',0),
+    }
+
+def session_cache_stats():
+    return {}
+
+def game_cache_stats():
+    return {}
+
+def start_game_change_listener():
+    # games are only held in this process.
+    return
+
+def pool_stats():
+    return {}
+
+def query_stats():
+    return {}
+
+def table_sizes():
+    """Number of rows in each table.
+    """
+    with __lock:
+        return {
+            'games': len(__games.rows),
+            'users': len(__users.rows),
+            'ideas': len(__ideas.rows),
+            'identities': len(__identities.rows),
+            'sessions': len(__sessions),
+            'outbox': len(__outbox.rows),
+        }
+
+#######################
+# *User*
+#######################
+
+def get_users(query:dict, properties:list = ['id','name','game'] ):
+    """ Gets a user from a game by id,game etc.
+    """
+    valid_properties = ['id','name','game','santa']
+    return __get_simple_table(__users,properties,query,valid_properties)
+
+def get_user_giftee(user_id:int,game_code:str):
+    """ Gets the assigned recipient of a select user
+    """
+    if len(game_code) == 0:
+        raise ValueError("Game code is empty.")
+    with __lock:
+        game_id = __games_by_code.get(game_code)
+        santa_id = __users_by_game.get(game_id,{}).get(user_id)
+        if santa_id is None:
+            return []
+        santa = __users.rows[santa_id]
+        giftee = __users.rows.get(santa['santa'])
+        if giftee is None:
+            return []
+        return [{'name':santa['name'],'giftee':giftee['name']}]
+
+def get_user_ideas(user_id:int,game_code:str):
+    """ Gets the ideas assigned to a user
+    """
+    if len(game_code) == 0:
+        raise ValueError("Game code is empty.")
+    with __lock:
+        game_id = __games_by_code.get(game_code)
+        santa_id = __users_by_game.get(game_id,{}).get(user_id)
+        if santa_id is None:
+            return []
+        return [{'idea':__ideas.rows[x]['idea']} for x in sorted(__ideas_by_user.get(santa_id,()))]
+
+def get_draw_results(code:str,sessionid:str,sessionpassword:str):
+    """ Gets the giftee and ideas of every user in a drawn game, with their email address.
+    """
+    owner = __authenticate_user(sessionid,sessionpassword)
+    if len(code) == 0:
+        raise SantaErrors.EmptyValue("Group id is empty.")
+    with __lock:
+        game = __owned_game(code,owner['id'])
+        if game is None or game['state'] != 1:
+            return []
+        results = []
+        # in user order, as with postgres, so a resumed send skips the same people.
+        for santa_id in sorted(__users_by_game.get(game['id'],{}).values()):
+            santa = __users.rows[santa_id]
+            giftee = __users.rows.get(santa['santa'])
+            identity = __identities.rows.get(santa['account_id'])
+            if giftee is None or identity is None:
+                continue
+            results.append({
+                'email': identity['email'],
+                'name': santa['name'],
+                'giftee': giftee['name'],
+                'gamename': game['name'],
+                'ideas': [__ideas.rows[x]['idea'] for x in sorted(__ideas_by_user.get(santa_id,()))],
+            })
+        return results
+
+def __assign_idea(idea:dict,user_id:int):
+    old_user = idea['userid']
+    if old_user in __ideas_by_user:
+        __ideas_by_user[old_user].discard(idea['id'])
+    idea['userid'] = user_id
+    __ideas_by_user.setdefault(user_id,set()).add(idea['id'])
+
+def set_user_santa(user_id:str,santa_id:str,game_code:str,sessionid:str,sessionpassword:str):
+    """
+    Sets the santa of a user.
+    """
+    owner = __authenticate_user(sessionid,sessionpassword)
+    if (len(game_code) == 0):
+        raise ValueError("Gameid is empty.")
+    with __lock:
+        game = __owned_game(game_code,owner['id'])
+        user = __users.rows.get(user_id)
+        if game is None or user is None or user['game'] != game['id']:
+            raise FileNotFoundError("Unable to update user, one or more keys were wrong.")
+        user['santa'] = santa_id
+
+#######################
+# *Game*
+#######################
+
+def get_game(query:dict, properties:list = ['id','name','code','state'], cached:bool = True):
+    """ Gets a game from id/code etc. Nothing is cached here, cached is for the same interface as postgres.
+    """
+    valid_properties = ['id','name','code','state','ownerid','version','modified']
+    return __get_simple_table(__games,properties,query,valid_properties)
+
+def get_game_ideas(pubkey:str,sessionid:str,sessionpassword:str):
+    """
+    Gets ideas from a game code.
+    """
+    user = __authenticate_user(sessionid,sessionpassword)
+    if (len(pubkey) == 0):
+        raise ValueError("Gameid is empty.")
+    with __lock:
+        game = __owned_game(pubkey,user['id'])
+        if game is None:
+            return []
+        return [__select(__ideas.rows[x],['id','idea','game','account_id']) for x in __ideas_by_game.get(game['id'],{}).values()]
+
+def new_game(name:str,pubkey:str,sessionid:str,sessionpassword:str):
+    """ Inserts a new game into the database.
+    """
+    user = __authenticate_user(sessionid,sessionpassword)
+    with __lock:
+        if pubkey in __games_by_code:
+            raise SantaErrors.Exists("Group code already exists.")
+        game = __games.insert({'name':name,'secret':None,'code':pubkey,'state':0,'ownerid':user['id'],'draw_date':None,'version':0,'modified':datetime.datetime.utcnow()})
+        __games_by_code[pubkey] = game['id']
+        return [__select(game,['id','name','code','state','ownerid'])]
+
+def join_game(user_name:str,pubkey:str,sessionid:str,sessionpassword:str):
+    """ Inserts a new name into a game
+    """
+    user = __authenticate_user(sessionid,sessionpassword)
+
+    clean_name = user_name.strip()
+    if len(clean_name) == 0:
+        clean_name = user['name']
+
+    with __lock:
+        game_id = __games_by_code.get(pubkey)
+        if game_id is None or __games.rows[game_id]['state'] != 0:
+            return []
+        game = __games.rows[game_id]
+        game_users = __users_by_game.setdefault(game_id,{})
+        if user['id'] in game_users:
+            player = __users.rows[game_users[user['id']]]
+            status = 'Existing'
+        else:
+            player = __users.insert({'game':game_id,'name':clean_name,'santa':-1,'account_id':user['id'],'draw_group':None})
+            game_users[user['id']] = player['id']
+            __users_by_account.setdefault(user['id'],set()).add(player['id'])
+            __touch_game(game)
+            status = 'New'
+        result = __select(player,['id','name','game','account_id'])
+        result['status'] = status
+        result['gamename'] = game['name']
+        return [result]
+
+def list_user_games(sessionid:str,sessionpassword:str):
+    """
+    Allows a user to get the list of joined groups
+    """
+    user = __authenticate_user(sessionid,sessionpassword)
+    with __lock:
+        results = []
+        for player_id in __users_by_account.get(user['id'],()):
+            player = __users.rows[player_id]
+            game = __games.rows.get(player['game'])
+            if game is not None and game['state'] in (0,1):
+                results.append({'name':game['name'],'code':game['code'],'state':game['state'],'joinname':player['name']})
+        return results
+
+def list_owned_games(sessionid:str,sessionpassword:str):
+    """
+    get a list of groups owned by the user.
+    """
+    user = __authenticate_user(sessionid,sessionpassword)
+    with __lock:
+        return [__select(game,['name','code','state']) for game in __games.rows.values() if game['ownerid'] == user['id']]
+
+#######################
+# *idea*
+#######################
+
+def get_idea(query:dict, properties:list = ['id','game','idea']):
+    """ Gets ideas from game/id
+    """
+    valid_properties = ['id','game','idea','userid']
+    return __get_simple_table(__ideas,properties,query,valid_properties)
+
+def new_idea(pubkey:str,idea:str,sessionid:str,sessionpassword:str):
+    """
+    Add a new idea to a game
+    """
+    user = __authenticate_user(sessionid,sessionpassword)
+    with __lock:
+        game_id = __games_by_code.get(pubkey)
+        if game_id is None or __games.rows[game_id]['state'] != 0:
+            raise SantaErrors.NotFound("Group not found.")
+        game_ideas = __ideas_by_game.setdefault(game_id,{})
+        key = (user['id'],idea)
+        if key in game_ideas:
+            row = __ideas.rows[game_ideas[key]]
+            status = 'Existing'
+        else:
+            row = __ideas.insert({'game':game_id,'idea':idea,'userid':-1,'account_id':user['id']})
+            game_ideas[key] = row['id']
+            __ideas_by_user.setdefault(-1,set()).add(row['id'])
+            __touch_game(__games.rows[game_id])
+            status = 'New'
+        result = __select(row,['id','idea','game','account_id'])
+        result['status'] = status
+        result['gamename'] = __games.rows[game_id]['name']
+        return [result]
+
+def set_idea_user(idea_id:str,user_id:str,game_code:str,sessionid:str,sessionpassword:str):
+    """
+    Sets the idea of a user.
+    """
+    owner = __authenticate_user(sessionid,sessionpassword)
+    if (len(game_code) == 0):
+        raise SantaErrors.EmptyValue("Group id is empty.")
+    with __lock:
+        game = __owned_game(game_code,owner['id'])
+        idea = __ideas.rows.get(idea_id)
+        if game is None or idea is None or idea['game'] != game['id']:
+            raise SantaErrors.DatabaseChangeError("Unable to update idea assignment, one or more keys were wrong.")
+        __assign_idea(idea,user_id)
+
+#########################################################
+# owner funcs
+#########################################################
+
+def get_game_sum(code:str,sessionid:str,sessionpassword:str):
+    """ Gets a summary of at game, can be used to check
+    authentication.
+    """
+    user = __authenticate_user(sessionid,sessionpassword)
+    with __lock:
+        game = __owned_game(code,user['id'])
+        if game is None:
+            return []
+        return [{
+            'state': game['state'],
+            'name': game['name'],
+            'santas': len(__users_by_game.get(game['id'],{})),
+            'ideas': len(__ideas_by_game.get(game['id'],{})),
+        }]
+
+def get_users_in_game(code:str,sessionid:str,sessionpassword:str):
+    """List of users that have joined a game
+    """
+    user = __authenticate_user(sessionid,sessionpassword)
+    if (len(code) == 0):
+        raise SantaErrors.EmptyValue("Group id is empty.")
+    with __lock:
+        game = __owned_game(code,user['id'])
+        if game is None:
+            return []
+        return [__select(__users.rows[x],['id','game','name','draw_group','account_id']) for x in __users_by_game.get(game['id'],{}).values()]
+
+def set_game_state(code:str,sessionid:str,sessionpassword:str,new_state:int):
+    """
+    Updates the stored state value of a game.
+    """
+    user = __authenticate_user(sessionid,sessionpassword)
+    if (len(code) == 0):
+        raise SantaErrors.EmptyValue("Group id is empty.")
+    with __lock:
+        game = __owned_game(code,user['id'])
+        if game is None:
+            raise SantaErrors.NotFound("Group not found.")
+        game['state'] = new_state
+        __touch_game(game)
+        return [{'code':game['code'],'state':game['state']}]
+
+def draw_game(code:str,santa_assignments:list,idea_assignments:list,sessionid:str,sessionpassword:str):
+    """
+    Write all the results of a draw at once, either the whole draw is saved
+    and the game moves to state 1 or nothing is changed.
+    """
+    owner = __authenticate_user(sessionid,sessionpassword)
+    if (len(code) == 0):
+        raise SantaErrors.EmptyValue("Group id is empty.")
+    with __lock:
+        game = __owned_game(code,owner['id'])
+        if game is None or game['state'] != 0:
+            raise SantaErrors.NotFound("Group not found or not open.")
+        # check everything before changing anything.
+        for user_id,_ in santa_assignments:
+            user = __users.rows.get(user_id)
+            if user is None or user['game'] != game['id']:
+                raise SantaErrors.DatabaseChangeError("Santa assignment for unknown user {}.".format(user_id))
+        for idea_id,_ in idea_assignments:
+            idea = __ideas.rows.get(idea_id)
+            if idea is None or idea['game'] != game['id']:
+                raise SantaErrors.DatabaseChangeError("Idea assignment for unknown idea {}.".format(idea_id))
+        for user_id,santa_id in santa_assignments:
+            __users.rows[user_id]['santa'] = santa_id
+        for idea_id,user_id in idea_assignments:
+            __assign_idea(__ideas.rows[idea_id],user_id)
+        game['state'] = 1
+        __touch_game(game)
+        return [{'code':game['code'],'state':game['state']}]
+
+def set_draw_date(code:str,draw_date,sessionid:str,sessionpassword:str):
+    """
+    Set when an open game should be drawn, None to not schedule it.
+    """
+    owner = __authenticate_user(sessionid,sessionpassword)
+    if (len(code) == 0):
+        raise SantaErrors.EmptyValue("Group id is empty.")
+    with __lock:
+        game = __owned_game(code,owner['id'])
+        if game is None or game['state'] != 0:
+            raise SantaErrors.NotFound("Group not found or not open.")
+        game['draw_date'] = draw_date
+        return [{'code':game['code'],'draw_date':game['draw_date']}]
+
+def get_exclusions(code:str,sessionid:str,sessionpassword:str):
+    """
+    Pairs of users in a game that must not be drawn, as userid (santa) and excluded (giftee.)
+    """
+    owner = __authenticate_user(sessionid,sessionpassword)
+    if (len(code) == 0):
+        raise SantaErrors.EmptyValue("Group id is empty.")
+    with __lock:
+        game = __owned_game(code,owner['id'])
+        if game is None:
+            return []
+        return [{'userid':userid,'excluded':excluded} for userid,excluded in __exclusions_by_game.get(game['id'],())]
+
+def set_exclusions(code:str,exclusions:list,groups:dict,sessionid:str,sessionpassword:str):
+    """
+    Replace the exclusions and groups of an open game.
+    """
+    owner = __authenticate_user(sessionid,sessionpassword)
+    if (len(code) == 0):
+        raise SantaErrors.EmptyValue("Group id is empty.")
+    with __lock:
+        game = __owned_game(code,owner['id'])
+        if game is None or game['state'] != 0:
+            raise SantaErrors.NotFound("Group not found or not open.")
+        members = __users_by_game.get(game['id'],{}).values()
+        member_ids = set(members)
+        __exclusions_by_game[game['id']] = {
+            (userid,excluded) for userid,excluded in exclusions
+            if userid in member_ids and excluded in member_ids and userid != excluded
+        }
+        for user_id in members:
+            __users.rows[user_id]['draw_group'] = groups.get(user_id)
+        return {'exclusions':len(__exclusions_by_game[game['id']])}
+
+def get_previous_draw_pairs(previous_code:str,code:str,sessionid:str,sessionpassword:str):
+    """
+    Santa pairs from an earlier drawn game, as userid and excluded in this game.
+    """
+    owner = __authenticate_user(sessionid,sessionpassword)
+    if (len(code) == 0 or len(previous_code) == 0):
+        raise SantaErrors.EmptyValue("Group id is empty.")
+    with __lock:
+        old_game = __owned_game(previous_code,owner['id'])
+        game = __owned_game(code,owner['id'])
+        if old_game is None or game is None or old_game['state'] not in (1,2):
+            return []
+        members = __users_by_game.get(game['id'],{})
+        pairs = []
+        for old_santa_id in __users_by_game.get(old_game['id'],{}).values():
+            old_santa = __users.rows[old_santa_id]
+            old_giftee = __users.rows.get(old_santa['santa'])
+            if old_giftee is None:
+                continue
+            santa = members.get(old_santa['account_id'])
+            giftee = members.get(old_giftee['account_id'])
+            if santa is not None and giftee is not None:
+                pairs.append({'userid':santa,'excluded':giftee})
+        return pairs
+
+###########################################
+# admin funcs
+###########################################
+
+def check_admin_key(admin_key:str):
+    __assert_admin_key(admin_key)
+
+def __all_games(state=None):
+    with __lock:
+        return [__select(game,['id','name','code','state','ownerid']) for game in __games.rows.values() if state is None or game['state'] == state]
+
+def get_all_games(admin_key:str):
+    __assert_admin_key(admin_key)
+    return __all_games()
+
+def get_games_page(admin_key:str,after_id:int=0,limit:int=100,state:int=None,ownerid:int=None):
+    """
+    A page of games in id order, starting after after_id.
+    """
+    __assert_admin_key(admin_key)
+    with __lock:
+        ids = heapq.nsmallest(limit,(game_id for game_id,game in __games.rows.items()
+            if game_id > after_id and (state is None or game['state'] == state) and (ownerid is None or game['ownerid'] == ownerid)))
+        return [__select(__games.rows[game_id],['id','name','code','state','ownerid']) for game_id in ids]
+
+def iter_games(admin_key:str,state:int=None,ownerid:int=None,batch_size:int=1000):
+    """
+    Generator of games in id order, a page at a time.
+    """
+    __assert_admin_key(admin_key)
+    after_id = 0
+    while True:
+        page = get_games_page(admin_key,after_id,batch_size,state,ownerid)
+        for game in page:
+            yield game
+        if len(page) < batch_size:
+            return
+        after_id = page[-1]['id']
+
+def iter_tables(admin_key:str,tables:list,batch_size:int=5000):
+    """
+    Generator of (table, row tuple) for every row of each table, with the columns in dbcommon.export_columns.
+    Rows are copied batch_size at a time, rows changed during the export may or may not be included.
+    """
+    __assert_admin_key(admin_key)
+    sources = {'identities':__identities,'games':__games,'users':__users,'ideas':__ideas}
+    for table in tables:
+        if table not in dbcommon.export_columns:
+            raise SantaErrors.NotFound("Unknown table {}.".format(table))
+    for table in tables:
+        columns = dbcommon.export_columns[table]
+        with __lock:
+            ids = list(sources[table].rows)
+        for start in range(0,len(ids),batch_size):
+            with __lock:
+                batch = [sources[table].rows.get(row_id) for row_id in ids[start:start + batch_size]]
+            for row in batch:
+                if row is not None:
+                    yield table,tuple(row.get(column) for column in columns)
+
+def get_all_open_games(admin_key:str):
+    __assert_admin_key(admin_key)
+    return __all_games(0)
+
+def get_due_games(admin_key:str):
+    __assert_admin_key(admin_key)
+    now = __now()
+    with __lock:
+        due = [game for game in __games.rows.values() if game['state'] == 0 and game['draw_date'] is not None and game['draw_date'] <= now]
+        due.sort(key=lambda game: game['draw_date'])
+        return [__select(game,['id','name','code','state','ownerid','draw_date']) for game in due]
+
+def get_all_complete_games(admin_key:str):
+    __assert_admin_key(admin_key)
+    return __all_games(1)
+
+def get_all_closed_games(admin_key:str):
+    __assert_admin_key(admin_key)
+    return __all_games(2)
+
+def reset_all_tables(admin_key:str):
+    __assert_admin_key(admin_key)
+    __assert_can_do_major_db_changes()
+    with __lock:
+        __games.clear()
+        __users.clear()
+        __ideas.clear()
+        __games_by_code.clear()
+        __users_by_game.clear()
+        __users_by_account.clear()
+        __ideas_by_game.clear()
+        __ideas_by_user.clear()
+        __exclusions_by_game.clear()
+        __draw_notify.clear()
+    return {'resetstatus':'ok'}
+
+__import_int_columns = ['id','game','state','ownerid','santa','account_id','userid','version']
+__import_date_columns = ['register_date','verify_date','draw_date','modified']
+
+def __read_import_rows(columns:list,source):
+    """
+    Rows of an import csv as dicts, empty values are null as with postgres COPY.
+    """
+    rows = []
+    for values in csv.reader(source):
+        row = {}
+        for column,value in zip(columns,values):
+            if value == '':
+                value = None
+            elif column in __import_int_columns:
+                value = int(value)
+            elif column in __import_date_columns:
+                value = datetime.datetime.fromisoformat(value)
+            row[column] = value
+        rows.append(row)
+    return rows
+
+def __import_problems(identities:list,games:list,users:list,ideas:list):
+    """
+    The same checks as the postgres import, as (description, bad ids.)
+    """
+    def duplicates(rows,key):
+        seen = {}
+        bad = []
+        for row in rows:
+            value = key(row)
+            if value in seen:
+                bad.append(seen[value])
+            else:
+                seen[value] = row['id']
+        return sorted(set(bad))
+    identity_ids = {row['id'] for row in identities}
+    game_ids = {row['id'] for row in games}
+    user_games = {row['id']:row['game'] for row in users}
+    return [
+        ('duplicate identity ids', duplicates(identities,lambda row: row['id'])),
+        ('duplicate identity emails', duplicates(identities,lambda row: (row.get('email') or '').lower())),
+        ('duplicate game ids', duplicates(games,lambda row: row['id'])),
+        ('duplicate game codes', duplicates(games,lambda row: row.get('code'))),
+        ('duplicate user ids', duplicates(users,lambda row: row['id'])),
+        ('duplicate idea ids', duplicates(ideas,lambda row: row['id'])),
+        ('games owned by unknown identities', [row['id'] for row in games if row.get('ownerid') is not None and row['ownerid'] not in identity_ids]),
+        ('users in unknown games', [row['id'] for row in users if row.get('game') not in game_ids]),
+        ('users of unknown identities', [row['id'] for row in users if row.get('account_id') is not None and row['account_id'] not in identity_ids]),
+        ('users drawn for someone outside their game', [row['id'] for row in users if row.get('santa') not in (None,-1) and user_games.get(row['santa']) != row.get('game')]),
+        ('ideas in unknown games', [row['id'] for row in ideas if row.get('game') not in game_ids]),
+        ('ideas given to someone outside their game', [row['id'] for row in ideas if row.get('userid') not in (None,-1) and user_games.get(row['userid']) != row.get('game')]),
+        ('ideas from unknown identities', [row['id'] for row in ideas if row.get('account_id') is not None and row['account_id'] not in identity_ids]),
+    ]
+
+def bulk_import(admin_key:str,sources:dict):
+    """
+    Replace the games, identities, users and ideas tables with imported rows, see postgresdb.bulk_import.
+    Empty values are always read as null, there is no difference between quoted and unquoted values here.
+    """
+    __assert_admin_key(admin_key)
+    __assert_can_do_major_db_changes()
+    missing_tables = [table for table in dbcommon.export_columns if table not in sources]
+    if len(missing_tables) > 0:
+        raise SantaErrors.EmptyValue("Import is missing tables {}".format(missing_tables))
+    for table,(columns,_) in sources.items():
+        if table not in dbcommon.export_columns:
+            raise SantaErrors.NotFound("Unknown table {}.".format(table))
+        invalid_columns = [column for column in columns if column not in dbcommon.export_columns[table]]
+        if len(invalid_columns) > 0:
+            raise KeyError("Invalid properties {props} for database query. The valid list of properties are: {valid}".format(props=invalid_columns,valid=dbcommon.export_columns[table]))
+        if 'id' not in columns or len(set(columns)) != len(columns):
+            raise SantaErrors.ImportValidationError("{} columns must include id once, and no column twice.".format(table))
+
+    timings = {}
+    start = time.perf_counter()
+    imported = {table:__read_import_rows(*sources[table]) for table in dbcommon.export_columns}
+    timings['copy'] = time.perf_counter() - start
+
+    check_start = time.perf_counter()
+    problems = ["{} {} (ids {})".format(len(bad),description,bad[:5]) for description,bad in __import_problems(
+        imported['identities'],imported['games'],imported['users'],imported['ideas']) if len(bad) > 0]
+    if len(problems) > 0:
+        raise SantaErrors.ImportValidationError("Import not applied: {}".format(', '.join(problems)))
+    timings['check'] = time.perf_counter() - check_start
+
+    swap_start = time.perf_counter()
+    defaults = {
+        'identities': {'email':None,'name':None,'register_date':None,'verify_date':None},
+        'games': {'name':None,'secret':None,'code':None,'state':None,'ownerid':None,'draw_date':None,'version':0,'modified':datetime.datetime.utcnow()},
+        'users': {'game':None,'name':None,'santa':-1,'account_id':None,'draw_group':None},
+        'ideas': {'game':None,'idea':None,'userid':-1,'account_id':None},
+    }
+    tables = {'identities':__identities,'games':__games,'users':__users,'ideas':__ideas}
+    with __lock:
+        for table,rows in imported.items():
+            tables[table].rows = {row['id']:dict(defaults[table],**row) for row in rows}
+            tables[table]._next_id = max(tables[table].rows,default=0) + 1
+        for index in [__games_by_code,__users_by_game,__users_by_account,__ideas_by_game,__ideas_by_user,__identities_by_email,__exclusions_by_game,__sessions,__draw_jobs,__active_draw_jobs,__draw_notify]:
+            index.clear()
+        __draw_job_order.clear()
+        for identity in __identities.rows.values():
+            if identity['email'] is not None:
+                __identities_by_email[identity['email'].lower()] = identity['id']
+        for game in __games.rows.values():
+            __games_by_code[game['code']] = game['id']
+        for player in __users.rows.values():
+            if player['account_id'] is not None:
+                __users_by_game.setdefault(player['game'],{})[player['account_id']] = player['id']
+                __users_by_account.setdefault(player['account_id'],set()).add(player['id'])
+        for idea in __ideas.rows.values():
+            __ideas_by_game.setdefault(idea['game'],{})[(idea['account_id'],idea['idea'])] = idea['id']
+            __ideas_by_user.setdefault(idea['userid'],set()).add(idea['id'])
+    timings['swap'] = time.perf_counter() - swap_start
+
+    elapsed = time.perf_counter() - start
+    counts = {table:len(rows) for table,rows in imported.items()}
+    rows = sum(counts.values())
+    return {
+        'tables': counts,
+        'rows': rows,
+        'seconds': round(elapsed,3),
+        'rows_per_second': round(rows / elapsed,1) if elapsed > 0 else 0.0,
+        'timings': {name:round(seconds,3) for name,seconds in timings.items()},
+    }
+
+def init_tables(admin_key:str,check_only:bool=False):
+    """Nothing to create in memory, kept for the same interface as postgres.
+    """
+    __assert_admin_key(admin_key)
+    return {'initstatus':'ok','schema_version':None,'latest_version':None,'pending':[],'applied':[]}
+
+###################################
+# Mail outbox funcs
+###################################
+
+__outbox_due = []
+
+def queue_mail(to_email:str,subject:str,html:str):
+    with __lock:
+        row = __outbox.insert({'to_email':to_email,'subject':subject,'html':html,'state':'queued','attempts':0,'last_error':None,'queued_time':time.time()})
+        heapq.heappush(__outbox_due,(time.time(),row['id']))
+        return row['id']
+
+def claim_mail(stale_minutes:int=10):
+    with __lock:
+        if not __outbox_due or __outbox_due[0][0] > time.time():
+            return None
+        _,mail_id = heapq.heappop(__outbox_due)
+        row = __outbox.rows[mail_id]
+        row['state'] = 'sending'
+        row['attempts'] += 1
+        return __select(row,['id','to_email','subject','html','attempts','queued_time'])
+
+def mark_mail_sent(mail_id:int):
+    with __lock:
+        row = __outbox.rows[mail_id]
+        row['state'] = 'sent'
+        row['html'] = None
+
+def mark_mail_failed(mail_id:int,error:str,retry_seconds:float=None):
+    with __lock:
+        row = __outbox.rows[mail_id]
+        row['last_error'] = error
+        if retry_seconds is None:
+            row['state'] = 'dead'
+            row['html'] = None
+        else:
+            row['state'] = 'queued'
+            heapq.heappush(__outbox_due,(time.time() + retry_seconds,mail_id))
+
+def mail_queue_depth():
+    with __lock:
+        return len([row for row in __outbox.rows.values() if row['state'] in ('queued','sending')])
+
+###################################
+# Draw job funcs
+###################################
+
+__draw_jobs = {}
+__draw_job_order = []
+__active_draw_jobs = {}     # game code -> job id
+
+def queue_draw_job(job_id:str,code:str,ownerid:int):
+    with __lock:
+        active = __active_draw_jobs.get(code)
+        if active is not None:
+            return dict(__draw_jobs[active])
+        job = {
+            'id': job_id,
+            'code': code,
+            'ownerid': ownerid,
+            'state': 'queued',
+            'attempts': 0,
+            'error': None,
+            'users': None,
+            'ideas': None,
+            'queued_time': time.time(),
+            'started_time': None,
+            'finished_time': None,
+        }
+        __draw_jobs[job_id] = job
+        __draw_job_order.append(job_id)
+        __active_draw_jobs[code] = job_id
+        return dict(job)
+
+def claim_draw_job(stale_minutes:int=10):
+    with __lock:
+        while __draw_job_order:
+            job = __draw_jobs[__draw_job_order.pop(0)]
+            if job['state'] == 'queued':
+                job['state'] = 'running'
+                job['attempts'] += 1
+                job['started_time'] = time.time()
+                return dict(job)
+        return None
+
+def heartbeat_draw_job(job_id:str,attempt:int):
+    # draws can't outlive this process, so there is nothing to pick up again.
+    pass
+
+def finish_draw_job(job_id:str,state:str,error:str=None,users:int=None,ideas:int=None,attempt:int=None):
+    with __lock:
+        job = __draw_jobs[job_id]
+        if attempt is not None and job['attempts'] != attempt:
+            return
+        job.update({'state':state,'error':error,'users':users,'ideas':ideas,'finished_time':time.time()})
+        if __active_draw_jobs.get(job['code']) == job_id:
+            del __active_draw_jobs[job['code']]
+
+def get_draw_job(job_id:str):
+    with __lock:
+        job = __draw_jobs.get(job_id)
+        return dict(job) if job is not None else None
+
+def draw_job_depth():
+    with __lock:
+        return len(__active_draw_jobs)
+
+###################################
+# Draw notify funcs
+###################################
+
+__draw_notify = {}     # game code -> notify row
+
+def __notify_row(row:dict,stale_minutes:int):
+    row = dict(row)
+    row['stale'] = row['state'] in ('queued','sending') and row['updated_time'] < time.time() - stale_minutes * 60
+    del row['updated_time']
+    return row
+
+def claim_draw_notify(code:str,total:int,stale_minutes:int=10):
+    with __lock:
+        row = __draw_notify.get(code)
+        if row is None:
+            row = __draw_notify[code] = {'code':code,'state':'queued','attempts':1,'total':total,'sent':0,'error':None,'updated_time':time.time()}
+            return __notify_row(row,stale_minutes)
+        if row['state'] == 'failed' or __notify_row(row,stale_minutes)['stale']:
+            row.update({'state':'queued','attempts':row['attempts'] + 1,'total':total,'error':None,'updated_time':time.time()})
+            return __notify_row(row,stale_minutes)
+        return None
+
+def update_draw_notify(code:str,attempt:int,state:str,sent:int,error:str=None):
+    with __lock:
+        row = __draw_notify.get(code)
+        if row is None or row['attempts'] != attempt:
+            return
+        row.update({'state':state,'sent':sent,'error':error,'updated_time':time.time()})
+
+def get_draw_notify(code:str,stale_minutes:int=10):
+    with __lock:
+        row = __draw_notify.get(code)
+        return __notify_row(row,stale_minutes) if row is not None else None
+
+###################################
+# Login funcs
+###################################
+
+def new_session(uuid:str, email:str, verify_code:str):
+    """
+    Create a new session for a user
+    """
+    with __lock:
+        identity_id = __identities_by_email.get(__lowercase_email(email))
+        if identity_id is None:
+            return []
+        identity = __identities.rows[identity_id]
+        session = {
+            'id': uuid,
+            'verify_hash': __hash_secret(verify_code),
+            'secret_hash': None,
+            'identity_id': identity_id,
+            'last_date': __now(),
+        }
+        __sessions[uuid] = session
+        return [{'id':uuid,'last_date':session['last_date'],'email':identity['email'],'name':identity['name']}]
+
+def confirm_session(uuid:str, verify_code:str, new_secret:str):
+    """
+    Check and update the session to verify that the session is
+    good to use.
+    """
+    with __lock:
+        session = __sessions.get(uuid)
+        if session is None or not __check_secret(verify_code,session['verify_hash']):
+            return []
+        session['secret_hash'] = __hash_secret(new_secret)
+        session['verify_hash'] = None
+        session['last_date'] = __now()
+        identity = __identities.rows[session['identity_id']]
+        identity['verify_date'] = __now()
+        return {
+            'id': uuid,
+            'identity_id': identity['id'],
+            'last_date': session['last_date'],
+            'name': identity['name'],
+            'email': identity['email'],
+        }
+
+def remove_session(uuid:str, secret:str):
+    """
+    Log out a session by removing it.
+    """
+    __authenticate_user(uuid,secret)
+    with __lock:
+        session = __sessions.get(uuid)
+        if session is None or not __check_secret(secret,session['secret_hash']):
+            return []
+        del __sessions[uuid]
+    if getattr(__request_state,'active',False):
+        __request_state.identities.pop((uuid,secret),None)
+    return [{'id':uuid}]
+
+def register_user(email:str,name:str):
+    """
+    Create an identity for an email so new session can be created.
+    """
+    with __lock:
+        identity = __identities.insert({'email':__lowercase_email(email),'name':name,'register_date':__now(),'verify_date':None})
+        __identities_by_email.setdefault(identity['email'],identity['id'])
+        return [__select(identity,['id','email','name'])]
+
+def get_registered_user(email:str):
+    """
+    Check the id of a user from an email.
+    """
+    valid_columns = ['id','email','register_date','verify_date']
+    return __get_simple_table(__identities,valid_columns,{'email':email},valid_columns)
+
+def __authenticate_user(sessionid:str,sessionpassword:str):
+    """
+    Check user session is authenticated and get user, once per request.
+    """
+    if isinstance(sessionid,Identity):
+        return sessionid
+
+    in_request = getattr(__request_state,'active',False)
+    if in_request:
+        known_identity = __request_state.identities.get((sessionid,sessionpassword))
+        if known_identity is not None:
+            return known_identity
+        __request_state.auth_count += 1
+
+    start = time.perf_counter()
+    with __lock:
+        session = __sessions.get(sessionid)
+        if session is None or not __check_secret(sessionpassword,session['secret_hash']):
+            raise SantaErrors.SessionError("Session not found or wrong password.")
+        identity = Identity(__select(__identities.rows[session['identity_id']],['id','name','email']),sessionid)
+    if in_request:
+        __request_state.auth_time += time.perf_counter() - start
+        __request_state.identities[(sessionid,sessionpassword)] = identity
+    return identity
+
+def get_authenticated_user(sessionid:str,sessionpassword:str):
+    """
+    get info about session user, as an Identity that can be passed to other functions
+    instead of the session credentials.
+    """
+    return __authenticate_user(sessionid,sessionpassword)
@@ -0,0 +1,344 @@
+"""
+Versioned schema changes for the database.
+
+Each migration is run once, in order, and recorded in the schema_version table.
+A database that is already up to date is confirmed with a single query.
+
+To change the schema add a new function to the end of migration_list, never
+change a migration that has already been released.
+"""
+
+import time
+
+import psycopg2
+import psycopg2.errors
+from psycopg2.extras import RealDictCursor
+
+# any number will do, it just has to be the same for every process.
+__migration_lock_id = 7271225
+
+###############################
+# migrations
+###############################
+
+def __initial_tables(tablename):
+    # initial 1.0 tables
+    return [
+        'CREATE TABLE IF NOT EXISTS {} (id serial,name varchar(200),secret varchar(64),code varchar(8),state int);'.format(tablename('games')),
+        'create unique index if not exists {games}_code on {games} using btree (code);'.format(games=tablename('games')),
+        'CREATE TABLE IF NOT EXISTS {} (id serial,game int,idea varchar(260),userid int DEFAULT -1);'.format(tablename('ideas')),
+        'CREATE TABLE IF NOT EXISTS {} (id serial,game int,name varchar(30),santa int DEFAULT -1);'.format(tablename('users')),
+    ]
+
+def __auth_tables(tablename):
+    # tables for user auth
+    return [
+        'create extension if not exists pgcrypto;',
+        'Create Table If Not Exists {identity} (id serial PRIMARY KEY, email varchar(255), name varchar(30),register_date timestamp Not Null Default NOW(), verify_date timestamp);'.format(identity=tablename('identities')),
+        """
+        Create Table If Not Exists {session} (
+            id uuid,
+            verify_hash text,
+            secret_hash text,
+            identity_id int not null,
+            last_date timestamp Default NOW(),
+            CONSTRAINT fk_identity_id
+                FOREIGN KEY(identity_id)
+                REFERENCES {identity}(id)
+                ON DELETE CASCADE
+        );
+        """.format(session=tablename('sessions'),identity=tablename('identities')),
+        'create unique index if not exists {session}_uuid on {session} using btree (id);'.format(session=tablename('sessions')),
+    ]
+
+def __game_owners(tablename):
+    # upgrade 1.0 tables with user columns
+    return [
+        """
+        ALTER TABLE {games}
+        Add Column If Not Exists ownerid int default null;
+        """.format(games=tablename('games')),
+        """
+        -- no if not exists for constraints
+        DO $$
+        begin
+            if not exists (select constraint_name
+                        from information_schema.constraint_column_usage
+                        where table_name = '{identity}' and constraint_name = '{games}_ownerid' ) then
+                ALTER TABLE {games}
+                ADD CONSTRAINT {games}_ownerid FOREIGN KEY (ownerid) REFERENCES {identity} (id);
+            end if;
+        end $$;
+        """.format(games=tablename('games'),identity=tablename('identities')),
+    ]
+
+def __user_accounts(tablename):
+    return [
+        """
+        ALTER TABLE {users}
+        Add Column If Not Exists account_id int default null;
+        """.format(users=tablename('users')),
+        """
+        -- no if not exists for constraints
+        DO $$
+        begin
+            if not exists (select constraint_name
+                        from information_schema.constraint_column_usage
+                        where table_name = '{identity}' and constraint_name = '{users}_account_id' ) then
+                ALTER TABLE {users}
+                Add Constraint {users}_account_id Foreign Key (account_id) References {identity} (id);
+            end if;
+        end $$;
+        """.format(users=tablename('users'),identity=tablename('identities')),
+        "create unique index if not exists {users}_game_account on {users} using btree (game,account_id);".format(users=tablename('users')),
+    ]
+
+def __idea_submitters(tablename):
+    ## upgrade ideas to include submitter so that duplication can be detected.
+    return [
+        """
+        ALTER TABLE {ideas}
+        Add Column If Not Exists account_id int default null;
+        """.format(ideas=tablename('ideas')),
+        """
+        -- no if not exists for constraints
+        DO $$
+        begin
+            if not exists (select constraint_name
+                        from information_schema.constraint_column_usage
+                        where table_name = '{identity}' and constraint_name = '{ideas}_account_id' ) then
+                ALTER TABLE {ideas}
+                Add Constraint {ideas}_account_id Foreign Key (account_id) References {identity} (id);
+            end if;
+        end $$;
+        """.format(ideas=tablename('ideas'),identity=tablename('identities')),
+        # add index for faster lookups
+        "create unique index if not exists {ideas}_game_account on {ideas} using btree (game,account_id,idea);".format(ideas=tablename('ideas')),
+    ]
+
+def __query_indexes(tablename):
+    # indexes for the lookups made on most requests.
+    return [
+        # list_user_games, get_user_giftee and get_user_ideas find a user's rows by account.
+        "create index if not exists {users}_account_game on {users} using btree (account_id,game);".format(users=tablename('users')),
+        # leftover ideas (userid = -1) and get_game_ideas filter by game, get_user_ideas joins on userid.
+        "create index if not exists {ideas}_game_userid on {ideas} using btree (game,userid);".format(ideas=tablename('ideas')),
+        "create index if not exists {ideas}_userid on {ideas} using btree (userid);".format(ideas=tablename('ideas')),
+        # list_owned_games and all owner checks.
+        "create index if not exists {games}_ownerid on {games} using btree (ownerid,code);".format(games=tablename('games')),
+        # new_session looks up identities with LOWER(email).
+        "create index if not exists {identity}_lower_email on {identity} using btree (lower(email));".format(identity=tablename('identities')),
+        # deleting an identity cascades to its sessions.
+        "create index if not exists {session}_identity on {session} using btree (identity_id);".format(session=tablename('sessions')),
+    ]
+
+def __mail_outbox(tablename):
+    # queued emails for the background senders.
+    return [
+        """
+        Create Table If Not Exists {outbox} (
+            id serial PRIMARY KEY,
+            to_email varchar(255) not null,
+            subject text not null,
+            html text,
+            state varchar(10) not null default 'queued',
+            attempts int not null default 0,
+            last_error text,
+            queued_date timestamp not null default NOW(),
+            next_attempt timestamp not null default NOW(),
+            locked_date timestamp,
+            sent_date timestamp
+        );
+        """.format(outbox=tablename('outbox')),
+        "create index if not exists {outbox}_due on {outbox} using btree (state,next_attempt);".format(outbox=tablename('outbox')),
+    ]
+
+def __draw_exclusions(tablename):
+    # pairs that must not be drawn, and groups that must not draw each other.
+    return [
+        """
+        Create Table If Not Exists {exclusions} (
+            id serial PRIMARY KEY,
+            game int not null,
+            userid int not null,
+            excluded int not null
+        );
+        """.format(exclusions=tablename('exclusions')),
+        "create unique index if not exists {exclusions}_game_pair on {exclusions} using btree (game,userid,excluded);".format(exclusions=tablename('exclusions')),
+        """
+        ALTER TABLE {users}
+        Add Column If Not Exists draw_group varchar(30) default null;
+        """.format(users=tablename('users')),
+    ]
+
+def __draw_schedule(tablename):
+    # time an open game should be drawn, for the admin bulk draw.
+    return [
+        """
+        ALTER TABLE {games}
+        Add Column If Not Exists draw_date timestamp default null;
+        """.format(games=tablename('games')),
+        "create index if not exists {games}_open_draw_date on {games} using btree (draw_date) where state = 0;".format(games=tablename('games')),
+    ]
+
+def __draw_jobs(tablename):
+    # queued draws for the background draw workers.
+    return [
+        """
+        Create Table If Not Exists {jobs} (
+            id varchar(36) PRIMARY KEY,
+            code varchar(8) not null,
+            ownerid int not null,
+            state varchar(10) not null default 'queued',
+            attempts int not null default 0,
+            error text,
+            users int,
+            ideas int,
+            queued_date timestamp not null default NOW(),
+            started_date timestamp,
+            finished_date timestamp
+        );
+        """.format(jobs=tablename('draw_jobs')),
+        # one waiting or running draw per game.
+        "create unique index if not exists {jobs}_active_code on {jobs} using btree (code) where state in ('queued','running');".format(jobs=tablename('draw_jobs')),
+        "create index if not exists {jobs}_due on {jobs} using btree (state,queued_date);".format(jobs=tablename('draw_jobs')),
+    ]
+
+def __game_versions(tablename):
+    # changed with the game state, players and ideas, for conditional gets of /game and /idea.
+    return [
+        """
+        ALTER TABLE {games}
+        Add Column If Not Exists version int not null default 0,
+        Add Column If Not Exists modified timestamp not null default (NOW() AT TIME ZONE 'utc');
+        """.format(games=tablename('games')),
+    ]
+
+def __game_list_indexes(tablename):
+    # keyset pages of the games list by id, on their own or by state or owner.
+    return [
+        "create unique index if not exists {games}_id on {games} using btree (id);".format(games=tablename('games')),
+        "create index if not exists {games}_state_id on {games} using btree (state,id);".format(games=tablename('games')),
+        "create index if not exists {games}_ownerid_id on {games} using btree (ownerid,id);".format(games=tablename('games')),
+    ]
+
+def __draw_job_heartbeat(tablename):
+    # running draws refresh this, so only draws whose worker has stopped are picked up again.
+    return [
+        "ALTER TABLE {jobs} Add Column If Not Exists heartbeat_date timestamp;".format(jobs=tablename('draw_jobs')),
+    ]
+
+def __draw_notify(tablename):
+    # progress of the draw result emails of each game, so any process can report or resume them.
+    return [
+        """
+        Create Table If Not Exists {notify} (
+            code varchar(8) PRIMARY KEY,
+            state varchar(10) not null default 'queued',
+            attempts int not null default 1,
+            total int not null default 0,
+            sent int not null default 0,
+            error text,
+            started_date timestamp not null default NOW(),
+            updated_date timestamp not null default NOW()
+        );
+        """.format(notify=tablename('draw_notify')),
+    ]
+
+# (version, name, function returning the sql statements), in the order they are applied.
+# the first migrations match the old init_tables so existing databases are upgraded in place.
+migration_list = [
+    (1, 'initial tables', __initial_tables),
+    (2, 'auth tables', __auth_tables),
+    (3, 'game owners', __game_owners),
+    (4, 'user accounts', __user_accounts),
+    (5, 'idea submitters', __idea_submitters),
+    (6, 'query indexes', __query_indexes),
+    (7, 'mail outbox', __mail_outbox),
+    (8, 'draw exclusions', __draw_exclusions),
+    (9, 'draw schedule', __draw_schedule),
+    (10, 'draw jobs', __draw_jobs),
+    (11, 'game versions', __game_versions),
+    (12, 'game list indexes', __game_list_indexes),
+    (13, 'draw job heartbeat', __draw_job_heartbeat),
+    (14, 'draw notify', __draw_notify),
+]
+
+###############################
+# runner
+###############################
+
+def latest_version():
+    return migration_list[-1][0]
+
+def __version_table_sql(tablename):
+    return """
+    CREATE TABLE IF NOT EXISTS {version} (
+        version int PRIMARY KEY,
+        name text NOT NULL,
+        applied_date timestamp NOT NULL DEFAULT NOW(),
+        duration_ms real
+    );
+    """.format(version=tablename('schema_version'))
+
+def current_version(connection,tablename):
+    """
+    Get the version of the database schema, 0 for a database without a version table.
+
+    :param connection: Function returning a transaction context manager for a connection.
+    :param tablename: Function converting short table names to real names.
+    """
+    try:
+        with connection() as conn, conn.cursor() as cursor:
+            cursor.execute("SELECT COALESCE(MAX(version),0) FROM {version};".format(version=tablename('schema_version')))
+            return cursor.fetchone()[0]
+    except psycopg2.errors.UndefinedTable:
+        return 0
+
+def migrate(connection,tablename,check_only:bool=False):
+    """
+    Bring the database schema up to date.
+    Each migration runs in its own transaction along with recording its version, so
+    a failed migration can be fixed and the run started again.
+
+    :param connection: Function returning a transaction context manager for a connection.
+    :param tablename: Function converting short table names to real names.
+    :param check_only: Only report what would be run, no changes are made.
+    """
+    start_version = current_version(connection,tablename)
+    pending = [m for m in migration_list if m[0] > start_version]
+    result = {
+        'schema_version': start_version,
+        'latest_version': latest_version(),
+        'pending': [{'version':m[0],'name':m[1]} for m in pending],
+        'applied': [],
+    }
+    if check_only or len(pending) == 0:
+        return result
+
+    with connection() as conn, conn.cursor() as cursor:
+        cursor.execute(__version_table_sql(tablename))
+
+    for version,name,statements in pending:
+        step_start = time.perf_counter()
+        with connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            # stop two processes running the same migration.
+            cursor.execute("SELECT pg_advisory_xact_lock(%(lock)s);",{'lock':__migration_lock_id})
+            cursor.execute("SELECT 1 FROM {version} WHERE version = %(version)s;".format(version=tablename('schema_version')),{'version':version})
+            if cursor.rowcount > 0:
+                # someone else got here first.
+                continue
+            for statement in statements(tablename):
+                cursor.execute(statement,{})
+            duration_ms = (time.perf_counter() - step_start) * 1000
+            cursor.execute("INSERT INTO {version} (version,name,duration_ms) VALUES (%(version)s,%(name)s,%(duration)s);".format(version=tablename('schema_version')),{
+                'version':version,
+                'name':name,
+                'duration':duration_ms,
+            })
+        print("Migration: {version} {name} applied in {duration:.1f}ms".format(version=version,name=name,duration=duration_ms))
+        result['applied'].append({'version':version,'name':name,'duration_ms':duration_ms})
+
+    result['schema_version'] = current_version(connection,tablename)
+    result['pending'] = [{'version':m[0],'name':m[1]} for m in migration_list if m[0] > result['schema_version']]
+    return result
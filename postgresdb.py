@@ -0,0 +1,1639 @@
+# Interface for SQL calls,
+
+""" Postgres backend for the database module, allows calling db as code instead of having
+other code mess with sql.
+"""
+
+# SQL note:
+#
+# I'm using 2 "formats" for sql queries.  one is used by the sql connector so i used the other type
+# to fill in table names. tables names use a fromat like: {basename} and values %(valuename)s
+# sql queries should be .format ed when created so that they choose dev/prod as needed.
+
+import os
+import json
+import random
+from re import S
+import threading
+import time
+from contextlib import contextmanager
+# database
+import urllib.parse
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+import SantaErrors
+import dbcommon
+from dbcommon import Identity
+import dbpool
+import authcache
+import gamecache
+import migrations
+
+# db setup
+
+
+urllib.parse.uses_netloc.append('postgres')
+__dbPool = None
+# heroku puts db info in this env
+if "DATABASE_URL" in os.environ:
+    __dburl = urllib.parse.urlparse(os.environ['DATABASE_URL'])
+    def __connect():
+        return psycopg2.connect( database=__dburl.path[1:], user=__dburl.username, password=__dburl.password, host=__dburl.hostname, port=__dburl.port)
+    __dbPool = dbpool.ConnectionPool(
+        __connect,
+        minconn=int(os.environ.get('DB_POOL_MIN',1)),
+        maxconn=int(os.environ.get('DB_POOL_MAX',10)),
+        idle_timeout=float(os.environ.get('DB_POOL_IDLE_TIMEOUT',300)),
+        checkout_timeout=float(os.environ.get('DB_POOL_TIMEOUT',30)),
+    )
+else:
+    print("DATABASE_URL not set any database connections will fail!")
+
+# connection held by the current request, if any.
+__request_state = threading.local()
+
+# named query stats and slow query logging.
+__query_stats = {}
+__query_stats_lock = threading.Lock()
+__slow_query_seconds = float(os.environ.get('SLOW_QUERY_MS',500)) / 1000
+__slow_query_explain_sample = float(os.environ.get('SLOW_QUERY_EXPLAIN_SAMPLE',0))
+__unexplained_queries = {'authenticate_user','new_session','confirm_session.verify','remove_session'}
+
+# sessions that recently passed the bcrypt check.
+__session_cache = authcache.SessionCache(
+    ttl=float(os.environ.get('AUTH_CACHE_TTL',60)),
+    max_size=int(os.environ.get('AUTH_CACHE_SIZE',1024)),
+)
+
+# games by code, dropped when this process changes them, and with GAME_CACHE_NOTIFY when other processes do.
+# notify is on by default with database draw jobs, as the draws are saved by the worker process.
+__game_cache = gamecache.GameCache(
+    ttl=float(os.environ.get('GAME_CACHE_TTL',30)),
+    max_size=int(os.environ.get('GAME_CACHE_SIZE',4096)),
+)
+__game_cache_columns = ['id','name','code','state','ownerid','version','modified']
+__game_cache_notify = os.environ.get('GAME_CACHE_NOTIFY','1' if os.environ.get('DRAW_JOBS','database').lower() == 'database' else '0') == '1'
+__game_change_listener = None
+
+
+# state setup
+
+if os.environ.get('IS_PROD',0) == '1':
+    __table_prefix = "prod"
+else:
+    __table_prefix = "dev"
+__realm_name = "santa"
+
+###############################
+# connection handling
+###############################
+
+def begin_request():
+    """Start a request scope, the first database call in the scope checks out a
+    connection which is then used until end_request.
+    """
+    __request_state.active = True
+    __request_state.conn = None
+    __request_state.identities = {}
+    __request_state.auth_count = 0
+    __request_state.db_time = 0.0
+    __request_state.auth_time = 0.0
+    __request_state.query_count = 0
+
+def end_request():
+    """Return the request's connection to the pool.
+    """
+    conn = getattr(__request_state,'conn',None)
+    __request_state.active = False
+    __request_state.conn = None
+    __request_state.identities = {}
+    if conn is not None:
+        __get_pool().putconn(conn)
+
+def request_auth_count():
+    """Number of times a session was checked in the current request, should be at most 1.
+    """
+    return getattr(__request_state,'auth_count',0)
+
+def request_timings():
+    """Time spent in the database and checking sessions during the current request, in seconds.
+    auth_time is included in db_time when the check needed the database.
+    """
+    return {
+        'db_time': getattr(__request_state,'db_time',0.0),
+        'auth_time': getattr(__request_state,'auth_time',0.0),
+        'auth_count': getattr(__request_state,'auth_count',0),
+        'queries': getattr(__request_state,'query_count',0),
+    }
+
+def __add_request_time(timer:str,seconds:float):
+    if getattr(__request_state,'active',False):
+        setattr(__request_state,timer,getattr(__request_state,timer,0.0) + seconds)
+
+def session_cache():
+    """The verified session cache, shared with asyncdb so a logout clears both.
+    """
+    return __session_cache
+
+def game_cache_stats():
+    """Hit, miss and eviction counts for the game cache.
+    """
+    stats = __game_cache.stats()
+    if __game_change_listener is not None:
+        stats['notifications'] = __game_change_listener.notifications
+        stats['listener_reconnects'] = __game_change_listener.reconnects
+    return stats
+
+def session_cache_stats():
+    """Hit, miss and eviction counts for the verified session cache.
+    """
+    return __session_cache.stats()
+
+def pool_stats():
+    """Usage of the connection pool, checked out connections and wait times.
+    """
+    if __dbPool is None:
+        return {}
+    return __dbPool.stats()
+
+###############################
+# internal funcs
+###############################
+
+def true_tablename(tablename):
+    """Convert a basic table name to one with realm and env names
+
+    :param tablename: Short name to convert to actual name
+    """
+    return "{}_{}_{}".format(__table_prefix,__realm_name,tablename)
+
+def __stringlist_to_sql_columns(columns:list) -> str:
+    """Convert a list of strings to column definitions in sql
+    """
+    return ','.join(columns)
+
+def __assert_dict_columns(query:dict,valid_list:list):
+    """Tests for invalid columns in a dict use for requests.
+    """
+    invalid_properties = [x for x in query.keys() if x not in valid_list]
+    if (invalid_properties):
+        raise KeyError("Invalid query property {props} for database query. The valid list of columns are: {valid}".format(props=invalid_properties,valid=valid_list))
+    return 0
+
+def __assert_columns(wanted:list,valid_list:list):
+    """Tests for invalid column names in a list.
+    """
+    invalid_properties = [x for x in wanted if x not in valid_list]
+    if (invalid_properties):
+        raise KeyError("Invalid properties {props} for database query. The valid list of properties are: {valid}".format(props=invalid_properties,valid=valid_list))
+    return 0
+
+__assert_admin_key = dbcommon.assert_admin_key
+__assert_can_do_major_db_changes = dbcommon.assert_can_do_major_db_changes
+
+def __get_pool():
+    if __dbPool is None:
+        raise SantaErrors.ConfigurationError("DATABASE_URL not set, no database connection available.")
+    return __dbPool
+
+@contextmanager
+def __connection():
+    """Get a connection as a transaction block, commits on success and rolls back on errors.
+    Inside a request the request's connection is used, otherwise one is borrowed from the pool for the call.
+    """
+    if getattr(__request_state,'active',False):
+        start = time.perf_counter()
+        if getattr(__request_state,'conn',None) is None:
+            __request_state.conn = __get_pool().getconn()
+        conn = __request_state.conn
+        try:
+            with conn:
+                yield conn
+        except psycopg2.OperationalError:
+            # connection is likely gone, replace it on the next call.
+            __request_state.conn = None
+            __get_pool().mark_reconnect()
+            __get_pool().putconn(conn,close=True)
+            raise
+        finally:
+            __add_request_time('db_time',time.perf_counter() - start)
+        return
+
+    pool = __get_pool()
+    conn = pool.getconn()
+    broken = False
+    try:
+        with conn:
+            yield conn
+    except psycopg2.OperationalError:
+        broken = True
+        pool.mark_reconnect()
+        raise
+    finally:
+        pool.putconn(conn,close=broken)
+
+def __execute(cursor,query_name:str,query:str,params:dict):
+    """Run a query on a cursor, recording its time and row counts under query_name.
+    Queries slower than the slow query threshold are logged, with their plan for a sample of them.
+    """
+    start = time.perf_counter()
+    cursor.execute(query,params)
+    duration = time.perf_counter() - start
+
+    # rowcount is the rows returned for selects, or rows changed for updates.
+    returned_rows = cursor.rowcount if cursor.description is not None else 0
+    record_query(query_name,duration,returned_rows,cursor.rowcount)
+    if getattr(__request_state,'active',False):
+        __request_state.query_count = getattr(__request_state,'query_count',0) + 1
+
+    if duration >= __slow_query_seconds:
+        __log_slow_query(cursor,query_name,query,params,duration)
+
+def record_query(query_name:str,duration:float,returned_rows:int,rowcount:int):
+    """Add a query run to the named query stats, also used by the async queries in asyncdb.
+    """
+    with __query_stats_lock:
+        stats = __query_stats.get(query_name)
+        if stats is None:
+            stats = __query_stats[query_name] = {'calls':0,'time_total':0.0,'time_max':0.0,'rows':0,'rowcount':0,'slow':0}
+        stats['calls'] += 1
+        stats['time_total'] += duration
+        stats['time_max'] = max(stats['time_max'],duration)
+        stats['rows'] += max(returned_rows,0)
+        stats['rowcount'] += max(rowcount,0)
+        if duration >= __slow_query_seconds:
+            stats['slow'] += 1
+
+def __log_slow_query(cursor,query_name:str,query:str,params:dict,duration:float):
+    slow_record = {
+        'slow_query': query_name,
+        'duration_ms': round(duration * 1000,3),
+        'rowcount': cursor.rowcount,
+    }
+    # queries with secrets in their parameters are never explained, the plan can include the values.
+    if query_name not in __unexplained_queries and random.random() < __slow_query_explain_sample:
+        try:
+            with cursor.connection.cursor() as explain_cursor:
+                explain_cursor.execute("EXPLAIN (FORMAT JSON) " + query,params)
+                slow_record['plan'] = explain_cursor.fetchone()[0]
+        except psycopg2.Error as e:
+            slow_record['plan_error'] = str(e).strip()
+    print(json.dumps(slow_record,default=str))
+
+def query_stats():
+    """Call counts, times and row counts for each named query since the process started.
+    """
+    with __query_stats_lock:
+        return {name:dict(stats) for name,stats in __query_stats.items()}
+
+def __get_new_cursor(conn):
+    """Gets a new cursor, needed for atomic operations that use multiple sql commands
+    """
+    return conn.cursor(cursor_factory=RealDictCursor)
+
+def __get_simple_table(table_name:str,columns_to_get:list,column_query:dict,valid_columns:list):
+    """Does a simple lookup against a single table.
+    This is for basic 'Select column From table Where column = value;' queries.
+    It creates a parameterized query to prevent injection attacks.
+    """
+    # prevent a get all of table without a query
+    if (len(column_query) == 0):
+        raise KeyError("Simple database lookup requires at least one column lookup.")
+
+    # whitelist column names to prevent injection attack.
+    __assert_columns(columns_to_get,valid_columns)
+    __assert_dict_columns(column_query,valid_columns)
+
+    query_keys = ' AND '.join( [ " {key} = %({key})s ".format(key=k) for k in column_query.keys() ] )
+    user_query = "SELECT {props} FROM {table} WHERE {query_string};".format(table=true_tablename(table_name),props=__stringlist_to_sql_columns(columns_to_get),query_string=query_keys)
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as __dbCursor:
+        __execute(__dbCursor,'get_{}'.format(table_name),user_query,column_query)
+        return __dbCursor.fetchall()
+
+def __lowercase_email(email:str):
+    return email.lower()
+
+#######################
+# external funcs
+#######################
+
+#######################
+# *User*
+#######################
+
+def get_users(query:dict, properties:list = ['id','name','game'] ):
+    """ Gets a user from a game by id,game etc.
+    """
+    # valid properties
+    valid_properties = ['id','name','game','santa']
+    return __get_simple_table('users',properties,query,valid_properties)
+
+def get_user_giftee(user_id:int,game_code:str):
+    """ Gets the assigned recipient of a select user
+    """
+
+    if len(game_code) == 0:
+        raise ValueError("Game code is empty.")
+
+    get_santainfo_query = """
+    SELECT santa.name as name,giftees.name as giftee
+    FROM {users} as santa
+        INNER JOIN {users} as giftees ON santa.santa = giftees.id
+        INNER JOIN {games} as game On santa.game = game.id
+    WHERE santa.account_id = %(userid)s AND game.code = %(gameid)s;
+    """.format(users=true_tablename('users'),games=true_tablename('games'))
+
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as __dbCursor:
+        __execute(__dbCursor,'get_user_giftee',get_santainfo_query,{'userid': user_id, 'gameid':game_code })
+        return __dbCursor.fetchall()
+
+def get_user_ideas(user_id:int,game_code:str):
+    """ Gets the ideas assigned to a user
+    """
+
+    if len(game_code) == 0:
+        raise ValueError("Game code is empty.")
+    
+    get_idea_query = """
+    SELECT idea FROM {ideas} 
+        INNER JOIN {users} ON {ideas}.userid = {users}.id
+        INNER JOIN {games} ON {users}.game = {games}.id
+    WHERE {users}.account_id = %(userid)s AND {games}.code = %(gameid)s;
+    """.format(users=true_tablename('users'),ideas=true_tablename('ideas'),games=true_tablename('games'))
+
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as __dbCursor:
+        __execute(__dbCursor,'get_user_ideas',get_idea_query,{'userid': user_id, 'gameid': game_code })
+        return __dbCursor.fetchall()
+
+def get_draw_results(code:str,sessionid:str,sessionpassword:str):
+    """ Gets the giftee and ideas of every user in a drawn game, with their email address
+    for sending the results. Owner only.
+    """
+
+    ## get logged on user details
+    owner = __authenticate_user(sessionid,sessionpassword)
+
+    if len(code) == 0:
+        raise SantaErrors.EmptyValue("Group id is empty.")
+
+    get_results_query = """
+    SELECT {identity}.email,santa.name AS name,giftees.name AS giftee,game.name AS gamename,
+        ARRAY(
+            SELECT {ideas}.idea FROM {ideas} WHERE {ideas}.userid = santa.id ORDER BY {ideas}.id
+        ) AS ideas
+    FROM {users} AS santa
+        INNER JOIN {users} AS giftees ON santa.santa = giftees.id
+        INNER JOIN {games} AS game ON santa.game = game.id
+        INNER JOIN {identity} ON {identity}.id = santa.account_id
+    WHERE game.code = %(code)s AND game.ownerid = %(ownerid)s AND game.state = 1
+    ORDER BY santa.id;
+    """.format(users=true_tablename('users'),games=true_tablename('games'),ideas=true_tablename('ideas'),identity=true_tablename('identities'))
+
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as __dbCursor:
+        __execute(__dbCursor,'get_draw_results',get_results_query,{'code':code,'ownerid':owner['id']})
+        return __dbCursor.fetchall()
+
+def set_user_santa(user_id:str,santa_id:str,game_code:str,sessionid:str,sessionpassword:str):
+    """
+    Sets the santa of a user.
+    """
+    
+    ## get logged on user details
+    owner = __authenticate_user(sessionid,sessionpassword)
+
+    if (len(game_code) == 0):
+        raise ValueError("Gameid is empty.")
+    
+    update_query = """
+    WITH gameinfo AS (
+        -- Get game by code and secret
+        SELECT {games}.id as gameid
+        FROM {games} 
+        WHERE {games}.code = %(code)s AND {games}.ownerid = %(ownerid)s
+    )
+    UPDATE {users} 
+    SET santa = %(santaid)s 
+    FROM gameinfo
+    WHERE {users}.id = %(userid)s
+    AND {users}.game = gameinfo.gameid;
+    """.format(users=true_tablename('users'),games=true_tablename('games'))
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        __execute(cursor,'set_user_santa',update_query,{
+            'code':game_code,
+            'ownerid':owner['id'],
+            'userid':user_id,
+            'santaid':santa_id,
+        })
+        if cursor.rowcount == 0:
+            raise FileNotFoundError("Unable to update user, one or more keys were wrong.")
+        elif not cursor.rowcount == 1:
+            conn.rollback()
+            raise RuntimeError("Database attempted to make multiple changes to single item action.")
+        else:
+            # exactly one
+            conn.commit()
+            return
+
+#######################
+# *Game*
+#######################
+
+
+def get_game(query:dict, properties:list = ['id','name','code','state'], cached:bool = True):
+    """ Gets a game from id/code etc.
+    Lookups by code, or code and owner, are served from the game cache unless cached is False,
+    use that where a state changed by another process must be seen straight away.
+    """
+    # valid properties
+    valid_properties = ['id','name','code','state','ownerid','version','modified']
+    if cached and 'code' in query and set(query) <= {'code','ownerid'} and __game_cache.enabled:
+        __assert_columns(properties,valid_properties)
+        game = __game_cache.get(query['code'],__load_game)
+        if game is None or any(game[key] != value for key,value in query.items()):
+            return []
+        return [{key:game[key] for key in properties}]
+    return __get_simple_table('games',properties,query,valid_properties)
+
+def __load_game(code:str):
+    games = __get_simple_table('games',__game_cache_columns,{'code':code},__game_cache_columns)
+    return games[0] if len(games) > 0 else None
+
+def __notify_game_change(cursor,code:str):
+    """Tell other processes a game has changed, sent when the transaction commits.
+    The local cache entry must be dropped after the commit with __game_cache.invalidate.
+    """
+    if __game_cache_notify:
+        __execute(cursor,'notify_game_change',"SELECT pg_notify(%(channel)s,%(code)s);",{'channel':__game_change_channel(),'code':code})
+
+def __game_change_channel():
+    return true_tablename('game_changes')
+
+def start_game_change_listener():
+    """Listen for games changed by other processes, when GAME_CACHE_NOTIFY is set.
+    Uses its own connection outside of the pool.
+    """
+    global __game_change_listener
+    if not __game_cache_notify or not __game_cache.enabled or __game_change_listener is not None or __dbPool is None:
+        return
+    __game_change_listener = gamecache.GameChangeListener(__connect,__game_change_channel(),__game_cache)
+    __game_change_listener.start()
+
+def get_game_ideas(pubkey:str,sessionid:str,sessionpassword:str):
+    """
+    Gets ideas from a game code.
+    """
+
+    ## get logged on user details
+    user = __authenticate_user(sessionid,sessionpassword)
+
+    if (len(pubkey) == 0):
+        raise ValueError("Gameid is empty.")
+
+    get_idea_query = """
+    SELECT {ideas}.id,idea,game,{ideas}.account_id
+    FROM {ideas} 
+        INNER JOIN {games} 
+        ON {games}.id = {ideas}.game
+    WHERE {games}.code = %(code)s
+    AND {games}.ownerid = %(userid)s;
+    """.format(games=true_tablename('games'),ideas=true_tablename('ideas'))
+
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as __dbCursor:
+        __execute(__dbCursor,'get_game_ideas',get_idea_query,{
+            'code': pubkey,
+            'userid': user['id']
+        })
+        return __dbCursor.fetchall()
+
+def new_game(name:str,pubkey:str,sessionid:str,sessionpassword:str):
+    """ Inserts a new game into the database.
+    """
+    user = __authenticate_user(sessionid,sessionpassword)
+
+    query = "INSERT INTO {} (id,name,secret,code,state,ownerid) VALUES(DEFAULT,%(name)s,null,%(pubkey)s,0,%(userid)s) RETURNING id,name,code,state,ownerid ;".format(true_tablename('games'))
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        __execute(cursor,'new_game',query,{'name':name,'userid':user['id'],'pubkey':pubkey})
+        return cursor.fetchall()
+
+def join_game(user_name:str,pubkey:str,sessionid:str,sessionpassword:str):
+    """ Inserts a new name into a game
+    """
+
+    ## get logged on user details
+    user = __authenticate_user(sessionid,sessionpassword)
+
+    register_query = """
+    WITH r As(
+        Insert Into {users}(game,name,account_id)
+        Select {games}.id,%(name)s,%(userid)s
+        From {games}
+        WHERE {games}.code = %(code)s AND state IN (0)
+        On Conflict("game","account_id") Do Nothing
+        Returning {users}.id,{users}.name,{users}.game,{users}.account_id,'New'::text AS Status
+    ), v As(
+        -- a new player changes the game version, for conditional gets.
+        Update {games} Set version = version + 1, modified = NOW() AT TIME ZONE 'utc'
+        Where id In (Select game From r)
+    ), s As(
+        SELECT * From r
+        Union
+            Select {users}.id,{users}.name,{users}.game,{users}.account_id,'Existing'::text As Status
+            From {users}
+            INNER Join {games} On {games}.id = {users}.game
+            Where {games}.code = %(code)s AND state IN (0) And {users}.account_id = %(userid)s
+    )
+    SELECT s.*,{games}.name as gamename From s
+        Inner Join {games}
+        On {games}.id = s.game;
+    """.format(games=true_tablename('games'),users=true_tablename('users'))
+    
+    # we should trim the name at this point
+    clean_name = user_name.strip()
+    if len(clean_name) == 0:
+        clean_name = user['name']
+
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        __execute(cursor,'join_game',register_query,{
+            'name':clean_name,
+            'code':pubkey,
+            'userid':user['id'],
+        })
+        result = cursor.fetchall()
+        changed = any(x['status'] == 'New' for x in result)
+        if changed:
+            __notify_game_change(cursor,pubkey)
+    if changed:
+        __game_cache.invalidate(pubkey)
+    return result
+
+def list_user_games(sessionid:str,sessionpassword:str):
+    """
+    Allows a user to get the list of joined groups
+    """
+
+    ## get logged on user details
+    user = __authenticate_user(sessionid,sessionpassword)
+
+    list_query = """
+    SELECT games.name,games.code,games.state,users.name as joinname
+    FROM {games} as games
+        INNER JOIN {users} as users
+        ON games.id = users.game
+    WHERE users.account_id = %(userid)s AND games.state IN (0,1);
+    """.format(games=true_tablename('games'),users=true_tablename('users'))
+
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as __dbCursor:
+        __execute(__dbCursor,'list_user_games',list_query,{
+            'userid':user['id'],
+        })
+        return __dbCursor.fetchall()
+
+def list_owned_games(sessionid:str,sessionpassword:str):
+    """
+    get a list of groups owned by the user.
+    """
+
+    ## get logged on user details
+    user = __authenticate_user(sessionid,sessionpassword)
+
+    list_query = """
+    SELECT name,code,state 
+    FROM {games} as games
+    Where games.ownerid = %(userid)s;
+    """.format(games=true_tablename('games'))
+
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as __dbCursor:
+        __execute(__dbCursor,'list_owned_games',list_query,{
+            'userid':user['id'],
+        })
+        return __dbCursor.fetchall()
+
+
+#######################
+# *idea*
+#######################
+
+def get_idea(query:dict, properties:list = ['id','game','idea']):
+    """ Gets ideas from game/id
+    """
+    valid_properties = ['id','game','idea','userid']
+    return __get_simple_table('ideas',properties,query,valid_properties)
+
+def new_idea(pubkey:str,idea:str,sessionid:str,sessionpassword:str):
+    """
+    Add a new idea to a game
+    """
+
+    ## get logged on user details
+    user = __authenticate_user(sessionid,sessionpassword)
+
+    unique_idea_query ="""
+    WITH r As(
+        -- insert query
+        Insert Into {ideas}(game,idea,account_id)
+        Select {games}.id,%(idea)s,%(userid)s
+        From {games}
+        WHERE {games}.code = %(code)s AND state IN (0)
+        On Conflict("game","idea","account_id") Do Nothing
+        Returning {ideas}.id,{ideas}.idea,{ideas}.game,{ideas}.account_id,'New'::text AS Status
+    ), v As(
+        -- a new idea changes the game version, for conditional gets.
+        Update {games} Set version = version + 1, modified = NOW() AT TIME ZONE 'utc'
+        Where id In (Select game From r)
+    ), s As(
+        -- union here will get existing records, if the row existed then r is empty and we fill with exiting data.
+        SELECT * From r
+        Union
+            Select {ideas}.id,{ideas}.idea,{ideas}.game,{ideas}.account_id,'Existing'::text As Status
+            From {ideas}
+            INNER Join {games} On {games}.id = {ideas}.game
+            Where {games}.code = %(code)s AND state IN (0) And {ideas}.account_id = %(userid)s And {ideas}.idea = %(idea)s
+    )
+    -- join whatever result we just got with the games take to return the name, not the game internal id.
+    SELECT s.*,{games}.name as gamename From s
+        Inner Join {games}
+        On {games}.id = s.game;
+    """.format(ideas=true_tablename('ideas'),games=true_tablename('games'))
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        __execute(cursor,'new_idea',unique_idea_query,{
+            'idea':idea,
+            'code':pubkey,
+            'userid':user['id'],
+        })
+        result = cursor.fetchall()
+        if len(result) == 0:
+            raise SantaErrors.NotFound("Group not found.")
+        changed = any(x['status'] == 'New' for x in result)
+        if changed:
+            __notify_game_change(cursor,pubkey)
+    if changed:
+        __game_cache.invalidate(pubkey)
+    return result
+
+def set_idea_user(idea_id:str,user_id:str,game_code:str,sessionid:str,sessionpassword:str):
+    """
+    Sets the idea of a user.
+    """
+
+    ## get logged on user details
+    owner = __authenticate_user(sessionid,sessionpassword)
+
+    if (len(game_code) == 0):
+        raise SantaErrors.EmptyValue("Group id is empty.")
+
+    update_query = """
+    WITH gameinfo AS (
+        -- Get game by code and secret
+        SELECT {games}.id as gameid
+        FROM {games} 
+        WHERE {games}.code = %(code)s AND {games}.ownerid = %(ownerid)s
+    )
+    UPDATE {ideas} 
+    SET userid = %(userid)s 
+    FROM gameinfo
+    WHERE {ideas}.id = %(ideaid)s
+    AND {ideas}.game = gameinfo.gameid;
+    """.format(ideas=true_tablename('ideas'),games=true_tablename('games'))
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        __execute(cursor,'set_idea_user',update_query,{
+            'code':game_code,
+            'ownerid':owner['id'],
+            'userid':user_id,
+            'ideaid':idea_id,
+        })
+        if cursor.rowcount == 0:
+            raise SantaErrors.DatabaseChangeError("Unable to update idea assignment, one or more keys were wrong.")
+        elif not cursor.rowcount == 1:
+            conn.rollback()
+            raise SantaErrors.DatabaseChangeError("Database attempted to make multiple changes to single item action.")
+        else:
+            # exactly one
+            conn.commit()
+            return
+
+#########################################################
+# owner funcs
+# all funcs should check the game secret is correct.
+#########################################################
+
+def get_game_sum(code:str,sessionid:str,sessionpassword:str):
+    """ Gets a summary of at game, can be used to check
+    authentication.
+    """
+
+    ## get logged on user details
+    user = __authenticate_user(sessionid,sessionpassword)
+
+    get_summary_query = """
+    SELECT {games}.state,{games}.name,
+    (
+        SELECT COUNT({users}.game) From {users} WHERE {users}.game = {games}.id
+    ) As santas,
+    (
+        SELECT COUNT({ideas}.game) From {ideas} WHERE {ideas}.game = {games}.id
+    ) AS ideas
+    FROM {games}
+    WHERE {games}.ownerid = %(userid)s AND {games}.code = %(code)s;
+    """.format(games=true_tablename('games'),users=true_tablename('users'),ideas=true_tablename('ideas'))
+
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as __dbCursor:
+        __execute(__dbCursor,'get_game_sum',get_summary_query,{
+            'code':code,
+            'userid':user['id'],
+        })
+        return __dbCursor.fetchall()
+
+def get_users_in_game(code:str,sessionid:str,sessionpassword:str):
+    """List of users that have joined a game
+    """
+
+    ## get logged on user details
+    user = __authenticate_user(sessionid,sessionpassword)
+
+    if (len(code) == 0):
+        raise SantaErrors.EmptyValue("Group id is empty.")
+
+    get_userlist_query = """
+    SELECT {users}.id,game,{users}.name,{users}.draw_group,{users}.account_id FROM {users} INNER JOIN {games} ON {games}.id = {users}.game WHERE {games}.code = %(code)s AND {games}.ownerid = %(userid)s;
+    """.format(users=true_tablename('users'),games=true_tablename('games'))
+
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as __dbCursor:
+        __execute(__dbCursor,'get_users_in_game',get_userlist_query,{'code':code,'userid':user['id']})
+        return __dbCursor.fetchall()
+
+def set_game_state(code:str,sessionid:str,sessionpassword:str,new_state:int):
+    """
+    Updates the stored state value of a game.
+    """
+
+    ## get logged on user details
+    user = __authenticate_user(sessionid,sessionpassword)
+
+    if (len(code) == 0):
+        raise SantaErrors.EmptyValue("Group id is empty.")
+    
+    query = """
+    UPDATE {games} SET state = %(state)s, version = version + 1, modified = NOW() AT TIME ZONE 'utc'
+    WHERE ownerid = %(ownerid)s AND code = %(code)s
+    RETURNING {games}.code,{games}.state;
+    """.format(games=true_tablename('games'))
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        __execute(cursor,'set_game_state',query,{
+            'state': new_state,
+            'code': code,
+            'ownerid': user['id'],
+        })
+        result = cursor.fetchall()
+        if len(result) == 0:
+            raise SantaErrors.NotFound("Group not found.")
+        __notify_game_change(cursor,code)
+    __game_cache.invalidate(code)
+    return result
+
+def draw_game(code:str,santa_assignments:list,idea_assignments:list,sessionid:str,sessionpassword:str):
+    """
+    Write all the results of a draw in one transaction, either the whole draw is saved
+    and the game moves to state 1 or nothing is changed.
+
+    :param santa_assignments: list of (userid,santaid) tuples.
+    :param idea_assignments: list of (ideaid,userid) tuples.
+    """
+
+    ## get logged on user details
+    owner = __authenticate_user(sessionid,sessionpassword)
+
+    if (len(code) == 0):
+        raise SantaErrors.EmptyValue("Group id is empty.")
+
+    # lock the game row so two draws of the same game can't run at once.
+    lock_game_query = """
+    SELECT id FROM {games}
+    WHERE code = %(code)s AND ownerid = %(ownerid)s AND state = 0
+    FOR UPDATE;
+    """.format(games=true_tablename('games'))
+
+    # arrays are used so the number of round trips is the same for any size of game.
+    santa_query = """
+    UPDATE {users}
+    SET santa = draw.santa
+    FROM unnest(%(userids)s::int[],%(santaids)s::int[]) AS draw(userid,santa)
+    WHERE {users}.id = draw.userid
+    AND {users}.game = %(gameid)s;
+    """.format(users=true_tablename('users'))
+
+    idea_query = """
+    UPDATE {ideas}
+    SET userid = draw.userid
+    FROM unnest(%(ideaids)s::int[],%(userids)s::int[]) AS draw(ideaid,userid)
+    WHERE {ideas}.id = draw.ideaid
+    AND {ideas}.game = %(gameid)s;
+    """.format(ideas=true_tablename('ideas'))
+
+    state_query = """
+    UPDATE {games} SET state = 1, version = version + 1, modified = NOW() AT TIME ZONE 'utc'
+    WHERE id = %(gameid)s
+    RETURNING {games}.code,{games}.state;
+    """.format(games=true_tablename('games'))
+
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        __execute(cursor,'draw_game.lock_game',lock_game_query,{'code':code,'ownerid':owner['id']})
+        game = cursor.fetchone()
+        if game is None:
+            raise SantaErrors.NotFound("Group not found or not open.")
+
+        __execute(cursor,'draw_game.assign_santas',santa_query,{
+            'gameid': game['id'],
+            'userids': [x[0] for x in santa_assignments],
+            'santaids': [x[1] for x in santa_assignments],
+        })
+        if cursor.rowcount != len(santa_assignments):
+            conn.rollback()
+            raise SantaErrors.DatabaseChangeError("Santa assignment changed {} users, expected {}.".format(cursor.rowcount,len(santa_assignments)))
+
+        __execute(cursor,'draw_game.assign_ideas',idea_query,{
+            'gameid': game['id'],
+            'ideaids': [x[0] for x in idea_assignments],
+            'userids': [x[1] for x in idea_assignments],
+        })
+        if cursor.rowcount != len(idea_assignments):
+            conn.rollback()
+            raise SantaErrors.DatabaseChangeError("Idea assignment changed {} ideas, expected {}.".format(cursor.rowcount,len(idea_assignments)))
+
+        __execute(cursor,'draw_game.set_state',state_query,{'gameid': game['id']})
+        result = cursor.fetchall()
+        __notify_game_change(cursor,code)
+    __game_cache.invalidate(code)
+    return result
+
+def set_draw_date(code:str,draw_date,sessionid:str,sessionpassword:str):
+    """
+    Set when an open game should be drawn, None to not schedule it.
+    """
+
+    ## get logged on user details
+    owner = __authenticate_user(sessionid,sessionpassword)
+
+    if (len(code) == 0):
+        raise SantaErrors.EmptyValue("Group id is empty.")
+
+    schedule_query = """
+    UPDATE {games} SET draw_date = %(draw_date)s
+    WHERE code = %(code)s AND ownerid = %(ownerid)s AND state = 0
+    RETURNING code,draw_date;
+    """.format(games=true_tablename('games'))
+
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        __execute(cursor,'set_draw_date',schedule_query,{'code':code,'ownerid':owner['id'],'draw_date':draw_date})
+        result = cursor.fetchall()
+        if len(result) == 0:
+            raise SantaErrors.NotFound("Group not found or not open.")
+        return result
+
+def get_exclusions(code:str,sessionid:str,sessionpassword:str):
+    """
+    Pairs of users in a game that must not be drawn, as userid (santa) and excluded (giftee.)
+    """
+
+    ## get logged on user details
+    owner = __authenticate_user(sessionid,sessionpassword)
+
+    if (len(code) == 0):
+        raise SantaErrors.EmptyValue("Group id is empty.")
+
+    exclusion_query = """
+    SELECT {exclusions}.userid,{exclusions}.excluded FROM {exclusions}
+        INNER JOIN {games} ON {games}.id = {exclusions}.game
+    WHERE {games}.code = %(code)s AND {games}.ownerid = %(ownerid)s;
+    """.format(exclusions=true_tablename('exclusions'),games=true_tablename('games'))
+
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        __execute(cursor,'get_exclusions',exclusion_query,{'code':code,'ownerid':owner['id']})
+        return cursor.fetchall()
+
+def set_exclusions(code:str,exclusions:list,groups:dict,sessionid:str,sessionpassword:str):
+    """
+    Replace the exclusions and groups of an open game in one transaction.
+
+    :param exclusions: list of (userid,excluded) tuples, the user will not be santa for excluded.
+    :param groups: userid -> group name, users in the same group are not drawn for each other.
+    """
+
+    ## get logged on user details
+    owner = __authenticate_user(sessionid,sessionpassword)
+
+    if (len(code) == 0):
+        raise SantaErrors.EmptyValue("Group id is empty.")
+
+    lock_game_query = """
+    SELECT id FROM {games}
+    WHERE code = %(code)s AND ownerid = %(ownerid)s AND state = 0
+    FOR UPDATE;
+    """.format(games=true_tablename('games'))
+
+    clear_query = "DELETE FROM {exclusions} WHERE game = %(gameid)s;".format(exclusions=true_tablename('exclusions'))
+
+    # both users have to be in the game, pairs for anyone else are dropped.
+    exclusion_query = """
+    INSERT INTO {exclusions} (game,userid,excluded)
+    SELECT DISTINCT %(gameid)s,pairs.userid,pairs.excluded
+    FROM unnest(%(userids)s::int[],%(excludedids)s::int[]) AS pairs(userid,excluded)
+        INNER JOIN {users} AS santa ON santa.id = pairs.userid AND santa.game = %(gameid)s
+        INNER JOIN {users} AS giftee ON giftee.id = pairs.excluded AND giftee.game = %(gameid)s
+    WHERE pairs.userid <> pairs.excluded;
+    """.format(exclusions=true_tablename('exclusions'),users=true_tablename('users'))
+
+    group_query = """
+    UPDATE {users}
+    SET draw_group = grouped.draw_group
+    FROM (
+        SELECT {users}.id,member.draw_group
+        FROM {users}
+            LEFT JOIN unnest(%(userids)s::int[],%(groups)s::varchar[]) AS member(userid,draw_group) ON member.userid = {users}.id
+        WHERE {users}.game = %(gameid)s
+    ) AS grouped
+    WHERE {users}.id = grouped.id;
+    """.format(users=true_tablename('users'))
+
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        __execute(cursor,'set_exclusions.lock_game',lock_game_query,{'code':code,'ownerid':owner['id']})
+        game = cursor.fetchone()
+        if game is None:
+            raise SantaErrors.NotFound("Group not found or not open.")
+
+        __execute(cursor,'set_exclusions.clear',clear_query,{'gameid':game['id']})
+        __execute(cursor,'set_exclusions.insert',exclusion_query,{
+            'gameid': game['id'],
+            'userids': [x[0] for x in exclusions],
+            'excludedids': [x[1] for x in exclusions],
+        })
+        exclusion_count = cursor.rowcount
+        __execute(cursor,'set_exclusions.groups',group_query,{
+            'gameid': game['id'],
+            'userids': list(groups.keys()),
+            'groups': list(groups.values()),
+        })
+        return {'exclusions':exclusion_count}
+
+def get_previous_draw_pairs(previous_code:str,code:str,sessionid:str,sessionpassword:str):
+    """
+    Santa pairs from an earlier drawn game, as userid and excluded in this game.
+    Users are matched between the games by account, both games have to be owned by the user.
+    """
+
+    ## get logged on user details
+    owner = __authenticate_user(sessionid,sessionpassword)
+
+    if (len(code) == 0 or len(previous_code) == 0):
+        raise SantaErrors.EmptyValue("Group id is empty.")
+
+    previous_query = """
+    SELECT santa.id AS userid,giftee.id AS excluded
+    FROM {users} AS old_santa
+        INNER JOIN {users} AS old_giftee ON old_giftee.id = old_santa.santa
+        INNER JOIN {games} AS old_game ON old_game.id = old_santa.game
+        INNER JOIN {games} AS game ON game.code = %(code)s AND game.ownerid = %(ownerid)s
+        INNER JOIN {users} AS santa ON santa.game = game.id AND santa.account_id = old_santa.account_id
+        INNER JOIN {users} AS giftee ON giftee.game = game.id AND giftee.account_id = old_giftee.account_id
+    WHERE old_game.code = %(previous)s AND old_game.ownerid = %(ownerid)s AND old_game.state IN (1,2);
+    """.format(users=true_tablename('users'),games=true_tablename('games'))
+
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        __execute(cursor,'get_previous_draw_pairs',previous_query,{'code':code,'previous':previous_code,'ownerid':owner['id']})
+        return cursor.fetchall()
+
+###########################################
+# admin funcs
+# all method should check for an admin_key
+###########################################
+
+def check_admin_key(admin_key:str):
+    """Raise an error unless the admin key is correct, for admin functions outside this module.
+    """
+    __assert_admin_key(admin_key)
+
+def get_all_games(admin_key:str):
+    __assert_admin_key(admin_key)
+    properties = ['id','name','code','state','ownerid']
+    user_query = "SELECT {props} FROM {table};".format(table=true_tablename('games'),props=__stringlist_to_sql_columns(properties))
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as __dbCursor:
+        __execute(__dbCursor,'get_all_games',user_query,{})
+        return __dbCursor.fetchall()
+
+def __game_list_filter(state:int,ownerid:int):
+    """Where clauses for the game list filters, None for no filter.
+    """
+    filters = []
+    if state is not None:
+        filters.append("state = %(state)s")
+    if ownerid is not None:
+        filters.append("ownerid = %(ownerid)s")
+    return filters
+
+def get_games_page(admin_key:str,after_id:int=0,limit:int=100,state:int=None,ownerid:int=None):
+    """
+    A page of games in id order, starting after after_id. Use the id of the last game
+    as after_id to get the next page.
+    """
+    __assert_admin_key(admin_key)
+    properties = ['id','name','code','state','ownerid']
+    filters = ["id > %(after_id)s"] + __game_list_filter(state,ownerid)
+    page_query = "SELECT {props} FROM {table} WHERE {filters} ORDER BY id LIMIT %(limit)s;".format(
+        table=true_tablename('games'),
+        props=__stringlist_to_sql_columns(properties),
+        filters=' AND '.join(filters),
+    )
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as __dbCursor:
+        __execute(__dbCursor,'get_games_page',page_query,{'after_id':after_id,'limit':limit,'state':state,'ownerid':ownerid})
+        return __dbCursor.fetchall()
+
+def iter_games(admin_key:str,state:int=None,ownerid:int=None,batch_size:int=1000):
+    """
+    Generator of games in id order, read from a server side cursor batch_size rows at a
+    time so the whole table is never held in memory.
+    """
+    __assert_admin_key(admin_key)
+    properties = ['id','name','code','state','ownerid']
+    filters = __game_list_filter(state,ownerid)
+    stream_query = "SELECT {props} FROM {table} {where} ORDER BY id;".format(
+        table=true_tablename('games'),
+        props=__stringlist_to_sql_columns(properties),
+        where='WHERE ' + ' AND '.join(filters) if filters else '',
+    )
+    with __connection() as conn, conn.cursor(name='iter_games',cursor_factory=RealDictCursor) as cursor:
+        cursor.itersize = batch_size
+        __execute(cursor,'iter_games',stream_query,{'state':state,'ownerid':ownerid})
+        for row in cursor:
+            yield row
+
+def iter_tables(admin_key:str,tables:list,batch_size:int=5000):
+    """
+    Generator of (table, row tuple) for every row of each table, with the columns in dbcommon.export_columns.
+    Each table is read from a server side cursor batch_size rows at a time, all from one snapshot of the database.
+    """
+    __assert_admin_key(admin_key)
+    for table in tables:
+        if table not in dbcommon.export_columns:
+            raise SantaErrors.NotFound("Unknown table {}.".format(table))
+    with __connection() as conn:
+        with conn.cursor() as cursor:
+            # must be the first statement of the transaction.
+            __execute(cursor,'iter_tables.snapshot',"SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY;",{})
+        for table in tables:
+            table_query = "SELECT {columns} FROM {table};".format(
+                columns=__stringlist_to_sql_columns(dbcommon.export_columns[table]),
+                table=true_tablename(table),
+            )
+            with conn.cursor(name='iter_{}'.format(table)) as cursor:
+                cursor.itersize = batch_size
+                __execute(cursor,'iter_tables.{}'.format(table),table_query,{})
+                for row in cursor:
+                    yield table,row
+
+def get_all_open_games(admin_key:str):
+    __assert_admin_key(admin_key)
+    properties = ['id','name','code','state','ownerid']
+    user_query = "SELECT {props} FROM {table} WHERE state = 0;".format(table=true_tablename('games'),props=__stringlist_to_sql_columns(properties))
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as __dbCursor:
+        __execute(__dbCursor,'get_all_open_games',user_query,{})
+        return __dbCursor.fetchall()
+
+def get_due_games(admin_key:str):
+    """
+    Open games with a draw date that has passed.
+    """
+    __assert_admin_key(admin_key)
+    properties = ['id','name','code','state','ownerid','draw_date']
+    user_query = "SELECT {props} FROM {table} WHERE state = 0 AND draw_date <= NOW() ORDER BY draw_date;".format(table=true_tablename('games'),props=__stringlist_to_sql_columns(properties))
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as __dbCursor:
+        __execute(__dbCursor,'get_due_games',user_query,{})
+        return __dbCursor.fetchall()
+
+def get_all_complete_games(admin_key:str):
+    __assert_admin_key(admin_key)
+    properties = ['id','name','code','state','ownerid']
+    user_query = "SELECT {props} FROM {table} WHERE state = 1;".format(table=true_tablename('games'),props=__stringlist_to_sql_columns(properties))
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as __dbCursor:
+        __execute(__dbCursor,'get_all_complete_games',user_query,{})
+        return __dbCursor.fetchall()
+
+def get_all_closed_games(admin_key:str):
+    __assert_admin_key(admin_key)
+    properties = ['id','name','code','state','ownerid']
+    user_query = "SELECT {props} FROM {table} WHERE state = 2;".format(table=true_tablename('games'),props=__stringlist_to_sql_columns(properties))
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as __dbCursor:
+        __execute(__dbCursor,'get_all_closed_games',user_query,{})
+        return __dbCursor.fetchall()
+
+def reset_all_tables(admin_key:str):
+    __assert_admin_key(admin_key)
+    __assert_can_do_major_db_changes()
+    table_list = [
+        true_tablename('games'),
+        true_tablename('ideas'),
+        true_tablename('users'),
+        true_tablename('exclusions'),
+        true_tablename('draw_notify'),
+    ]
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        for table in table_list:
+            table_truncate = "TRUNCATE TABLE {};".format(table)
+            __execute(cursor,'reset_all_tables',table_truncate,{})
+        __notify_game_change(cursor,'*')
+        conn.commit()
+    __game_cache.clear()
+    return {'resetstatus':'ok'}
+
+# checks run on bulk imports before they replace the tables, as (description, query giving the ids of bad rows.)
+# {identities}, {games}, {users} and {ideas} are the staging tables.
+__import_checks = [
+    ('duplicate identity ids', "SELECT id FROM {identities} GROUP BY id HAVING COUNT(*) > 1"),
+    ('duplicate identity emails', "SELECT MIN(id) FROM {identities} GROUP BY LOWER(email) HAVING COUNT(*) > 1"),
+    ('duplicate game ids', "SELECT id FROM {games} GROUP BY id HAVING COUNT(*) > 1"),
+    ('duplicate game codes', "SELECT MIN(id) FROM {games} GROUP BY code HAVING COUNT(*) > 1"),
+    ('duplicate user ids', "SELECT id FROM {users} GROUP BY id HAVING COUNT(*) > 1"),
+    ('duplicate idea ids', "SELECT id FROM {ideas} GROUP BY id HAVING COUNT(*) > 1"),
+    ('games owned by unknown identities', "SELECT id FROM {games} g WHERE ownerid IS NOT NULL AND NOT EXISTS (SELECT 1 FROM {identities} i WHERE i.id = g.ownerid)"),
+    ('users in unknown games', "SELECT id FROM {users} u WHERE NOT EXISTS (SELECT 1 FROM {games} g WHERE g.id = u.game)"),
+    ('users of unknown identities', "SELECT id FROM {users} u WHERE account_id IS NOT NULL AND NOT EXISTS (SELECT 1 FROM {identities} i WHERE i.id = u.account_id)"),
+    ('users drawn for someone outside their game', "SELECT id FROM {users} u WHERE santa <> -1 AND NOT EXISTS (SELECT 1 FROM {users} s WHERE s.id = u.santa AND s.game = u.game)"),
+    ('ideas in unknown games', "SELECT id FROM {ideas} i WHERE NOT EXISTS (SELECT 1 FROM {games} g WHERE g.id = i.game)"),
+    ('ideas given to someone outside their game', "SELECT id FROM {ideas} i WHERE userid <> -1 AND NOT EXISTS (SELECT 1 FROM {users} u WHERE u.id = i.userid AND u.game = i.game)"),
+    ('ideas from unknown identities', "SELECT id FROM {ideas} i WHERE account_id IS NOT NULL AND NOT EXISTS (SELECT 1 FROM {identities} a WHERE a.id = i.account_id)"),
+]
+
+def bulk_import(admin_key:str,sources:dict):
+    """
+    Replace the games, identities, users and ideas tables with imported rows, for restores and
+    moving data between table prefixes.
+
+    The rows are copied into temporary staging tables with COPY, checked that every reference
+    between them resolves, then swapped into the real tables in the same transaction, so either
+    everything is replaced or nothing changes. Sessions, exclusions, draw jobs and result email progress are cleared.
+
+    :param sources: table -> (columns, file like object of csv rows without a header) for each table in dbcommon.export_columns.
+    """
+    __assert_admin_key(admin_key)
+    __assert_can_do_major_db_changes()
+    missing_tables = [table for table in dbcommon.export_columns if table not in sources]
+    if len(missing_tables) > 0:
+        raise SantaErrors.EmptyValue("Import is missing tables {}".format(missing_tables))
+    for table,(columns,_) in sources.items():
+        if table not in dbcommon.export_columns:
+            raise SantaErrors.NotFound("Unknown table {}.".format(table))
+        __assert_columns(columns,dbcommon.export_columns[table])
+        if 'id' not in columns or len(set(columns)) != len(columns):
+            raise SantaErrors.ImportValidationError("{} columns must include id once, and no column twice.".format(table))
+
+    staging = {table:'import_{}'.format(table) for table in dbcommon.export_columns}
+    counts = {}
+    timings = {}
+    start = time.perf_counter()
+    with __connection() as conn, conn.cursor() as cursor:
+        for table in dbcommon.export_columns:
+            columns,source = sources[table]
+            column_list = __stringlist_to_sql_columns(columns)
+            __execute(cursor,'bulk_import.staging',"CREATE TEMP TABLE {staging} ON COMMIT DROP AS SELECT {columns} FROM {table} WITH NO DATA;".format(
+                staging=staging[table],columns=column_list,table=true_tablename(table)),{})
+            copy_start = time.perf_counter()
+            cursor.copy_expert("COPY {staging} ({columns}) FROM STDIN WITH (FORMAT csv);".format(staging=staging[table],columns=column_list),source,size=65536)
+            __execute(cursor,'bulk_import.count',"SELECT COUNT(*) FROM {staging};".format(staging=staging[table]),{})
+            counts[table] = cursor.fetchone()[0]
+            record_query('bulk_import.copy',time.perf_counter() - copy_start,0,counts[table])
+            # the checks join on id, so give the planner an idea of the sizes.
+            __execute(cursor,'bulk_import.analyze',"ANALYZE {staging};".format(staging=staging[table]),{})
+        timings['copy'] = time.perf_counter() - start
+
+        check_start = time.perf_counter()
+        problems = []
+        for description,check_query in __import_checks:
+            __execute(cursor,'bulk_import.check',"SELECT COUNT(*),(ARRAY_AGG(id))[1:5] FROM ({check}) AS bad(id);".format(check=check_query.format(**staging)),{})
+            bad_count,examples = cursor.fetchone()
+            if bad_count > 0:
+                problems.append("{} {} (ids {})".format(bad_count,description,examples))
+        if len(problems) > 0:
+            raise SantaErrors.ImportValidationError("Import not applied: {}".format(', '.join(problems)))
+        timings['check'] = time.perf_counter() - check_start
+
+        swap_start = time.perf_counter()
+        # sessions are removed along with their identities by the cascade.
+        __execute(cursor,'bulk_import.truncate',"TRUNCATE TABLE {tables} CASCADE;".format(tables=','.join(
+            [true_tablename(table) for table in list(dbcommon.export_columns) + ['exclusions','draw_jobs','draw_notify']])),{})
+        for table in dbcommon.export_columns:
+            columns = sources[table][0]
+            column_list = __stringlist_to_sql_columns(columns)
+            __execute(cursor,'bulk_import.insert',"INSERT INTO {table} ({columns}) SELECT {columns} FROM {staging};".format(
+                table=true_tablename(table),columns=column_list,staging=staging[table]),{})
+            # new rows carry on from the highest imported id.
+            __execute(cursor,'bulk_import.sequence',"SELECT setval(pg_get_serial_sequence(%(table)s,'id'),COALESCE((SELECT MAX(id) FROM {table}),0) + 1,false);".format(
+                table=true_tablename(table)),{'table':true_tablename(table)})
+            __execute(cursor,'bulk_import.analyze',"ANALYZE {table};".format(table=true_tablename(table)),{})
+        __notify_game_change(cursor,'*')
+        timings['swap'] = time.perf_counter() - swap_start
+    __game_cache.clear()
+    __session_cache.clear()
+
+    elapsed = time.perf_counter() - start
+    rows = sum(counts.values())
+    return {
+        'tables': counts,
+        'rows': rows,
+        'seconds': round(elapsed,3),
+        'rows_per_second': round(rows / elapsed,1) if elapsed > 0 else 0.0,
+        'timings': {name:round(seconds,3) for name,seconds in timings.items()},
+    }
+
+def init_tables(admin_key:str,check_only:bool=False):
+    """Bring the database schema up to date using the migrations.
+    With check_only the current version and pending migrations are returned without making changes.
+    """
+    __assert_admin_key(admin_key)
+    if not check_only:
+        __assert_can_do_major_db_changes()
+    result = migrations.migrate(__connection,true_tablename,check_only=check_only)
+    result['initstatus'] = 'ok'
+    return result
+
+###################################
+# Mail outbox funcs
+# used by the background mail senders
+###################################
+
+def queue_mail(to_email:str,subject:str,html:str):
+    """
+    Add a message to the outbox table, returns the id.
+    """
+    queue_query = """
+    INSERT INTO {outbox} (to_email,subject,html)
+    VALUES (%(to)s,%(subject)s,%(html)s)
+    RETURNING id;
+    """.format(outbox=true_tablename('outbox'))
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        __execute(cursor,'queue_mail',queue_query,{'to':to_email,'subject':subject,'html':html})
+        return cursor.fetchone()['id']
+
+def claim_mail(stale_minutes:int=10):
+    """
+    Take the next due message from the outbox, or None if nothing is due.
+    Messages left sending by a process that stopped are picked up again after stale_minutes.
+    """
+    claim_query = """
+    UPDATE {outbox}
+    SET state = 'sending', attempts = attempts + 1, locked_date = NOW()
+    WHERE id = (
+        SELECT id FROM {outbox}
+        WHERE (state = 'queued' AND next_attempt <= NOW())
+        OR (state = 'sending' AND locked_date < NOW() - make_interval(mins => %(stale)s))
+        ORDER BY next_attempt
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id,to_email,subject,html,attempts,EXTRACT(EPOCH FROM queued_date)::float AS queued_time;
+    """.format(outbox=true_tablename('outbox'))
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        __execute(cursor,'claim_mail',claim_query,{'stale':stale_minutes})
+        return cursor.fetchone()
+
+def mark_mail_sent(mail_id:int):
+    """
+    Record a message as sent, the body is removed as it is no longer needed.
+    """
+    sent_query = """
+    UPDATE {outbox}
+    SET state = 'sent', html = NULL, sent_date = NOW(), locked_date = NULL
+    WHERE id = %(id)s;
+    """.format(outbox=true_tablename('outbox'))
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        __execute(cursor,'mark_mail_sent',sent_query,{'id':mail_id})
+
+def mark_mail_failed(mail_id:int,error:str,retry_seconds:float=None):
+    """
+    Record a failed send, the message is retried after retry_seconds or if it is None
+    moved to the dead state.
+    """
+    failed_query = """
+    UPDATE {outbox}
+    SET state = CASE WHEN %(retry)s::float IS NULL THEN 'dead' ELSE 'queued' END,
+        html = CASE WHEN %(retry)s::float IS NULL THEN NULL ELSE html END,
+        next_attempt = NOW() + make_interval(secs => COALESCE(%(retry)s::float,0)),
+        last_error = %(error)s,
+        locked_date = NULL
+    WHERE id = %(id)s;
+    """.format(outbox=true_tablename('outbox'))
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        __execute(cursor,'mark_mail_failed',failed_query,{'id':mail_id,'error':error,'retry':retry_seconds})
+
+def mail_queue_depth():
+    """
+    Number of messages waiting to be sent.
+    """
+    depth_query = """
+    SELECT COUNT(*) AS depth FROM {outbox} WHERE state IN ('queued','sending');
+    """.format(outbox=true_tablename('outbox'))
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        __execute(cursor,'mail_queue_depth',depth_query,{})
+        return cursor.fetchone()['depth']
+
+###################################
+# Draw job funcs
+###################################
+
+__draw_job_columns = """id,code,ownerid,state,attempts,error,users,ideas,
+    EXTRACT(EPOCH FROM queued_date)::float AS queued_time,
+    EXTRACT(EPOCH FROM started_date)::float AS started_time,
+    EXTRACT(EPOCH FROM finished_date)::float AS finished_time"""
+
+def queue_draw_job(job_id:str,code:str,ownerid:int):
+    """
+    Add a draw to the jobs table, if the game already has a waiting or running draw
+    that job is returned instead.
+    """
+    queue_query = """
+    WITH r AS (
+        INSERT INTO {jobs} (id,code,ownerid)
+        VALUES (%(id)s,%(code)s,%(ownerid)s)
+        ON CONFLICT DO NOTHING
+        RETURNING {columns}
+    )
+    SELECT * FROM r
+    UNION ALL
+    SELECT {columns} FROM {jobs}
+    WHERE code = %(code)s AND state IN ('queued','running') AND NOT EXISTS (SELECT 1 FROM r);
+    """.format(jobs=true_tablename('draw_jobs'),columns=__draw_job_columns)
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        __execute(cursor,'queue_draw_job',queue_query,{'id':job_id,'code':code,'ownerid':ownerid})
+        return cursor.fetchone()
+
+def claim_draw_job(stale_minutes:int=10):
+    """
+    Take the oldest waiting draw, or None if there are none.
+    Draws whose worker has not sent a heartbeat for stale_minutes are picked up again, the worker has stopped.
+    """
+    claim_query = """
+    UPDATE {jobs}
+    SET state = 'running', attempts = attempts + 1, started_date = NOW(), heartbeat_date = NOW()
+    WHERE id = (
+        SELECT id FROM {jobs}
+        WHERE state = 'queued'
+        OR (state = 'running' AND COALESCE(heartbeat_date,started_date) < NOW() - make_interval(mins => %(stale)s))
+        ORDER BY queued_date
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING {columns};
+    """.format(jobs=true_tablename('draw_jobs'),columns=__draw_job_columns)
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        __execute(cursor,'claim_draw_job',claim_query,{'stale':stale_minutes})
+        return cursor.fetchone()
+
+def heartbeat_draw_job(job_id:str,attempt:int):
+    """
+    Show a draw is still being run, so it isn't picked up again by another worker.
+    """
+    heartbeat_query = """
+    UPDATE {jobs}
+    SET heartbeat_date = NOW()
+    WHERE id = %(id)s AND attempts = %(attempt)s AND state = 'running';
+    """.format(jobs=true_tablename('draw_jobs'))
+    with __connection() as conn, conn.cursor() as cursor:
+        __execute(cursor,'heartbeat_draw_job',heartbeat_query,{'id':job_id,'attempt':attempt})
+
+def finish_draw_job(job_id:str,state:str,error:str=None,users:int=None,ideas:int=None,attempt:int=None):
+    """
+    Record the end of a draw, state is done or failed.
+    If attempt is given the result is only recorded if the draw was not picked up again since.
+    """
+    finish_query = """
+    UPDATE {jobs}
+    SET state = %(state)s, error = %(error)s, users = %(users)s, ideas = %(ideas)s, finished_date = NOW()
+    WHERE id = %(id)s AND (%(attempt)s::int IS NULL OR attempts = %(attempt)s);
+    """.format(jobs=true_tablename('draw_jobs'))
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        __execute(cursor,'finish_draw_job',finish_query,{'id':job_id,'state':state,'error':error,'users':users,'ideas':ideas,'attempt':attempt})
+
+def get_draw_job(job_id:str):
+    """
+    A draw job by id, or None.
+    """
+    job_query = "SELECT {columns} FROM {jobs} WHERE id = %(id)s;".format(jobs=true_tablename('draw_jobs'),columns=__draw_job_columns)
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        __execute(cursor,'get_draw_job',job_query,{'id':job_id})
+        return cursor.fetchone()
+
+def draw_job_depth():
+    """
+    Number of draws waiting or running.
+    """
+    depth_query = "SELECT COUNT(*) AS depth FROM {jobs} WHERE state IN ('queued','running');".format(jobs=true_tablename('draw_jobs'))
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        __execute(cursor,'draw_job_depth',depth_query,{})
+        return cursor.fetchone()['depth']
+
+###################################
+# Draw notify funcs
+###################################
+
+__draw_notify_columns = """code,state,attempts,total,sent,error,
+    (state IN ('queued','sending') AND updated_date < NOW() - make_interval(mins => %(stale)s)) AS stale"""
+
+def claim_draw_notify(code:str,total:int,stale_minutes:int=10):
+    """
+    Start sending the draw result emails of a game. Returns the notify row if the caller should send them,
+    starting after the sent count, or None if they are done or being sent by someone else.
+    Failed sends, and sends not updated for stale_minutes as the process stopped, are taken over.
+    """
+    claim_query = """
+    INSERT INTO {notify} AS n (code,total)
+    VALUES (%(code)s,%(total)s)
+    ON CONFLICT (code) DO UPDATE
+    SET state = 'queued', attempts = n.attempts + 1, total = EXCLUDED.total, error = NULL, updated_date = NOW()
+    WHERE n.state = 'failed'
+    OR (n.state IN ('queued','sending') AND n.updated_date < NOW() - make_interval(mins => %(stale)s))
+    RETURNING {columns};
+    """.format(notify=true_tablename('draw_notify'),columns=__draw_notify_columns)
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        __execute(cursor,'claim_draw_notify',claim_query,{'code':code,'total':total,'stale':stale_minutes})
+        return cursor.fetchone()
+
+def update_draw_notify(code:str,attempt:int,state:str,sent:int,error:str=None):
+    """
+    Record the progress of the draw result emails, only if they were not taken over since.
+    """
+    update_query = """
+    UPDATE {notify}
+    SET state = %(state)s, sent = %(sent)s, error = %(error)s, updated_date = NOW()
+    WHERE code = %(code)s AND attempts = %(attempt)s;
+    """.format(notify=true_tablename('draw_notify'))
+    with __connection() as conn, conn.cursor() as cursor:
+        __execute(cursor,'update_draw_notify',update_query,{'code':code,'attempt':attempt,'state':state,'sent':sent,'error':error})
+
+def get_draw_notify(code:str,stale_minutes:int=10):
+    """
+    The draw result email progress of a game, or None if they have not been started.
+    """
+    notify_query = "SELECT {columns} FROM {notify} WHERE code = %(code)s;".format(notify=true_tablename('draw_notify'),columns=__draw_notify_columns)
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        __execute(cursor,'get_draw_notify',notify_query,{'code':code,'stale':stale_minutes})
+        return cursor.fetchone()
+
+###################################
+# Login funcs
+###################################
+
+def new_session(uuid:str, email:str, verify_code:str):
+    """
+    Create a new session for a user
+    """
+
+    new_session_query = """
+    WITH user_ident AS (
+        SELECT id,email,name
+        FROM {identity} WHERE LOWER({identity}.email) = LOWER(%(email)s)
+    )
+    INSERT INTO {session} (id,verify_hash,secret_hash,identity_id,last_date)
+        SELECT %(uuid)s,crypt(%(code)s, gen_salt('bf')),NULL,{identity}.id,NOW()
+        FROM {identity} WHERE LOWER({identity}.email) = LOWER(%(email)s)
+    RETURNING {session}.id,{session}.last_date,
+        (SELECT email FROM user_ident),
+        (SELECT name FROM user_ident);
+    """.format(session=true_tablename('sessions'),identity=true_tablename('identities'))
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        __execute(cursor,'new_session',new_session_query,{
+            'uuid':uuid,
+            'email': __lowercase_email(email),
+            'code':verify_code,
+            })
+        return cursor.fetchall()
+
+def confirm_session(uuid:str, verify_code:str, new_secret:str):
+    """
+    Check and update the session to verify that the session is
+    good to use.
+    """
+
+    verify_session_query = """
+    UPDATE {session}
+    SET secret_hash = crypt(%(secret)s,gen_salt('bf')) , verify_hash = NULL , last_date = NOW()
+    WHERE id = %(uuid)s AND verify_hash = crypt(%(code)s,verify_hash)
+    RETURNING id,identity_id,last_date;
+    """.format(session=true_tablename('sessions'))
+    update_verify_date = """
+    UPDATE {identity}
+    SET verify_date = NOW()
+    WHERE {identity}.id = %(ident)s
+    RETURNING id,name,email;
+    """.format(identity=true_tablename('identities'))
+    # the secret is changing, so any cached copy is no longer valid.
+    __session_cache.invalidate(uuid)
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        __execute(cursor,'confirm_session.verify',verify_session_query,{'uuid':uuid,'secret':new_secret,'code':verify_code})
+        session_data = cursor.fetchall()
+        if type(session_data) == list:
+            if len(session_data) == 0:
+                return session_data # nothing done, so just return nothing
+            session_data = session_data[0]
+        __execute(cursor,'confirm_session.update_identity',update_verify_date,{'ident':session_data['identity_id']})
+        identity = cursor.fetchone()
+        session_data['name'] = identity['name']
+        session_data['email'] = identity['email']
+        return session_data
+        
+def remove_session(uuid:str, secret:str):
+    """
+    Log out a session by removing it from the db.
+    """
+    # only authed users can logout!
+    __authenticate_user(uuid,secret)
+    __session_cache.invalidate(uuid)
+
+    remove_session_query = """
+    DELETE FROM {session}
+    WHERE id = %(uuid)s AND secret_hash = crypt(%(password)s,secret_hash)
+    RETURNING id;
+    """.format(session=true_tablename('sessions'))
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        __execute(cursor,'remove_session',remove_session_query,{'uuid':uuid,'password':secret})
+        result = cursor.fetchall()
+    __session_cache.invalidate(uuid)
+    if getattr(__request_state,'active',False):
+        __request_state.identities.pop((uuid,secret),None)
+    return result
+
+def register_user(email:str,name:str):
+    """
+    Create an identity for an email so new session can be created.
+    """
+
+    new_user = """
+    INSERT into {identity}(id,email,name,register_date) 
+    Values (DEFAULT,%(email)s,%(name)s,NOW())
+    RETURNING id,email,name;
+    """.format(session=true_tablename('sessions'),identity=true_tablename('identities'))
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        __execute(cursor,'register_user',new_user,{
+            'name':name,
+            'email':__lowercase_email(email),
+            })
+        return cursor.fetchall()
+
+def get_registered_user(email:str):
+    """
+    Check the id of a user from an email.
+    """
+    valid_columns = ['id','email','register_date','verify_date']
+    return __get_simple_table('identities',valid_columns=valid_columns,columns_to_get=valid_columns,column_query={'email':email})
+
+def __authenticate_user(sessionid:str,sessionpassword:str):
+    """
+    Check user session is authenticated and get user.
+    Recently verified sessions are served from the session cache, and each
+    session is only checked once per request.
+    """
+    if isinstance(sessionid,Identity):
+        return sessionid
+
+    in_request = getattr(__request_state,'active',False)
+    if in_request:
+        known_identity = __request_state.identities.get((sessionid,sessionpassword))
+        if known_identity is not None:
+            return known_identity
+        __request_state.auth_count += 1
+
+    start = time.perf_counter()
+    try:
+        identity = __check_session(sessionid,sessionpassword)
+    finally:
+        __add_request_time('auth_time',time.perf_counter() - start)
+    if in_request:
+        __request_state.identities[(sessionid,sessionpassword)] = identity
+    return identity
+
+def __check_session(sessionid:str,sessionpassword:str):
+    """
+    Check session credentials against the session cache, then the database.
+    """
+    cached_user = __session_cache.get(sessionid,sessionpassword)
+    if cached_user is not None:
+        return Identity(cached_user,sessionid)
+
+    get_user = """
+    SELECT {identity}.id,{identity}.name,{identity}.email
+    FROM {identity}
+        INNER JOIN {session}
+        ON {session}.identity_id = {identity}.id
+        WHERE {session}.id = %(uuid)s AND secret_hash = crypt(%(password)s,secret_hash)
+    """.format(identity=true_tablename('identities'),session=true_tablename('sessions'))
+    with __connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        __execute(cursor,'authenticate_user',get_user,{'uuid':sessionid,'password':sessionpassword})
+        if cursor.rowcount == 0:
+            raise SantaErrors.SessionError("Session not found or wrong password.")
+        user = cursor.fetchone()
+    __session_cache.put(sessionid,sessionpassword,user)
+    return Identity(user,sessionid)
+    
+def get_authenticated_user(sessionid:str,sessionpassword:str):
+    """
+    get info about session user, as an Identity that can be passed to other functions
+    instead of the session credentials.
+    """
+    return __authenticate_user(sessionid,sessionpassword)
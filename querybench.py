@@ -0,0 +1,198 @@
+"""
+EXPLAIN ANALYZE report of the lookups made on most requests, before and after the query
+indexes (migration 6), on a synthetic dataset:
+
+    python querybench.py [users] [users per game] [keep]
+
+Needs DATABASE_URL. The tables are made by the real migrations with the bench_santa_ prefix,
+so the app's own tables are never touched, and are dropped at the end unless keep is given.
+The default is 1,000,000 users in games of 20, played by 250,000 identities that are in 4
+games each, with two ideas per user. Filling the tables takes a few minutes.
+
+The tables are built up to migration 5, each query is timed, then migration 6 is applied and
+they are timed again. Each query is run a few times and the fastest run is reported, so both
+sides are timed with the data cached. The plans are printed in full with -v.
+"""
+
+import json
+import os
+import sys
+import time
+import urllib.parse
+import uuid
+
+import psycopg2
+
+import migrations
+
+__prefix = 'bench_santa'
+__runs = 5
+
+def tablename(table:str):
+    return "{}_{}".format(__prefix,table)
+
+def connect():
+    dburl = urllib.parse.urlparse(os.environ['DATABASE_URL'])
+    return psycopg2.connect(database=dburl.path[1:],user=dburl.username,password=dburl.password,host=dburl.hostname,port=dburl.port)
+
+# the queries as postgresdb runs them, with the bench tables.
+# get_users_in_game leaves out draw_group as that column comes with migration 8.
+queries = {
+    'list_user_games': """
+    SELECT games.name,games.code,games.state,users.name as joinname
+    FROM {games} as games
+        INNER JOIN {users} as users
+        ON games.id = users.game
+    WHERE users.account_id = %(userid)s AND games.state IN (0,1);
+    """,
+    'get_game_ideas': """
+    SELECT {ideas}.id,idea,game,{ideas}.account_id
+    FROM {ideas}
+        INNER JOIN {games}
+        ON {games}.id = {ideas}.game
+    WHERE {games}.code = %(code)s
+    AND {games}.ownerid = %(userid)s;
+    """,
+    # the leftover ideas of a drawn game, as __get_simple_table builds it for api.py.
+    'get_idea': "SELECT idea FROM {ideas} WHERE  game = %(game)s  AND  userid = %(userid)s ;",
+    'get_users_in_game': """
+    SELECT {users}.id,game,{users}.name,{users}.account_id FROM {users} INNER JOIN {games} ON {games}.id = {users}.game WHERE {games}.code = %(code)s AND {games}.ownerid = %(userid)s;
+    """,
+    'new_session': """
+    WITH user_ident AS (
+        SELECT id,email,name
+        FROM {identities} WHERE LOWER({identities}.email) = LOWER(%(email)s)
+    )
+    INSERT INTO {sessions} (id,verify_hash,secret_hash,identity_id,last_date)
+        SELECT %(uuid)s,crypt(%(code)s, gen_salt('bf')),NULL,{identities}.id,NOW()
+        FROM {identities} WHERE LOWER({identities}.email) = LOWER(%(email)s)
+    RETURNING {sessions}.id,{sessions}.last_date,
+        (SELECT email FROM user_ident),
+        (SELECT name FROM user_ident);
+    """,
+}
+
+def __tables():
+    return {table:tablename(table) for table in ['games','users','ideas','identities','sessions']}
+
+def drop_tables(conn):
+    with conn, conn.cursor() as cursor:
+        cursor.execute("DROP TABLE IF EXISTS {} CASCADE;".format(','.join(__tables().values())))
+
+def apply_migrations(conn,versions:list):
+    for version,name,statements in migrations.migration_list:
+        if version not in versions:
+            continue
+        start = time.perf_counter()
+        with conn, conn.cursor() as cursor:
+            for statement in statements(tablename):
+                cursor.execute(statement,{})
+        print("migration {} {}: {:.1f}s".format(version,name,time.perf_counter() - start))
+
+def fill_tables(conn,users:int,per_game:int,games_per_identity:int=4):
+    """
+    Fill the tables in a few set based inserts, returns the number of games and identities.
+    """
+    games = users // per_game
+    identities = max(per_game,users // games_per_identity)
+    tables = __tables()
+    statements = [
+        # people in games of per_game, the identity of the first person owns the game.
+        """INSERT INTO {identities} (email,name,verify_date)
+        SELECT 'person' || i || '@example.com','Person ' || i,NOW() FROM generate_series(1,%(identities)s) AS i;""",
+        """INSERT INTO {games} (name,code,state,ownerid)
+        SELECT 'Group ' || g,lpad(to_hex(g),8,'0'),g %% 3,((g - 1) * %(per_game)s) %% %(identities)s + 1
+        FROM generate_series(1,%(games)s) AS g;""",
+        """INSERT INTO {users} (game,name,santa,account_id)
+        SELECT (i - 1) / %(per_game)s + 1,'Person ' || i,-1,(i - 1) %% %(identities)s + 1
+        FROM generate_series(1,%(users)s) AS i;""",
+        # two ideas each, given out in drawn games (state 1) and left over in the rest.
+        """INSERT INTO {ideas} (game,idea,userid,account_id)
+        SELECT u.game,'Idea ' || k || ' from ' || u.id,CASE WHEN g.state = 1 THEN u.id ELSE -1 END,u.account_id
+        FROM {users} AS u INNER JOIN {games} AS g ON g.id = u.game, generate_series(1,2) AS k;""",
+    ]
+    params = {'users':users,'per_game':per_game,'games':games,'identities':identities}
+    for statement in statements:
+        start = time.perf_counter()
+        with conn, conn.cursor() as cursor:
+            cursor.execute(statement.format(**tables),params)
+            print("{} rows in {:.1f}s".format(cursor.rowcount,time.perf_counter() - start))
+    analyze(conn)
+    return games,identities
+
+def analyze(conn):
+    with conn, conn.cursor() as cursor:
+        for table in __tables().values():
+            cursor.execute("ANALYZE {};".format(table))
+
+def explain(conn,name:str,params:dict,verbose:bool=False):
+    """
+    Fastest of a few EXPLAIN ANALYZE runs of a query, rolled back so inserts leave nothing behind.
+    Returns the time in ms and the scans in the plan.
+    """
+    query = "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + queries[name].format(**__tables())
+    best = None
+    for _ in range(__runs):
+        with conn.cursor() as cursor:
+            cursor.execute(query,params)
+            plan = cursor.fetchone()[0]
+            if isinstance(plan,str):
+                plan = json.loads(plan)
+            plan = plan[0]
+        conn.rollback()
+        if best is None or plan['Execution Time'] < best['Execution Time']:
+            best = plan
+    if verbose:
+        print(json.dumps(best['Plan'],indent=2))
+    return best['Execution Time'],__scans(best['Plan'])
+
+def __scans(node:dict):
+    scans = []
+    if 'Scan' in node['Node Type']:
+        scans.append("{} {}".format(node['Node Type'],node.get('Index Name') or node.get('Relation Name','')).replace(__prefix + '_',''))
+    for child in node.get('Plans',[]):
+        scans.extend(__scans(child))
+    return scans
+
+def sample_params(conn,games:int,identities:int):
+    """
+    Parameters of each query for a drawn game and a person from the middle of the tables.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT id,code,ownerid FROM {games} WHERE id >= %(id)s AND state = 1 ORDER BY id LIMIT 1;".format(**__tables()),{'id':games // 2})
+        game_id,code,ownerid = cursor.fetchone()
+    conn.rollback()
+    person = identities // 2
+    return {
+        'list_user_games': {'userid':person},
+        'get_game_ideas': {'code':code,'userid':ownerid},
+        'get_idea': {'game':game_id,'userid':-1},
+        'get_users_in_game': {'code':code,'userid':ownerid},
+        'new_session': {'uuid':str(uuid.uuid4()),'email':'Person{}@Example.com'.format(person),'code':'123456'},
+    }
+
+def run(users:int,per_game:int,keep:bool=False,verbose:bool=False):
+    conn = connect()
+    try:
+        drop_tables(conn)
+        apply_migrations(conn,[1,2,3,4,5])
+        games,identities = fill_tables(conn,users,per_game)
+        params = sample_params(conn,games,identities)
+        before = {name:explain(conn,name,params[name],verbose) for name in queries}
+        apply_migrations(conn,[6])
+        analyze(conn)
+        after = {name:explain(conn,name,params[name],verbose) for name in queries}
+    finally:
+        if not keep:
+            drop_tables(conn)
+        conn.close()
+    return before,after
+
+if __name__ == '__main__':
+    args = [x for x in sys.argv[1:] if x not in ('keep','-v')]
+    users = int(args[0]) if len(args) > 0 else 1000000
+    per_game = int(args[1]) if len(args) > 1 else 20
+    before,after = run(users,per_game,keep='keep' in sys.argv,verbose='-v' in sys.argv)
+    print("{:<18} {:>10} {:>10}  {}".format('query','before ms','after ms','scans before -> after'))
+    for name in queries:
+        print("{:<18} {:>10.3f} {:>10.3f}  {} -> {}".format(name,before[name][0],after[name][0],', '.join(before[name][1]),', '.join(after[name][1])))
@@ -0,0 +1,525 @@
+"""
+Draw engine, picks who each person is secret santa for while keeping to exclusion rules.
+
+Exclusions are (santa, giftee) pairs that must not be drawn, and groups of people that
+must not draw anyone else in the same group (households, teams etc.)
+
+A draw is a perfect matching of santas to giftees. Most people are matched with a random
+greedy pass, anyone left over is matched with augmenting paths, and the cycles of the
+result are then joined into one cycle where the exclusions allow it. The augmenting path
+search visits the allowed pairs without listing them, so the cost grows with the number
+of people plus the number of exclusions rather than with people squared.
+
+If no augmenting path exists for someone then no valid draw exists at all, and the
+people that cannot all be given a giftee are reported.
+
+Ideas are given out by allocate_ideas, which never gives someone an idea they submitted.
+
+Run this file to benchmark the engine:
+
+    python santadraw.py [participants] [exclusions per person] [group size]
+    python santadraw.py tight [participants] [giftees allowed per person]
+    python santadraw.py ideas [participants] [ideas submitted per person] [ideas per person]
+"""
+
+import gc
+import heapq
+import random
+import sys
+import time
+from collections import Counter
+from itertools import islice, repeat
+from operator import itemgetter
+
+import SantaErrors
+
+# random picks tried for each santa before looking through every free giftee.
+greedy_tries = 8
+# swaps tried when joining one cycle into the main cycle.
+merge_tries = 64
+# exclusion pairs looked at to estimate how constrained each santa is.
+exclusion_sample_size = 20000
+# exclusions are sorted out by santa up front once there are more than people squared over this.
+dense_exclusions = 16
+
+class _Rules:
+    """
+    Exclusions and groups, santas and giftees are positions in the people list.
+
+    Exclusions are normally kept as the set of (santa id, giftee id) pairs they were given as,
+    building the set is done in C so it costs far less than sorting the pairs out by person.
+    The positions each santa can't draw are only worked out for santas the greedy pass or
+    the augmenting path search have to look at closely. When the exclusions are dense most
+    santas end up there, so the rows are given for everyone up front instead.
+    """
+
+    def __init__(self,people:list,index_of:dict,pairs:set,groups:list,rows:list=None):
+        self.count = len(people)
+        self.people = people
+        self.index_of = index_of
+        self.pairs = pairs
+        self.groups = groups
+        self.group_sizes = {}
+        # positions in each group.
+        self.group_members = {}
+        for position,group in enumerate(groups):
+            if group is not None:
+                self.group_members.setdefault(group,set()).add(position)
+        for group,members in self.group_members.items():
+            self.group_sizes[group] = len(members)
+        self.exclusion_counts = {}
+        self._excluded = {}
+        if rows is not None:
+            self._excluded = dict(enumerate(rows))
+            self.exclusion_counts = {people[santa]:len(row) - 1 for santa,row in enumerate(rows)}
+        elif pairs:
+            # exclusions per santa are only used to order the greedy pass, so they are estimated
+            # from a sample of the pairs rather than counting them all.
+            sample = Counter(map(itemgetter(0),islice(pairs,exclusion_sample_size)))
+            scale = len(pairs) / min(len(pairs),exclusion_sample_size)
+            self.exclusion_counts = {santa:count * scale for santa,count in sample.items()}
+
+    def excluded(self,santa:int) -> set:
+        """
+        Positions a santa can't draw apart from their group, including themselves.
+        """
+        excluded = self._excluded.get(santa)
+        if excluded is None:
+            santa_id = self.people[santa]
+            excluded = set(map(self.index_of.__getitem__,map(itemgetter(1),self.pairs.intersection(zip(repeat(santa_id),self.people)))))
+            excluded.add(santa)
+            self._excluded[santa] = excluded
+        return excluded
+
+    def first_allowed(self,santa:int,giftees:list) -> int:
+        """
+        Index in giftees of the first one the santa can draw, or -1.
+        """
+        excluded = self._excluded.get(santa)
+        if excluded is None and len(giftees) * 2 >= self.count:
+            # most people are still in the list, work out the whole row so the search can use it too.
+            excluded = self.excluded(santa)
+        elif excluded is None:
+            santa_id = self.people[santa]
+            excluded = set(map(self.index_of.__getitem__,map(itemgetter(1),self.pairs.intersection(zip(repeat(santa_id),map(self.people.__getitem__,giftees))))))
+            excluded.add(santa)
+        group = self.groups[santa]
+        members = self.group_members[group] if group is not None else ()
+        for index,giftee in enumerate(giftees):
+            if giftee not in excluded and giftee not in members:
+                return index
+        return -1
+
+    def allowed(self,santa:int,giftee:int) -> bool:
+        if santa == giftee:
+            return False
+        group = self.groups[santa]
+        if group is not None and group == self.groups[giftee]:
+            return False
+        if self.pairs is None:
+            return giftee not in self._excluded[santa]
+        return (self.people[santa],self.people[giftee]) not in self.pairs
+
+    def constraint_count(self,santa:int) -> float:
+        group = self.groups[santa]
+        return self.exclusion_counts.get(self.people[santa],0) + (self.group_sizes[group] if group is not None else 0)
+
+def __greedy_match(rules:_Rules,rng):
+    """
+    Match santas to random free giftees, most constrained santas first.
+    """
+    count = rules.count
+    giftee_of = [-1] * count
+    santa_of = [-1] * count
+
+    order = list(range(count))
+    rng.shuffle(order)
+    if rules.group_sizes or rules.exclusion_counts:
+        order.sort(key=rules.constraint_count,reverse=True)
+
+    free = list(range(count))
+    rng.shuffle(free)
+    allowed = rules.allowed
+    pick = rng.random
+    for santa in order:
+        chosen = -1
+        for _ in range(min(greedy_tries,len(free))):
+            index = int(pick() * len(free))
+            if allowed(santa,free[index]):
+                chosen = index
+                break
+        if chosen == -1:
+            chosen = rules.first_allowed(santa,free)
+        if chosen == -1:
+            # left for the augmenting path search.
+            continue
+        giftee = free[chosen]
+        free[chosen] = free[-1]
+        free.pop()
+        giftee_of[santa] = giftee
+        santa_of[giftee] = santa
+    return giftee_of,santa_of
+
+def __augment(rules:_Rules,start:int,giftee_of:list,santa_of:list):
+    """
+    Breadth first search for a path from an unmatched santa to a free giftee,
+    alternating allowed pairs and matched pairs, then flip the path.
+
+    The allowed pairs are never listed: each santa takes the giftees not yet reached,
+    any it is allowed are reached and the rest are kept for the next santa.
+    Giftees are reached once and a giftee is only kept when the santa has a rule
+    against it, so one search costs people plus exclusions. Both are set operations
+    so the work for each giftee is done in C.
+
+    :returns: None when matched, or when no path exists the santas searched and the
+        number of giftees they can reach between them.
+    """
+    parent = {}
+    unreached = set(range(rules.count))
+    queue = [start]
+    searched = 0
+    while searched < len(queue):
+        santa = queue[searched]
+        searched += 1
+        kept = unreached & rules.excluded(santa)
+        group = rules.groups[santa]
+        if group is not None:
+            kept |= unreached & rules.group_members[group]
+        for giftee in unreached - kept:
+            parent[giftee] = santa
+            if santa_of[giftee] == -1:
+                # free giftee, flip the matched pairs back along the path.
+                while giftee != -1:
+                    santa = parent[giftee]
+                    previous = giftee_of[santa]
+                    giftee_of[santa] = giftee
+                    santa_of[giftee] = santa
+                    giftee = previous
+                return None
+            queue.append(santa_of[giftee])
+        unreached = kept
+    return queue,len(parent)
+
+def __cycles(giftee_of:list):
+    seen = [False] * len(giftee_of)
+    cycles = []
+    for start in range(len(giftee_of)):
+        if seen[start]:
+            continue
+        cycle = []
+        person = start
+        while not seen[person]:
+            seen[person] = True
+            cycle.append(person)
+            person = giftee_of[person]
+        cycles.append(cycle)
+    return cycles
+
+def __join_cycles(rules:_Rules,giftee_of:list,rng):
+    """
+    Join cycles into the largest one by swapping giftees between a person in each,
+    swapping the giftees of two people in different cycles makes one cycle of the two.
+
+    :returns: number of cycles left.
+    """
+    cycles = __cycles(giftee_of)
+    cycles.sort(key=len,reverse=True)
+    main = cycles[0]
+    left = 1
+    for cycle in cycles[1:]:
+        joined = False
+        for _ in range(merge_tries):
+            a = main[rng.randrange(len(main))]
+            b = cycle[rng.randrange(len(cycle))]
+            if rules.allowed(a,giftee_of[b]) and rules.allowed(b,giftee_of[a]):
+                giftee_of[a],giftee_of[b] = giftee_of[b],giftee_of[a]
+                main.extend(cycle)
+                joined = True
+                break
+        if not joined:
+            left += 1
+    return left
+
+def draw(people:list,exclusions=(),groups:dict=None,single_cycle:bool=True,rng=None):
+    """
+    Draw a giftee for every person.
+
+    :param people: ids of everyone in the draw.
+    :param exclusions: (santa id, giftee id) pairs that must not be drawn.
+    :param groups: id -> group name, people in the same group never draw each other.
+    :param single_cycle: join the draw into one chain where the exclusions allow it.
+    :param rng: random.Random to use, the random module by default.
+    :returns: dict with assignments, a list of (santa id, giftee id), and stats about the draw.
+    :raises SantaErrors.DrawImpossible: if no draw meets the exclusions.
+    """
+    # the draw makes no reference cycles, but every collection while it runs would walk
+    # the whole exclusion set, millions of pairs.
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        return __draw(people,exclusions,groups,single_cycle,rng)
+    finally:
+        if collecting:
+            gc.enable()
+
+def __draw(people:list,exclusions,groups:dict,single_cycle:bool,rng):
+    if rng is None:
+        rng = random
+    start_time = time.perf_counter()
+
+    count = len(people)
+    if count < 2:
+        raise SantaErrors.DrawImpossible("A draw needs at least 2 people.")
+    index_of = {person:index for index,person in enumerate(people)}
+    if len(index_of) != count:
+        raise SantaErrors.DrawImpossible("The same person is in the draw more than once.")
+
+    group_list = [None] * count
+    if groups:
+        for person,group in groups.items():
+            if person in index_of:
+                group_list[index_of[person]] = group
+    if hasattr(exclusions,'__len__') and len(exclusions) * dense_exclusions > count * count:
+        pairs = None
+        rows = [{santa} for santa in range(count)]
+        position = index_of.get
+        for santa,giftee in exclusions:
+            santa = position(santa)
+            giftee = position(giftee)
+            # rules about people not in the draw do not matter.
+            if santa is not None and giftee is not None:
+                rows[santa].add(giftee)
+        rules = _Rules(people,index_of,None,group_list,rows)
+        exclusion_count = sum(len(row) - 1 for row in rows)
+    else:
+        try:
+            pairs = exclusions if isinstance(exclusions,(set,frozenset)) else set(exclusions)
+        except TypeError:
+            # pairs given as lists.
+            pairs = set(map(tuple,exclusions))
+        # rules about people not in the draw are never looked at.
+        rules = _Rules(people,index_of,pairs,group_list)
+        exclusion_count = len(pairs)
+
+    # a group with more than half the people cannot all be given someone outside it.
+    for group,size in rules.group_sizes.items():
+        if size > count - size:
+            raise SantaErrors.DrawImpossible("Group {} has {} of the {} people, no group can have more than half.".format(group,size,count))
+
+    giftee_of,santa_of = __greedy_match(rules,rng)
+    augmented = 0
+    for santa in range(count):
+        if giftee_of[santa] != -1:
+            continue
+        stuck = __augment(rules,santa,giftee_of,santa_of)
+        if stuck is not None:
+            santas,reached = stuck
+            names = ', '.join(str(people[x]) for x in santas[:10])
+            raise SantaErrors.DrawImpossible("No draw is possible with these exclusions, {} people ({}{}) can only be santa for {} others between them.".format(
+                len(santas),names,', ...' if len(santas) > 10 else '',reached))
+        augmented += 1
+
+    if single_cycle:
+        cycles = __join_cycles(rules,giftee_of,rng)
+    else:
+        cycles = len(__cycles(giftee_of))
+
+    # everything is checked once more, a bad draw must never be saved.
+    assignments = list(zip(people,map(people.__getitem__,giftee_of)))
+    valid = sorted(giftee_of) == list(range(count))
+    if valid and pairs is None:
+        valid = all(map(rules.allowed,range(count),giftee_of))
+    elif valid:
+        valid = pairs.isdisjoint(assignments) and not any(santa == giftee for santa,giftee in enumerate(giftee_of))
+        if valid and rules.group_sizes:
+            valid = not any(group is not None and group == group_list[giftee] for group,giftee in zip(group_list,giftee_of))
+    if not valid:
+        raise SantaErrors.GameStateError("Draw engine produced an invalid draw.")
+
+    return {
+        'assignments': assignments,
+        'people': count,
+        'exclusions': exclusion_count,
+        'augmented': augmented,
+        'cycles': cycles,
+        'time': time.perf_counter() - start_time,
+    }
+
+def __take_ideas(account,wanted:int,taken:list,heap:list,buckets:dict,rng,distinct:bool):
+    """
+    Take ideas for one person from the submitters with the most ideas left.
+    Only one heap entry per submitter is popped, so this is a few heap operations per idea.
+    """
+    used = {x[1] for x in taken} if taken else set()
+    passed = []
+    while len(taken) < wanted and heap:
+        entry = heapq.heappop(heap)
+        left,_,submitter = entry
+        if (submitter is not None and submitter == account) or (distinct and submitter in used):
+            passed.append(entry)
+            continue
+        taken.append((buckets[submitter].pop(),submitter))
+        used.add(submitter)
+        if left + 1 < 0:
+            passed.append((left + 1,rng.random(),submitter))
+    for entry in passed:
+        heapq.heappush(heap,entry)
+
+def __swap_for_idea(account,taken:list,served:list,allocated:list,accounts:list,heap:list,buckets:dict,rng,distinct:bool):
+    """
+    Give a person one of the ideas someone else already has, in exchange for an idea
+    left in the pool that the other person can have. Used when only the person's own
+    ideas are left.
+    """
+    if not heap or len(served) == 0:
+        return False
+    left,_,submitter = heap[0]
+    used = {x[1] for x in taken}
+    for _ in range(merge_tries):
+        other = served[rng.randrange(len(served))]
+        if (submitter is not None and submitter == accounts[other]):
+            continue
+        other_ideas = allocated[other]
+        for position,(idea,other_submitter) in enumerate(other_ideas):
+            if other_submitter == account and account is not None:
+                continue
+            if distinct and (other_submitter in used or any(x[1] == submitter for x in other_ideas)):
+                continue
+            heapq.heappop(heap)
+            other_ideas[position] = (buckets[submitter].pop(),submitter)
+            if left + 1 < 0:
+                heapq.heappush(heap,(left + 1,rng.random(),submitter))
+            taken.append((idea,other_submitter))
+            return True
+    return False
+
+def allocate_ideas(people:list,ideas:list,per_person:int=2,rng=None):
+    """
+    Give each person a number of ideas, never one they submitted themselves.
+
+    Ideas are taken from the submitters with the most ideas left, each person gets
+    ideas from different submitters when there are enough, so every submitter's ideas
+    are spread over many people. Each idea taken is a couple of heap operations on the
+    submitters, so the time is close to linear in the number of ideas.
+
+    Ideas that are not given out are left over, as before.
+
+    :param people: (person id, account id) for everyone in the draw.
+    :param ideas: (idea id, account id of the submitter) for every idea, None if the submitter is unknown.
+    :param per_person: ideas for each person.
+    :returns: dict with assignments, a list of (idea id, person id), and stats about the allocation.
+    """
+    if rng is None:
+        rng = random
+    start_time = time.perf_counter()
+
+    # one shuffle of everything leaves each submitter's ideas in a random order.
+    shuffled = list(ideas)
+    rng.shuffle(shuffled)
+    buckets = {}
+    for idea,submitter in shuffled:
+        bucket = buckets.get(submitter)
+        if bucket is None:
+            bucket = buckets[submitter] = []
+        bucket.append(idea)
+    pick = rng.random
+    heap = [(-len(bucket),pick(),submitter) for submitter,bucket in buckets.items()]
+    heapq.heapify(heap)
+
+    order = list(range(len(people)))
+    rng.shuffle(order)
+    accounts = [account for _,account in people]
+    allocated = [[] for _ in people]
+    served = []
+    swapped = 0
+    short = 0
+    for person in order:
+        account = accounts[person]
+        taken = allocated[person]
+        __take_ideas(account,per_person,taken,heap,buckets,rng,True)
+        if len(taken) < per_person:
+            # not enough submitters left, allow a second idea from the same one.
+            __take_ideas(account,per_person,taken,heap,buckets,rng,False)
+        while len(taken) < per_person and (
+            __swap_for_idea(account,taken,served,allocated,accounts,heap,buckets,rng,True) or
+            __swap_for_idea(account,taken,served,allocated,accounts,heap,buckets,rng,False)):
+            swapped += 1
+        if len(taken) < per_person:
+            short += 1
+        served.append(person)
+
+    return {
+        'assignments': [(idea,people[person][0]) for person,taken in enumerate(allocated) for idea,_ in taken],
+        'people': len(people),
+        'ideas': len(ideas),
+        'left_over': sum(len(x) for x in buckets.values()),
+        'swapped': swapped,
+        'short': short,
+        'time': time.perf_counter() - start_time,
+    }
+
+def benchmark(people:int,exclusions_per_person:int=0,group_size:int=0,seed:int=1):
+    """
+    Time a draw of made up people with random exclusions and groups.
+    """
+    rng = random.Random(seed)
+    ids = list(range(1,people + 1))
+    pick = rng.random
+    exclusions = [(person,int(pick() * people) + 1) for person in ids for _ in range(exclusions_per_person)]
+    groups = {person:person // group_size for person in ids} if group_size else None
+    return draw(ids,exclusions,groups,rng=rng)
+
+def benchmark_tight(people:int,allowed_per_person:int=3,seed:int=1):
+    """
+    Time a draw where everyone is excluded from all but a few giftees, one of them their giftee
+    in a hidden draw so a draw exists. Random picks nearly always fail, so most people are
+    matched by the augmenting path search.
+    """
+    rng = random.Random(seed)
+    ids = list(range(1,people + 1))
+    hidden = ids[:]
+    rng.shuffle(hidden)
+    allowed = {hidden[i]:{hidden[(i + 1) % people]} for i in range(people)}
+    for person in ids:
+        while len(allowed[person]) < min(allowed_per_person,people - 1):
+            giftee = rng.randint(1,people)
+            if giftee != person:
+                allowed[person].add(giftee)
+    exclusions = [(person,giftee) for person in ids for giftee in ids if giftee != person and giftee not in allowed[person]]
+    return draw(ids,exclusions,rng=rng)
+
+def benchmark_ideas(people:int,submitted_per_person:int=3,per_person:int=2,seed:int=1):
+    """
+    Time an idea allocation where everyone submitted ideas, some far more than others.
+    """
+    rng = random.Random(seed)
+    accounts = list(range(1,people + 1))
+    ideas = []
+    for account in accounts:
+        # a few people submit a lot of the ideas.
+        count = submitted_per_person * 10 if account % 50 == 0 else submitted_per_person
+        ideas.extend((len(ideas) + x,account) for x in range(count))
+    return allocate_ideas([(account,account) for account in accounts],ideas,per_person,rng=rng)
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['ideas']:
+        args = [int(x) for x in sys.argv[2:]]
+        runs = [tuple(args)] if args else [(1000,3,2),(100000,3,2),(100000,2,2),(50000,5,4)]
+        for run in runs:
+            result = benchmark_ideas(*run)
+            print("people={} ideas={}: {:.3f}s, {} swapped, {} short, {} left over".format(
+                result['people'],result['ideas'],result['time'],result['swapped'],result['short'],result['left_over']))
+    elif sys.argv[1:2] == ['tight']:
+        args = [int(x) for x in sys.argv[2:]]
+        runs = [tuple(args)] if args else [(300,3),(1000,3),(2000,2)]
+        for run in runs:
+            result = benchmark_tight(*run)
+            print("people={} exclusions={} allowed {}: {:.3f}s, {} augmented, {} cycles".format(
+                result['people'],result['exclusions'],run[1] if len(run) > 1 else 3,result['time'],result['augmented'],result['cycles']))
+    else:
+        args = [int(x) for x in sys.argv[1:]]
+        runs = [tuple(args)] if args else [(1000,0,0),(50000,0,0),(50000,20,0),(50000,20,50),(50000,200,1000),(2000,900,0)]
+        for run in runs:
+            result = benchmark(*run)
+            print("people={} exclusions={} groups of {}: {:.3f}s, {} augmented, {} cycles".format(
+                result['people'],result['exclusions'],run[2] if len(run) > 2 else 0,result['time'],result['augmented'],result['cycles']))
@@ -0,0 +1,185 @@
+"""
+Admin export of games, users, ideas and identities as NDJSON or CSV.
+
+Rows are read from server side cursors and written out in chunks as they are read, so
+memory use stays the same for any size of table. Exports can be streamed over http
+with /export or written to files from the command line:
+
+    python santaexport.py <directory> [ndjson|csv] [redact] [table ...]
+
+The admin key is read from AdminSecret. Files are written as <directory>/<table>.<format>,
+all tables are read from one snapshot of the database.
+
+A redacted export replaces emails and names (dbcommon.redacted_columns) with a keyed hash,
+the same value gets the same hash within one export so rows can still be matched up,
+but the key is random for each export so hashes can't be matched between exports.
+"""
+
+import csv
+import hashlib
+import hmac
+import io
+import json
+import os
+import sys
+import time
+
+import database
+import dbcommon
+
+# tables that can be exported, in the order they are written.
+tables = list(dbcommon.export_columns)
+
+# mime type and file extension of each format.
+formats = {
+    'ndjson': ('application/x-ndjson','ndjson'),
+    'csv': ('text/csv','csv'),
+}
+
+__chunk_size = 65536
+__batch_size = int(os.environ.get('EXPORT_BATCH',5000))
+
+class ExportStats:
+    """
+    Row counts and rates of an export, by table.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.tables = {}
+
+    def add(self,table:str,rows:int):
+        self.tables[table] = self.tables.get(table,0) + rows
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start
+        rows = sum(self.tables.values())
+        return {
+            'tables': dict(self.tables),
+            'rows': rows,
+            'seconds': round(elapsed,3),
+            'rows_per_second': round(rows / elapsed,1) if elapsed > 0 else 0.0,
+        }
+
+def __redactor(table:str,redact:bool,key:bytes):
+    """
+    Function that redacts a row tuple of a table, or None when nothing is redacted.
+    """
+    if not redact or table not in dbcommon.redacted_columns:
+        return None
+    columns = dbcommon.export_columns[table]
+    indexes = [columns.index(column) for column in dbcommon.redacted_columns[table]]
+    # copying a keyed hash is quicker than setting up the key for every value.
+    keyed_hash = hmac.new(key,digestmod=hashlib.sha256)
+    def redact_row(row):
+        row = list(row)
+        for index in indexes:
+            if row[index] is not None:
+                value_hash = keyed_hash.copy()
+                value_hash.update(str(row[index]).encode('utf-8'))
+                row[index] = value_hash.hexdigest()[:16]
+        return row
+    return redact_row
+
+def __format_rows(table_rows,file_format:str,redact:bool,stats:ExportStats):
+    """
+    Turn (table, row) pairs into chunks of text, starting a new output (and csv header)
+    whenever the table changes. Yields (table, chunk) pairs.
+    """
+    key = os.urandom(32)
+    table = None
+    redact_row = None
+    buffer = io.StringIO()
+    writer = None
+    count = 0
+    for row_table,row in table_rows:
+        if row_table != table:
+            if table is not None:
+                yield table,buffer.getvalue()
+                stats.add(table,count)
+            table = row_table
+            columns = dbcommon.export_columns[table]
+            redact_row = __redactor(table,redact,key)
+            buffer = io.StringIO()
+            count = 0
+            if file_format == 'csv':
+                writer = csv.writer(buffer,lineterminator='\n')
+                writer.writerow(columns)
+        if redact_row is not None:
+            row = redact_row(row)
+        if file_format == 'csv':
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(dict(zip(columns,row)),default=str))
+            buffer.write('\n')
+        count += 1
+        if buffer.tell() >= __chunk_size:
+            yield table,buffer.getvalue()
+            stats.add(table,count)
+            count = 0
+            buffer.seek(0)
+            buffer.truncate()
+    if table is not None:
+        yield table,buffer.getvalue()
+        stats.add(table,count)
+
+def export_table(admin_key:str,table:str,file_format:str='ndjson',redact:bool=False,stats:ExportStats=None):
+    """
+    Generator of text chunks of one table, for a streamed http response.
+    Check the table and format before starting, errors part way through the table are raised from the generator.
+    """
+    stats = stats if stats is not None else ExportStats()
+    empty = True
+    for _,chunk in __format_rows(database.iter_tables(admin_key,[table],batch_size=__batch_size),file_format,redact,stats):
+        empty = False
+        yield chunk
+    if empty and file_format == 'csv':
+        yield ','.join(dbcommon.export_columns[table]) + '\n'
+
+def export_to_directory(admin_key:str,directory:str,file_format:str='ndjson',redact:bool=False,tables:list=None):
+    """
+    Write each table to <directory>/<table>.<format>, returns the export summary.
+    """
+    tables = tables if tables else list(dbcommon.export_columns)
+    extension = formats[file_format][1]
+    os.makedirs(directory,exist_ok=True)
+    stats = ExportStats()
+    files = {}
+    try:
+        for table,chunk in __format_rows(database.iter_tables(admin_key,tables,batch_size=__batch_size),file_format,redact,stats):
+            if table not in files:
+                files[table] = open(os.path.join(directory,"{}.{}".format(table,extension)),'w',encoding='utf-8',newline='')
+            files[table].write(chunk)
+    finally:
+        for export_file in files.values():
+            export_file.close()
+    # tables without rows still get a file, with a header for csv.
+    for table in tables:
+        if table not in files:
+            with open(os.path.join(directory,"{}.{}".format(table,extension)),'w',encoding='utf-8',newline='') as export_file:
+                if file_format == 'csv':
+                    csv.writer(export_file,lineterminator='\n').writerow(dbcommon.export_columns[table])
+            stats.add(table,0)
+    return stats.summary()
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("usage: python santaexport.py <directory> [ndjson|csv] [redact] [table ...]")
+        sys.exit(1)
+    file_format = 'ndjson'
+    redact = False
+    export_tables = []
+    for arg in sys.argv[2:]:
+        if arg in formats:
+            file_format = arg
+        elif arg == 'redact':
+            redact = True
+        elif arg in dbcommon.export_columns:
+            export_tables.append(arg)
+        else:
+            print("Unknown format or table {}, tables are {}".format(arg,', '.join(tables)))
+            sys.exit(1)
+    summary = export_to_directory(os.environ.get('AdminSecret',''),sys.argv[1],file_format,redact,export_tables)
+    for table,rows in summary['tables'].items():
+        print("{}: {} rows".format(table,rows))
+    print("{rows} rows in {seconds}s, {rows_per_second} rows/s".format(**summary))
@@ -0,0 +1,123 @@
+"""
+Admin restore of games, users, ideas and identities from a santaexport directory.
+
+    python santaimport.py <directory>
+
+Reads <directory>/<table>.ndjson or <table>.csv for every table and replaces the contents of
+the tables with them in one transaction, see database.bulk_import. Rows are streamed into
+COPY as they are read, so memory use stays the same for any size of export.
+
+The admin key is read from AdminSecret, and AllowTableTruncates must be set as the
+existing rows are removed. Sessions, exclusions, draw jobs and result email progress are cleared.
+
+A csv export can't tell null from empty text, both are imported as null. Use ndjson
+for an exact restore.
+"""
+
+import csv
+import io
+import json
+import os
+import sys
+
+import database
+import dbcommon
+
+class NdjsonToCsv:
+    """
+    File like object that reads an ndjson export as csv rows for COPY, a line at a time.
+
+    Nulls are written as unquoted empty values and all text is quoted, so COPY
+    keeps the difference between null and empty text.
+    """
+
+    def __init__(self,source,columns:list,first_line:str=None):
+        self.source = source
+        self.columns = columns
+        self._pending = [first_line] if first_line else []
+        self._buffer = ''
+
+    def __format_value(self,value):
+        if value is None:
+            return ''
+        if isinstance(value,bool):
+            return 'true' if value else 'false'
+        if isinstance(value,(int,float)):
+            return str(value)
+        return '"' + str(value).replace('"','""') + '"'
+
+    def __row(self,line:str):
+        row = json.loads(line)
+        return ','.join([self.__format_value(row.get(column)) for column in self.columns]) + '\n'
+
+    def __next_line(self):
+        if self._pending:
+            return self._pending.pop()
+        return self.source.readline()
+
+    def read(self,size:int=-1):
+        while size < 0 or len(self._buffer) < size:
+            line = self.__next_line()
+            if not line:
+                break
+            if line.strip():
+                self._buffer += self.__row(line)
+        if size < 0:
+            size = len(self._buffer)
+        chunk,self._buffer = self._buffer[:size],self._buffer[size:]
+        return chunk
+
+    def readline(self):
+        line = self.__next_line()
+        while line and not line.strip():
+            line = self.__next_line()
+        return self.__row(line) if line else ''
+
+    def __iter__(self):
+        return iter(self.readline,'')
+
+def open_table(directory:str,table:str):
+    """
+    Open the export file of a table, returns (columns, csv stream without a header, file to close.)
+    """
+    ndjson_path = os.path.join(directory,"{}.ndjson".format(table))
+    csv_path = os.path.join(directory,"{}.csv".format(table))
+    if os.path.exists(ndjson_path):
+        import_file = open(ndjson_path,'r',encoding='utf-8')
+        first_line = import_file.readline()
+        while first_line and not first_line.strip():
+            first_line = import_file.readline()
+        columns = list(json.loads(first_line)) if first_line else list(dbcommon.export_columns[table])
+        return columns,NdjsonToCsv(import_file,columns,first_line),import_file
+    if os.path.exists(csv_path):
+        import_file = open(csv_path,'r',encoding='utf-8',newline='')
+        header = import_file.readline()
+        columns = next(csv.reader(io.StringIO(header))) if header.strip() else list(dbcommon.export_columns[table])
+        return columns,import_file,import_file
+    raise FileNotFoundError("No {table}.ndjson or {table}.csv in {directory}".format(table=table,directory=directory))
+
+def import_from_directory(admin_key:str,directory:str):
+    """
+    Replace all tables with the export in directory, returns the import summary.
+    """
+    files = []
+    try:
+        sources = {}
+        for table in dbcommon.export_columns:
+            columns,source,import_file = open_table(directory,table)
+            files.append(import_file)
+            sources[table] = (columns,source)
+        return database.bulk_import(admin_key,sources)
+    finally:
+        for import_file in files:
+            import_file.close()
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print("usage: python santaimport.py <directory>")
+        sys.exit(1)
+    summary = import_from_directory(os.environ.get('AdminSecret',''),sys.argv[1])
+    for table,rows in summary['tables'].items():
+        print("{}: {} rows".format(table,rows))
+    print("copy {copy}s, check {check}s, swap {swap}s".format(**summary['timings']))
+    print("{rows} rows in {seconds}s, {rows_per_second} rows/s".format(**summary))
@@ -5,14 +5,21 @@ that just reading a writting the database. Ie new game/triggering a draw etc.
 
 import database
 
+import os
 import string
+import datetime
 import random
 import uuid
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import SantaErrors
 from SantaErrors import exception_as_string
+import drawjobs
+import santadraw
 import santamail
+import santatokens
 
 import traceback
 
@@ -26,10 +33,6 @@ def __new_verify(length=6):
     temp_pass = random.choices(__verify_pool,k=length)
     return ''.join(temp_pass)
 
-def __chunks(lst, n):
-    for i in range(0, len(lst), n):
-        yield lst[i:i+n]
-
 def create_pubkey():
     """A new Short key
     """
@@ -66,7 +69,7 @@ def get_game(code):
     if not code:
         raise SantaErrors.EmptyValue('Property code is missing or empty.')
     
-    game_list =  database.get_game({'code':code},properties=['name','state','id'])
+    game_list =  database.get_game({'code':code},properties=['name','state','id','version','modified'])
     if len(game_list) == 0:
         raise SantaErrors.NotFound("Group id was Not Found.")
     if isinstance(game_list,list):
@@ -78,9 +81,11 @@ def update_game_state(code:str,sessionid:str,sessionpassword:str,new_state:int):
     Change the state of a game, moving it forward.
     """
 
+    # authenticate once, the identity is passed on in place of the credentials.
     owner = database.get_authenticated_user(sessionid,sessionpassword)
 
-    current_game = database.get_game({'code':code,'ownerid':owner['id']})
+    # read from the database, the draw may have been saved by another process since the game was cached.
+    current_game = database.get_game({'code':code,'ownerid':owner['id']},cached=False)
     if len(current_game) == 0:
         raise SantaErrors.GameChangeStateError("Game not found or not owned.")
     if isinstance(current_game,list):
@@ -97,7 +102,7 @@ def update_game_state(code:str,sessionid:str,sessionpassword:str,new_state:int):
     elif current_state == 1:
         # a run game
         if new_state == 2:
-            return database.set_game_state(code,sessionid,sessionpassword,new_state)
+            return database.set_game_state(code,owner,None,new_state)
         elif new_state == 1:
             raise SantaErrors.GameChangeStateError("Game already resolved.")
         else:
@@ -106,56 +111,334 @@ def update_game_state(code:str,sessionid:str,sessionpassword:str,new_state:int):
     elif current_state == 0:
         # is a new game
         if new_state == 2:
-            return database.set_game_state(code,sessionid,sessionpassword,new_state)
+            return database.set_game_state(code,owner,None,new_state)
         elif new_state == 0:
             raise SantaErrors.GameChangeStateError("Game already open.")
         elif new_state == 1:
-            return __run_game(code,sessionid,sessionpassword)
+            if draw_queue is not None:
+                return __queue_draw(code,owner)
+            return __run_game(code,owner)
     else:
         raise SantaErrors.GameStateError("Game in unknown state {}, cannot change state.".format(str(current_state)))
 
-def __run_game(code:str,sessionid:str,sessionpassword:str):
-    # game has two parts, ideas, santas
-    # each user is given another user to be santa of
-    # each user is also given two unique ideas from the idea pool
-    
-    owner = database.get_authenticated_user(sessionid,sessionpassword)
-
+def __draw_players(code:str,owner:database.Identity):
+    """
+    Users and ideas of a game, checking there are enough of them to draw.
+    """
     #all users
-    all_users = database.get_users_in_game(code,sessionid,sessionpassword)
+    all_users = database.get_users_in_game(code,owner,None)
     if len(all_users) < 2:
         raise SantaErrors.GameChangeStateError("game requires more than 2 users to run.")
 
     # get ideas
-    all_ideas = database.get_game_ideas(code,sessionid,sessionpassword)
-    if len(all_ideas) < len(all_users) * 2:
-        raise SantaErrors.GameChangeStateError("game requires at least 2 ideas per user")
+    ideas_per_user = int(os.environ.get('DRAW_IDEAS_PER_USER',2))
+    all_ideas = database.get_game_ideas(code,owner,None)
+    if len(all_ideas) < len(all_users) * ideas_per_user:
+        raise SantaErrors.GameChangeStateError("game requires at least {} ideas per user".format(ideas_per_user))
+    return all_users,all_ideas,ideas_per_user
 
-    # assing users to santa's
-    random.shuffle(all_users)
+def __run_game(code:str,owner:database.Identity):
+    # game has two parts, ideas, santas
+    # each user is given another user to be santa of
+    # each user is also given unique ideas from the idea pool, none of their own
+    start_time = time.perf_counter()
+
+    all_users,all_ideas,ideas_per_user = __draw_players(code,owner)
+
+    # assing users to santa's, keeping to any exclusions the owner has set.
+    exclusions = [(x['userid'],x['excluded']) for x in database.get_exclusions(code,owner,None)]
+    groups = {x['id']:x['draw_group'] for x in all_users if x.get('draw_group')}
+    draw = santadraw.draw(
+        [x['id'] for x in all_users],
+        exclusions,
+        groups,
+        single_cycle=os.environ.get('DRAW_SINGLE_CYCLE','1') == '1',
+    )
+    santa_assignments = draw['assignments']
+
+    allocation = santadraw.allocate_ideas(
+        [(x['id'],x.get('account_id')) for x in all_users],
+        [(x['id'],x.get('account_id')) for x in all_ideas],
+        ideas_per_user,
+    )
+    idea_assignments = allocation['assignments']
+    if allocation['short'] > 0:
+        print("Gamerun: {gameid}, {short} users were given fewer than {count} ideas.".format(gameid=code,short=allocation['short'],count=ideas_per_user))
+
+    # all assignments and the state change are saved together, so a failure leaves the game open.
     try:
-        last_user = all_users[-1]
-        for user in all_users:
-            database.set_user_santa(user['id'], last_user['id'],code,sessionid,sessionpassword)
-            last_user = user
+        database.draw_game(code,santa_assignments,idea_assignments,owner,None)
     except Exception as e:
-        print("Gamerun: {gameid}, User update failure: {exception}".format(gameid=code,exception=exception_as_string(e)))
-        raise SantaErrors.GameChangeStateError("Unable to assign santas.")
+        print("Gamerun: {gameid}, Draw update failure: {exception}".format(gameid=code,exception=exception_as_string(e)))
+        raise SantaErrors.GameChangeStateError("Unable to assign santas and ideas.")
+
+    print("Gamerun: {gameid}, Complete, {users} users, {ideas} ideas, {exclusions} exclusions, {cycles} cycles in {time:.3f}s".format(
+        gameid=code,
+        users=len(santa_assignments),
+        ideas=len(idea_assignments),
+        exclusions=draw['exclusions'],
+        cycles=draw['cycles'],
+        time=time.perf_counter() - start_time,
+    ))
+
+    if os.environ.get('DRAW_NOTIFY','0') == '1':
+        # a failure to email should not fail the draw, the results can still be fetched.
+        try:
+            santamail.send_draw_results(code,database.get_draw_results(code,owner,None))
+        except Exception as e:
+            print("Gamerun: {gameid}, Notify failure: {exception}".format(gameid=code,exception=exception_as_string(e)))
 
-    random.shuffle(all_ideas)
-    idea_chunks = list(__chunks(all_ideas,2))
+    return {
+        'users': len(santa_assignments),
+        'ideas': len(idea_assignments),
+    }
+
+def schedule_game(code:str,draw_date:str,sessionid:str,sessionpassword:str):
+    """
+    Set when an open game should be drawn by the admin bulk draw, an empty date removes the schedule.
+    """
+
+    if (len(code) == 0):
+        raise SantaErrors.EmptyValue("Group code is empty.")
+
+    parsed_date = None
+    if draw_date:
+        try:
+            parsed_date = datetime.datetime.fromisoformat(draw_date)
+        except ValueError:
+            raise SantaErrors.GameChangeStateError("draw_date must be an ISO date and time, i.e. 2020-12-01T09:00:00.")
+        if parsed_date.tzinfo is not None:
+            # stored as utc without a zone, like the other dates.
+            parsed_date = parsed_date.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+    result = database.set_draw_date(code,parsed_date,sessionid,sessionpassword)
+    if isinstance(result,list):
+        result = result[0]
+    return {
+        'code': result['code'],
+        'draw_date': result['draw_date'].isoformat() if result['draw_date'] else None,
+    }
+
+def __draw_one(game:dict):
+    """
+    Draw a game for the admin bulk draw, errors are reported in the result instead of raised.
+    """
+    start_time = time.perf_counter()
+    result = {'code':game['code'],'status':'done'}
     try:
-        for i in range(0, len(all_users)):
-            for j in idea_chunks[i]:
-                database.set_idea_user(j['id'],all_users[i]['id'],code,sessionid,sessionpassword)
+        # the draw is done as the owner, so all the owner checks still apply.
+        owner = database.Identity({'id':game['ownerid']},None)
+        result.update(__run_game(game['code'],owner))
+    except SantaErrors.PublicError as e:
+        result['status'] = 'failed'
+        result['error'] = str(e)
     except Exception as e:
-        print("Gamerun: {gameid}, Idea update failure: {exception}".format(gameid=code,exception=exception_as_string(e)))
-        raise SantaErrors.GameChangeStateError("Unable to assign ideas")
-    
-    database.set_game_state(code,sessionid,sessionpassword,1)
+        print("Bulk draw: {gameid}, Error: {exception}".format(gameid=game['code'],exception=exception_as_string(e)))
+        result['status'] = 'failed'
+        result['error'] = "Internal Error"
+    result['time'] = round(time.perf_counter() - start_time,3)
+    return result
+
+def draw_games(admin_key:str,codes:list=None,ids:list=None,due:bool=False):
+    """
+    Draw many open games at once on a pool of worker threads, admin only.
+    Each game is drawn and saved in its own transaction, so one failure does not affect the others.
+
+    :param codes: only draw games with these codes.
+    :param ids: only draw games with these ids.
+    :param due: only draw games with a draw_date that has passed.
+    """
+
+    database.check_admin_key(admin_key)
+    start_time = time.perf_counter()
+
+    if due:
+        games = database.get_due_games(admin_key)
+    else:
+        games = database.get_all_open_games(admin_key)
+    if codes:
+        wanted_codes = set(codes)
+        games = [x for x in games if x['code'] in wanted_codes]
+    if ids:
+        wanted_ids = set(ids)
+        games = [x for x in games if x['id'] in wanted_ids]
+
+    results = []
+    if len(games) > 0:
+        # each worker holds a database connection while drawing, so keep this under DB_POOL_MAX.
+        workers = min(int(os.environ.get('DRAW_WORKERS',4)),len(games))
+        with ThreadPoolExecutor(max_workers=workers,thread_name_prefix='bulk-draw') as executor:
+            results = list(executor.map(__draw_one,games))
+
+    total_time = time.perf_counter() - start_time
+    drawn = len([x for x in results if x['status'] == 'done'])
+    print("Bulk draw: {drawn} of {total} games drawn in {time:.3f}s".format(drawn=drawn,total=len(results),time=total_time))
+    return {
+        'games': results,
+        'drawn': drawn,
+        'failed': len(results) - drawn,
+        'time': round(total_time,3),
+        'games_per_second': round(len(results) / total_time,2) if total_time > 0 else 0,
+    }
+
+def __run_draw_job(job:dict):
+    """
+    Run a queued draw as the owner of the game.
+    """
+    game = database.get_game({'code':job['code'],'ownerid':job['ownerid']},properties=['state'],cached=False)
+    if len(game) == 0:
+        raise SantaErrors.NotFound("Group not found.")
+    if game[0]['state'] == 1 and job['attempts'] > 1:
+        # a worker stopped after the draw was saved, it doesn't need running again.
+        return {}
+    if game[0]['state'] != 0:
+        raise SantaErrors.GameChangeStateError("Game is not open.")
+    try:
+        return __run_game(job['code'],database.Identity({'id':job['ownerid']},None))
+    except SantaErrors.GameChangeStateError:
+        if job['attempts'] > 1:
+            # an earlier attempt may have still been running and saved the draw first.
+            game = database.get_game({'code':job['code'],'ownerid':job['ownerid']},properties=['state'],cached=False)
+            if len(game) > 0 and game[0]['state'] == 1:
+                return {}
+        raise
+
+# draw jobs, database (default), memory or off to draw during the request.
+# memory jobs are lost on restart and only known to the process that queued them.
+__draw_job_mode = os.environ.get('DRAW_JOBS','database').lower()
+if __draw_job_mode == 'database':
+    # with a worker process (drawworker.py) set DRAW_JOB_WORKERS to 0 so web processes only queue.
+    draw_queue = drawjobs.DrawQueue(__run_draw_job,drawjobs.DatabaseStore(),workers=int(os.environ.get('DRAW_JOB_WORKERS',2)))
+elif __draw_job_mode == 'memory':
+    draw_queue = drawjobs.DrawQueue(__run_draw_job,drawjobs.MemoryStore(),workers=max(1,int(os.environ.get('DRAW_JOB_WORKERS',2))))
+else:
+    draw_queue = None
+
+def __queue_draw(code:str,owner:database.Identity):
+    # the owner and state are checked by update_game_state, a group that is too small fails now rather than in the queue.
+    __draw_players(code,owner)
+    job = draw_queue.submit(str(uuid.uuid4()),code,owner['id'])
+    return {
+        'job': job['id'],
+        'job_state': job['state'],
+    }
+
+def __job_time(epoch):
+    if epoch is None:
+        return None
+    return datetime.datetime.utcfromtimestamp(epoch).isoformat()
+
+def get_draw_job(job_id:str):
+    """
+    State of a queued draw.
+    """
+    if not job_id:
+        raise SantaErrors.EmptyValue("Property job is missing or empty.")
+    try:
+        uuid.UUID(job_id)
+    except ValueError:
+        raise SantaErrors.NotFound("Draw job was Not Found.")
+    if draw_queue is None:
+        raise SantaErrors.NotFound("Draws are not queued on this server.")
+    job = draw_queue.status(job_id)
+    if job is None:
+        raise SantaErrors.NotFound("Draw job was Not Found.")
+    return {
+        'job': job['id'],
+        'code': job['code'],
+        'state': job['state'],
+        'error': job['error'],
+        'users': job['users'],
+        'ideas': job['ideas'],
+        'queued': __job_time(job['queued_time']),
+        'started': __job_time(job['started_time']),
+        'finished': __job_time(job['finished_time']),
+    }
+
+def draw_job_stats():
+    """
+    Depth and timings of the draw queue, empty if draws are not queued.
+    """
+    if draw_queue is None:
+        return {}
+    return draw_queue.stats()
+
 
-    print("Gamerun: {gameid}, Complete".format(gameid=code))
+def set_game_exclusions(code:str,pairs:list,groups:list,previous_code:str,sessionid:str,sessionpassword:str):
+    """
+    Replace the draw exclusions of an open game, owner only.
+    Users are given by their join name, as listed by /game/listuser.
+
+    :param pairs: lists of two names that will not be drawn for each other.
+    :param groups: lists of names, no one is drawn for someone in the same group.
+    :param previous_code: an earlier drawn game, no one is drawn for the same person again.
+    """
 
+    if (len(code) == 0):
+        raise SantaErrors.EmptyValue("Group code is empty.")
+
+    owner = database.get_authenticated_user(sessionid,sessionpassword)
+
+    users = database.get_users_in_game(code,owner,None)
+    if len(users) == 0:
+        raise SantaErrors.NotFound("Group not found, not owned or has no users.")
+    ids_by_name = {}
+    for user in users:
+        ids_by_name.setdefault(user['name'],[]).append(user['id'])
+
+    def user_id(name):
+        found = ids_by_name.get(name,[])
+        if len(found) == 0:
+            raise SantaErrors.NotFound("No one called {} has joined the group.".format(name))
+        if len(found) > 1:
+            raise SantaErrors.Exists("More than one person has joined as {}.".format(name))
+        return found[0]
+
+    exclusions = []
+    for pair in pairs:
+        if len(pair) != 2:
+            raise SantaErrors.EmptyValue("Exclusion pairs must have two names.")
+        first = user_id(pair[0])
+        second = user_id(pair[1])
+        exclusions.append((first,second))
+        exclusions.append((second,first))
+
+    group_of = {}
+    for number,group in enumerate(groups):
+        for name in group:
+            group_of[user_id(name)] = str(number + 1)
+
+    if previous_code:
+        exclusions.extend((x['userid'],x['excluded']) for x in database.get_previous_draw_pairs(previous_code,code,owner,None))
+
+    result = database.set_exclusions(code,exclusions,group_of,owner,None)
+    return {
+        'code':code,
+        'exclusions':result['exclusions'],
+        'grouped':len(group_of),
+    }
+
+def notify_game_results(code:str,sessionid:str,sessionpassword:str):
+    """
+    Email everyone in a drawn game their results, owner only.
+    Returns the progress of the emails, if they have already been sent or are being sent,
+    by any process, the progress is returned without sending again. Failed or stalled
+    sends carry on after the people already emailed.
+    """
+
+    if (len(code) == 0):
+        raise SantaErrors.EmptyValue("Group code is empty.")
+
+    owner = database.get_authenticated_user(sessionid,sessionpassword)
+
+    progress = santamail.draw_results_progress(code)
+    if progress is not None and progress['state'] not in ('failed','stalled'):
+        return progress
+
+    results = database.get_draw_results(code,owner,None)
+    if len(results) == 0:
+        raise SantaErrors.GameStateError("Game not found, not owned or not rolled.")
+    return santamail.send_draw_results(code,results)
 
 def join_game(user_name:str,code:str,sessionid:str,sessionpassword:str):
     """
@@ -195,7 +478,7 @@ def get_game_results(code:str,sessionid:str,sessionpassword:str):
     if (len(code) == 0):
         raise SantaErrors.EmptyValue("Group code is empty.")
     
-    game = database.get_game({'code':code},['state'])
+    game = database.get_game({'code':code},['state'],cached=False)
     if isinstance(game,list):
         game = game[0]
     
@@ -227,16 +510,24 @@ def get_game_results(code:str,sessionid:str,sessionpassword:str):
     raise SantaErrors.GameStateError("Unknown game state.")
 
 
-def list_user_games(sessionid:str,secret:str):
+def __assert_session_id(sessionid):
     """
-    List games joined by user.
+    Check a session id is a uuid, identities have already been checked.
     """
-
+    if isinstance(sessionid,database.Identity):
+        return
     try:
         uuid.UUID(sessionid)
     except ValueError as e:
         raise SantaErrors.SessionError("Session ids must be a uuid format")
 
+def list_user_games(sessionid:str,secret:str):
+    """
+    List games joined by user.
+    """
+
+    __assert_session_id(sessionid)
+
     results = database.list_user_games(sessionid,secret)
     return {
         'grouplist':results,
@@ -247,10 +538,7 @@ def list_owned_games(sessionid:str,secret:str):
     List games joined by user.
     """
 
-    try:
-        uuid.UUID(sessionid)
-    except ValueError as e:
-        raise SantaErrors.SessionError("Session ids must be a uuid format")
+    __assert_session_id(sessionid)
 
     results = database.list_owned_games(sessionid,secret)
     return {
@@ -337,9 +625,16 @@ def verify_session(sessionid:str,code:str,new_secret:str):
         raise SantaErrors.SessionError("Session id or verify code was not found.")
     if isinstance(results,list):
         results = results[0]
-    return {
+    session_result = {
         'session':results['id'],
     }
+    # optional signed token so later calls can skip the password check.
+    session_result.update(santatokens.issue_token(results['id'],{
+        'id':results['identity_id'],
+        'name':results['name'],
+        'email':results['email'],
+    }))
+    return session_result
     
 def remove_session(sessionid:str, secret:str):
     """
@@ -353,6 +648,7 @@ def remove_session(sessionid:str, secret:str):
     results = database.remove_session(sessionid,secret)
     if len(results) == 0:
         raise SantaErrors.SessionError("Session id or verify code was not found.")
+    santatokens.revoke_session(sessionid)
     if isinstance(results,list):
         results = results[0]
     return {
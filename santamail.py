@@ -2,20 +2,65 @@
 Module for sending emails on sign-in etc.
 """
 
+import functools
 import os
-
-# sendgrid module
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from html import escape
 
 import SantaErrors
+import database
+import mailoutbox
+import mailtransport
 
 #templating
 import jinja2
 
-jin_env = jinja2.Environment(loader=jinja2.FileSystemLoader('EmailTemplates/'))
+# template files are only checked for changes when auto reload is on, it defaults to off in prod.
+__template_auto_reload = os.environ.get('TEMPLATE_AUTO_RELOAD','0' if os.environ.get('IS_PROD',0) == '1' else '1') == '1'
+jin_env = jinja2.Environment(
+    loader=jinja2.FileSystemLoader(os.path.join(os.path.dirname(os.path.abspath(__file__)),'EmailTemplates')),
+    auto_reload=__template_auto_reload,
+)
+
+# compile every template file now, so the first email after a restart doesn't pay for it.
+for __template_name in jin_env.list_templates(extensions=['html']):
+    jin_env.get_template(__template_name)
+
+# render counts and times per template.
+__render_stats = {}
+__render_stats_lock = threading.Lock()
 
-if 'SENDGRIDAPIKEY' not in os.environ:
+def __record_render(name:str,render_time:float):
+    with __render_stats_lock:
+        stats = __render_stats.setdefault(name,{'renders':0,'render_time_total':0.0,'render_time_max':0.0})
+        stats['renders'] += 1
+        stats['render_time_total'] += render_time
+        stats['render_time_max'] = max(stats['render_time_max'],render_time)
+
+@functools.lru_cache(maxsize=int(os.environ.get('TEMPLATE_STRING_CACHE',128)))
+def __compile_string_template(string:str):
+    return jin_env.from_string(string)
+
+def template_stats():
+    """
+    Render counts and times for each template, and the string template cache usage.
+    """
+    cache_info = __compile_string_template.cache_info()
+    with __render_stats_lock:
+        return {
+            'auto_reload': __template_auto_reload,
+            'renders': {name:dict(stats) for name,stats in __render_stats.items()},
+            'string_cache': {
+                'hits': cache_info.hits,
+                'misses': cache_info.misses,
+                'size': cache_info.currsize,
+                'max_size': cache_info.maxsize,
+            },
+        }
+
+if os.environ.get('MAIL_TRANSPORT','sendgrid').lower() == 'sendgrid' and 'SENDGRIDAPIKEY' not in os.environ:
     print("SendGrid API key missing, email attempts will fail.")
 
 def __get_sendgrid_api_key():
@@ -26,46 +71,198 @@ def __get_sendgrid_api_key():
         raise SantaErrors.ConfigurationError("Mail API Key empty or missing.")
     return key
 
-def __send_mail_message(message:Mail):
+__from_address = 'secret-santa@em5031.santa.brettle.org.uk'
+
+# one transport for the process, so connections are reused between messages.
+transport = mailtransport.from_environment(__get_sendgrid_api_key)
+
+def __send_mail_message(message:dict):
     try:
-        api_client = SendGridAPIClient(__get_sendgrid_api_key())
-        result = api_client.send(message)
-        print("Email Send: {} {} {}".format(message.personalizations[0].tos[0]['email'],result.status_code,result.body))
+        transport.send(message)
     except Exception as e:
         print("Email Send Error: {}".format(SantaErrors.exception_as_string(e)))
         raise SantaErrors.SessionError("Unable to login at this time.")
 
+def deliver_email(to:str,subject:str,html:str):
+    """
+    Send an already rendered email, exceptions are passed on to the caller.
+    Used by the outbox workers.
+    """
+    transport.send({
+        'from': __from_address,
+        'to': to,
+        'subject': subject,
+        'html': html,
+    })
+
+# outbox mode, database (default), memory or off to send during the request.
+# memory drops mail that hasn't been sent when the process stops.
+__outbox_mode = os.environ.get('MAIL_OUTBOX','database').lower()
+if __outbox_mode == 'database':
+    __outbox_store = mailoutbox.DatabaseStore()
+elif __outbox_mode == 'memory':
+    __outbox_store = mailoutbox.MemoryStore()
+else:
+    __outbox_store = None
+
+if __outbox_store is not None:
+    outbox = mailoutbox.Outbox(
+        deliver_email,
+        __outbox_store,
+        workers=int(os.environ.get('MAIL_WORKERS',2)),
+        max_attempts=int(os.environ.get('MAIL_MAX_ATTEMPTS',5)),
+        backoff=float(os.environ.get('MAIL_RETRY_BACKOFF',2)),
+    )
+else:
+    outbox = None
+
+def outbox_stats():
+    """
+    Queue depth and send latency of the outbox, empty if the outbox is off.
+    """
+    if outbox is None:
+        return {}
+    return outbox.stats()
+
+def transport_stats():
+    """
+    Connections opened and messages sent by the mail transport.
+    """
+    return transport.stats()
+
 def resolve_template_file(filename:str,**template_values):
     """
     resolve a template file with only a specific set of
     values
     """
     real_filename = "{}.html".format(filename)
+    start = time.perf_counter()
     template = jin_env.get_template(real_filename)
-    return template.render(**template_values)
+    result = template.render(**template_values)
+    __record_render(real_filename,time.perf_counter() - start)
+    return result
 
 def resolve_template(string:str,**template_values):
     """
     resolve a template from a string, with only a specific set of values
     """
-    template = jin_env.from_string(string)
-    return template.render(**template_values)
+    start = time.perf_counter()
+    template = __compile_string_template(string)
+    result = template.render(**template_values)
+    __record_render('<string>',time.perf_counter() - start)
+    return result
 
 def send_email(to:str,subject:str,template_name:str,**template_values):
     """
     send an email to an address given, using the given template settings
     """
-    new_email = Mail(
-        from_email='secret-santa@em5031.santa.brettle.org.uk',
-        to_emails=to,
-        subject=subject,
-        html_content=resolve_template_file(template_name,**template_values)
-    )
+    new_email = {
+        'from': __from_address,
+        'to': to,
+        'subject': subject,
+        'html': resolve_template_file(template_name,**template_values),
+    }
     __send_mail_message(new_email)
 
+def queue_email(to:str,subject:str,template_name:str,**template_values):
+    """
+    Queue an email to be sent by the outbox, sends it straight away if the outbox is off.
+    """
+    if outbox is None:
+        return send_email(to,subject,template_name,**template_values)
+    try:
+        outbox.queue(to,subject,resolve_template_file(template_name,**template_values))
+    except Exception as e:
+        print("Email Queue Error: {}".format(SantaErrors.exception_as_string(e)))
+        raise SantaErrors.SessionError("Unable to login at this time.")
+
 def send_logon_email(email:str,display_name:str,code:str):
     """
     Send a logon email with the verification code.
     """
 
-    send_email(email,"New Logon request for Secret Santa.",'NewLogin',name=display_name,code=code)
\ No newline at end of file
+    queue_email(email,"New Logon request for Secret Santa.",'NewLogin',name=display_name,code=code)
+
+#####################
+# draw results
+#####################
+
+# draw result emails are sent off the request thread, progress is kept in the database per game code
+# so every process sees it, and a send that stopped part way is carried on from the last batch.
+__notify_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('NOTIFY_WORKERS',2)),thread_name_prefix='draw-notify')
+__notify_batch_size = int(os.environ.get('NOTIFY_BATCH_SIZE',500))
+# a send not updated for this long is taken to have stopped with its process.
+__notify_stale_minutes = int(os.environ.get('NOTIFY_STALE_MINUTES',10))
+
+def __ideas_html(ideas:list):
+    if len(ideas) == 0:
+        return "<p>No ideas were left for you.</p>"
+    return "<ul>{}</ul>".format(''.join("<li>{}</li>".format(escape(idea)) for idea in ideas))
+
+def __send_draw_results(code:str,results:list,claim:dict):
+    # the template is rendered once, with tokens that the transport fills in for each person.
+    message = {
+        'from': __from_address,
+        'subject': "Your Secret Santa for {}".format(results[0]['gamename']),
+        'html': resolve_template_file('DrawResults',name='-name-',giftee='-giftee-',ideas='-ideas-',gamename=escape(results[0]['gamename'])),
+    }
+    # people before the sent count were emailed by an earlier attempt.
+    sent = claim['sent']
+    recipients = [{
+        'to': result['email'],
+        'substitutions': {
+            '-name-': escape(result['name']),
+            '-giftee-': escape(result['giftee']),
+            '-ideas-': __ideas_html(result['ideas']),
+        },
+    } for result in results[sent:]]
+
+    try:
+        database.update_draw_notify(code,claim['attempts'],'sending',sent)
+        for batch_sent in transport.send_batch(message,recipients,batch_size=__notify_batch_size):
+            sent += batch_sent
+            database.update_draw_notify(code,claim['attempts'],'sending',sent)
+            print("Draw Notify: {} sent {}/{}".format(code,sent,len(results)))
+        database.update_draw_notify(code,claim['attempts'],'done',sent)
+    except Exception as e:
+        try:
+            database.update_draw_notify(code,claim['attempts'],'failed',sent,"Unable to send all emails.")
+        except Exception as update_error:
+            # left as sending, it is taken over once it is stale.
+            print("Draw Notify Error: {} unable to record failure {}".format(code,SantaErrors.exception_as_string(update_error)))
+        print("Draw Notify Error: {} {}".format(code,SantaErrors.exception_as_string(e)))
+
+def __progress(row:dict):
+    return {
+        # a send whose process stopped is reported as stalled, notifying again carries it on.
+        'state': 'stalled' if row['stale'] else row['state'],
+        'total': row['total'],
+        'sent': row['sent'],
+        'error': row['error'],
+    }
+
+def send_draw_results(code:str,results:list):
+    """
+    Start emailing each participant their giftee and ideas, returns the progress.
+    A game that is already being sent or is done is not sent again, a failed or stalled
+    send carries on after the people already emailed.
+
+    :param results: list of dicts with email,name,giftee,gamename and ideas keys, in the same order every time.
+    """
+    claim = database.claim_draw_notify(code,len(results),__notify_stale_minutes)
+    if claim is None:
+        return draw_results_progress(code)
+    if len(results) == 0 or claim['sent'] >= len(results):
+        database.update_draw_notify(code,claim['attempts'],'done',claim['sent'])
+        return draw_results_progress(code)
+    __notify_executor.submit(__send_draw_results,code,results,claim)
+    return __progress(claim)
+
+def draw_results_progress(code:str):
+    """
+    Progress of the results emails for a game, None if they have not been started.
+    """
+    row = database.get_draw_notify(code,__notify_stale_minutes)
+    if row is None:
+        return None
+    return __progress(row)
@@ -0,0 +1,155 @@
+"""
+Request metrics in the prometheus text format, for the /metrics endpoint.
+
+Recording a request only takes a lock and a few dict updates so it can be left on in prod.
+"""
+
+import threading
+
+# upper bounds in seconds for the latency histograms.
+default_buckets = (0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0)
+
+def __escape_label(value) -> str:
+    return str(value).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')
+
+def format_labels(labels:dict) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key,__escape_label(value)) for key,value in labels.items()) + '}'
+
+def format_number(value) -> str:
+    if value is None:
+        return 'NaN'
+    if isinstance(value,bool):
+        return '1' if value else '0'
+    return repr(float(value)) if isinstance(value,float) else str(value)
+
+class Histogram:
+    """
+    Counts of observations under each bucket bound, with a sum and total count.
+    Not thread safe, the Metrics lock is held when it is used.
+    """
+
+    def __init__(self,buckets=default_buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0
+        self.sum = 0.0
+
+    def observe(self,value:float):
+        self.total += 1
+        self.sum += value
+        for i,bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def lines(self,name:str,labels:dict):
+        cumulative = 0
+        for bound,count in zip(self.buckets,self.counts):
+            cumulative += count
+            yield "{}_bucket{} {}".format(name,format_labels(dict(labels,le=format_number(bound))),cumulative)
+        yield "{}_bucket{} {}".format(name,format_labels(dict(labels,le='+Inf')),self.total)
+        yield "{}_sum{} {}".format(name,format_labels(labels),format_number(self.sum))
+        yield "{}_count{} {}".format(name,format_labels(labels),self.total)
+
+class Metrics:
+    """
+    Counters and histograms for api requests, plus gauges read from other modules when rendered.
+
+    :param prefix: Start of every metric name.
+    """
+
+    def __init__(self,prefix:str='santa'):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        # (route,method,status,error_class) -> count
+        self._requests = {}
+        # route -> Histogram
+        self._latency = {}
+        self._auth_time = Histogram()
+        self._db_time = Histogram()
+        # (name, help, function returning a dict of values)
+        self._gauge_sources = []
+
+    def register_gauges(self,name:str,help_text:str,source):
+        """
+        Add gauges that are read when the metrics are rendered.
+
+        :param source: Function returning a dict of gauge name to number.
+        """
+        self._gauge_sources.append((name,help_text,source))
+
+    def request_started(self):
+        with self._lock:
+            self._in_flight += 1
+
+    def request_finished(self):
+        with self._lock:
+            self._in_flight -= 1
+
+    def record_request(self,route:str,method:str,status:str,error_class:str,latency:float,auth_time:float,db_time:float,authenticated:bool):
+        """
+        Record a completed request.
+
+        :param error_class: public, private, internal or validation for errors, empty for successful requests.
+        """
+        key = (route,method,status,error_class)
+        with self._lock:
+            self._requests[key] = self._requests.get(key,0) + 1
+            histogram = self._latency.get(route)
+            if histogram is None:
+                histogram = self._latency[route] = Histogram()
+            histogram.observe(latency)
+            self._db_time.observe(db_time)
+            if authenticated:
+                self._auth_time.observe(auth_time)
+
+    def render(self) -> str:
+        """
+        All metrics in the prometheus text exposition format.
+        """
+        lines = []
+        name = "{}_requests_total".format(self.prefix)
+        lines.append("# HELP {} Api requests by route, status and error class.".format(name))
+        lines.append("# TYPE {} counter".format(name))
+        with self._lock:
+            for (route,method,status,error_class),count in sorted(self._requests.items(),key=lambda item: tuple(str(x) for x in item[0])):
+                lines.append("{}{} {}".format(name,format_labels({'route':route,'method':method,'status':status,'error_class':error_class}),count))
+
+            name = "{}_request_duration_seconds".format(self.prefix)
+            lines.append("# HELP {} Api request latency by route.".format(name))
+            lines.append("# TYPE {} histogram".format(name))
+            for route in sorted(self._latency,key=str):
+                lines.extend(self._latency[route].lines(name,{'route':route}))
+
+            name = "{}_auth_duration_seconds".format(self.prefix)
+            lines.append("# HELP {} Time spent checking sessions in each authenticated request.".format(name))
+            lines.append("# TYPE {} histogram".format(name))
+            lines.extend(self._auth_time.lines(name,{}))
+
+            name = "{}_db_duration_seconds".format(self.prefix)
+            lines.append("# HELP {} Time spent in the database in each request.".format(name))
+            lines.append("# TYPE {} histogram".format(name))
+            lines.extend(self._db_time.lines(name,{}))
+
+            name = "{}_requests_in_flight".format(self.prefix)
+            lines.append("# HELP {} Api requests being handled.".format(name))
+            lines.append("# TYPE {} gauge".format(name))
+            lines.append("{} {}".format(name,self._in_flight))
+
+        for source_name,help_text,source in self._gauge_sources:
+            try:
+                values = source()
+            except Exception as e:
+                print("Metrics Error: unable to read {}: {}".format(source_name,str(e)))
+                continue
+            for key,value in sorted(values.items()):
+                if not isinstance(value,(int,float)) and value is not None:
+                    continue
+                name = "{}_{}_{}".format(self.prefix,source_name,key)
+                lines.append("# HELP {} {}".format(name,help_text))
+                lines.append("# TYPE {} gauge".format(name))
+                lines.append("{} {}".format(name,format_number(value)))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,91 @@
+"""
+Short lived signed session tokens, these let a verified session skip the database
+password check until the token expires.
+
+Tokens are only issued when SESSION_TOKEN_KEY is set.
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+
+import database
+
+__token_key = os.environ.get('SESSION_TOKEN_KEY','').encode('utf-8')
+__token_ttl = int(os.environ.get('SESSION_TOKEN_TTL',900))
+
+# sessions that have logged out, kept until any token they had would have expired.
+__revoked = {}
+__revoked_lock = threading.Lock()
+
+def __b64encode(data:bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+def __b64decode(data:str) -> bytes:
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+def __sign(payload:str) -> str:
+    return __b64encode(hmac.new(__token_key,payload.encode('ascii'),hashlib.sha256).digest())
+
+def tokens_enabled():
+    """
+    Tokens need a signing key of a reasonable length.
+    """
+    return len(__token_key) >= 16
+
+def issue_token(sessionid:str,identity:dict):
+    """
+    Create a signed token for a verified session.
+    Returns a dict with the token and expiry time, or an empty dict if tokens are disabled.
+    """
+    if not tokens_enabled():
+        return {}
+    expires = int(time.time()) + __token_ttl
+    payload = __b64encode(json.dumps({
+        'sid': str(sessionid),
+        'id': identity['id'],
+        'name': identity['name'],
+        'email': identity['email'],
+        'exp': expires,
+    },separators=(',',':')).encode('utf-8'))
+    return {
+        'token': "{}.{}".format(payload,__sign(payload)),
+        'token_expires': expires,
+    }
+
+def verify_token(token:str,sessionid:str):
+    """
+    Check a token, and get the identity it was issued for.
+    Returns None if the token is invalid, expired, revoked or for a different session,
+    the caller should then use the session secret instead.
+    """
+    if not tokens_enabled() or not isinstance(token,str) or token.count('.') != 1:
+        return None
+    payload,signature = token.split('.')
+    if not hmac.compare_digest(signature,__sign(payload)):
+        return None
+    try:
+        data = json.loads(__b64decode(payload))
+    except ValueError:
+        return None
+    if data['exp'] < time.time() or data['sid'] != sessionid:
+        return None
+    with __revoked_lock:
+        if data['sid'] in __revoked:
+            return None
+    return database.Identity({'id':data['id'],'name':data['name'],'email':data['email']},data['sid'])
+
+def revoke_session(sessionid:str):
+    """
+    Stop tokens for a session being accepted, called on logout.
+    """
+    now = time.time()
+    with __revoked_lock:
+        __revoked[str(sessionid)] = now + __token_ttl
+        # drop entries for tokens that have expired anyway, keeps the list small.
+        for expired in [sid for sid,until in __revoked.items() if until < now]:
+            del __revoked[expired]
@@ -0,0 +1,19 @@
+"""
+The tests run against the in memory database backend, so no postgres is needed:
+
+    python -m pytest tests
+
+The config is set here before any of the app modules are imported, as they read it on import.
+"""
+
+import os
+import sys
+
+os.environ['DATABASE_BACKEND'] = 'memory'
+os.environ['DRAW_JOBS'] = 'off'
+os.environ['MAIL_OUTBOX'] = 'off'
+os.environ.setdefault('AdminSecret','test-admin-secret')
+os.environ.setdefault('AllowTableTruncates','AllowTruncates')
+os.environ.setdefault('SESSION_TOKEN_KEY','test-session-token-key')
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,76 @@
+import types
+
+import authcache
+
+identity = {'id':1,'name':'Santa','email':'santa@example.com'}
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+def fake_clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(authcache,'time',types.SimpleNamespace(monotonic=clock.monotonic))
+    return clock
+
+def test_hit_after_put():
+    cache = authcache.SessionCache(ttl=60)
+    assert cache.get('session','secret') is None
+    cache.put('session','secret',identity)
+    assert cache.get('session','secret') == identity
+    stats = cache.stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+
+def test_wrong_secret_misses():
+    cache = authcache.SessionCache(ttl=60)
+    cache.put('session','secret',identity)
+    assert cache.get('session','other secret') is None
+    assert cache.get('other session','secret') is None
+
+def test_cached_identity_is_a_copy():
+    cache = authcache.SessionCache(ttl=60)
+    cache.put('session','secret',identity)
+    cache.get('session','secret')['name'] = 'Changed'
+    assert cache.get('session','secret')['name'] == 'Santa'
+
+def test_expiry(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    cache = authcache.SessionCache(ttl=60)
+    cache.put('session','secret',identity)
+    clock.now += 59
+    assert cache.get('session','secret') == identity
+    clock.now += 2
+    assert cache.get('session','secret') is None
+    assert cache.stats()['expirations'] == 1
+    assert cache.stats()['size'] == 0
+
+def test_invalidate_drops_every_secret_of_a_session():
+    cache = authcache.SessionCache(ttl=60)
+    cache.put('session','secret',identity)
+    cache.put('session','old secret',identity)
+    cache.put('other','secret',identity)
+    cache.invalidate('session')
+    assert cache.get('session','secret') is None
+    assert cache.get('session','old secret') is None
+    assert cache.get('other','secret') == identity
+    assert cache.stats()['invalidations'] == 2
+
+def test_least_recently_used_evicted():
+    cache = authcache.SessionCache(ttl=60,max_size=2)
+    cache.put('a','secret',identity)
+    cache.put('b','secret',identity)
+    cache.get('a','secret')
+    cache.put('c','secret',identity)
+    assert cache.get('b','secret') is None
+    assert cache.get('a','secret') == identity
+    assert cache.stats()['evictions'] == 1
+
+def test_disabled_with_zero_ttl():
+    cache = authcache.SessionCache(ttl=0)
+    cache.put('session','secret',identity)
+    assert cache.get('session','secret') is None
+    assert cache.stats()['size'] == 0
@@ -0,0 +1,41 @@
+import uuid
+
+import database
+
+def new_code():
+    return uuid.uuid4().hex[:8]
+
+def test_claim_once():
+    code = new_code()
+    claim = database.claim_draw_notify(code,10)
+    assert claim['state'] == 'queued'
+    assert claim['sent'] == 0
+    assert database.claim_draw_notify(code,10) is None
+    database.update_draw_notify(code,claim['attempts'],'done',10)
+    assert database.claim_draw_notify(code,10) is None
+    assert database.get_draw_notify(code)['state'] == 'done'
+
+def test_failed_send_resumes_after_sent():
+    code = new_code()
+    claim = database.claim_draw_notify(code,10)
+    database.update_draw_notify(code,claim['attempts'],'sending',4)
+    database.update_draw_notify(code,claim['attempts'],'failed',4,"Unable to send all emails.")
+    retry = database.claim_draw_notify(code,10)
+    assert retry['sent'] == 4
+    assert retry['attempts'] == claim['attempts'] + 1
+    assert retry['error'] is None
+    # the first attempt can no longer record progress.
+    database.update_draw_notify(code,claim['attempts'],'done',10)
+    assert database.get_draw_notify(code)['state'] == 'queued'
+
+def test_stale_send_is_taken_over():
+    code = new_code()
+    claim = database.claim_draw_notify(code,10)
+    database.update_draw_notify(code,claim['attempts'],'sending',2)
+    assert database.claim_draw_notify(code,10) is None
+    assert database.get_draw_notify(code,stale_minutes=-1)['stale']
+    retry = database.claim_draw_notify(code,10,stale_minutes=-1)
+    assert retry['sent'] == 2
+
+def test_no_progress_before_claim():
+    assert database.get_draw_notify(new_code()) is None
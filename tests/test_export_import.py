@@ -0,0 +1,69 @@
+import datetime
+import os
+
+import pytest
+
+import SantaErrors
+import database
+import dbcommon
+import santaexport
+import santaimport
+from dbcommon import Identity
+
+admin_key = os.environ['AdminSecret']
+
+def identity(email:str,name:str):
+    return Identity(database.register_user(email,name)[0],None)
+
+def snapshot():
+    rows = {table:[] for table in dbcommon.export_columns}
+    for table,row in database.iter_tables(admin_key,list(dbcommon.export_columns)):
+        rows[table].append(row)
+    return {table:sorted(table_rows) for table,table_rows in rows.items()}
+
+@pytest.fixture
+def games():
+    owner = identity('owner@example.com','Owner')
+    drawn = database.new_game('Drawn, with "quotes"','drawn001',owner,None)[0]
+    players = [identity('player{}@example.com'.format(i),'Player {}'.format(i)) for i in range(4)]
+    for player in players:
+        database.join_game(player['name'],drawn['code'],player,None)
+        database.new_idea(drawn['code'],"Socks\nfrom {}".format(player['name']),player,None)
+    users = [row['id'] for row in database.get_users({'game':drawn['id']})]
+    ideas = [row['id'] for row in database.get_idea({'game':drawn['id']})]
+    database.draw_game(drawn['code'],
+        [(user,users[(i + 1) % len(users)]) for i,user in enumerate(users)],
+        [(idea,users[(i + 2) % len(users)]) for i,idea in enumerate(ideas)],
+        owner,None)
+    open_game = database.new_game('Open','open0001',owner,None)[0]
+    database.join_game('Owner',open_game['code'],owner,None)
+    database.set_draw_date(open_game['code'],datetime.datetime(2026,12,1,18,30),owner,None)
+    yield
+    database.bulk_import(admin_key,{table:(columns,[]) for table,columns in dbcommon.export_columns.items()})
+
+@pytest.mark.parametrize('file_format',['ndjson','csv'])
+def test_export_import_round_trip(games,tmp_path,file_format):
+    before = snapshot()
+    assert len(before['users']) == 5
+    summary = santaexport.export_to_directory(admin_key,str(tmp_path),file_format)
+    assert summary['tables'] == {table:len(rows) for table,rows in before.items()}
+
+    # changes after the export are undone by the import.
+    extra = identity('late@example.com','Late')
+    database.new_game('Late','late0001',extra,None)
+
+    summary = santaimport.import_from_directory(admin_key,str(tmp_path))
+    assert summary['tables'] == {table:len(rows) for table,rows in before.items()}
+    assert snapshot() == before
+    assert database.get_game({'code':'late0001'}) == []
+    assert database.get_game({'code':'drawn001'},['name','state'])[0] == {'name':'Drawn, with "quotes"','state':1}
+
+def test_import_checks_before_replacing(games,tmp_path):
+    before = snapshot()
+    santaexport.export_to_directory(admin_key,str(tmp_path),'ndjson')
+    with open(os.path.join(str(tmp_path),'users.ndjson'),'a',encoding='utf-8') as users_file:
+        users_file.write('{"id": 999, "game": 12345, "name": "Nobody", "santa": -1, "account_id": null, "draw_group": null}\n')
+    with pytest.raises(SantaErrors.ImportValidationError) as error:
+        santaimport.import_from_directory(admin_key,str(tmp_path))
+    assert 'users in unknown games' in str(error.value)
+    assert snapshot() == before
@@ -0,0 +1,125 @@
+import threading
+import types
+
+import pytest
+
+import gamecache
+
+class Loader:
+    """
+    load function for GameCache.get that counts its calls.
+    """
+
+    def __init__(self,games:dict):
+        self.games = games
+        self.calls = 0
+
+    def __call__(self,code:str):
+        self.calls += 1
+        game = self.games.get(code)
+        return dict(game) if game is not None else None
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+def fake_clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(gamecache,'time',types.SimpleNamespace(monotonic=clock.monotonic))
+    return clock
+
+def test_hit_after_load():
+    load = Loader({'abc':{'id':1,'name':'Game'}})
+    cache = gamecache.GameCache(ttl=30)
+    assert cache.get('abc',load) == {'id':1,'name':'Game'}
+    assert cache.get('abc',load) == {'id':1,'name':'Game'}
+    assert load.calls == 1
+    assert cache.stats()['hits'] == 1
+
+def test_missing_games_are_not_cached():
+    load = Loader({})
+    cache = gamecache.GameCache(ttl=30)
+    assert cache.get('abc',load) is None
+    load.games['abc'] = {'id':1}
+    assert cache.get('abc',load) == {'id':1}
+    assert load.calls == 2
+
+def test_cached_game_is_a_copy():
+    load = Loader({'abc':{'id':1,'name':'Game'}})
+    cache = gamecache.GameCache(ttl=30)
+    cache.get('abc',load)['name'] = 'Changed'
+    assert cache.get('abc',load)['name'] == 'Game'
+
+def test_expiry(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    load = Loader({'abc':{'id':1,'state':0}})
+    cache = gamecache.GameCache(ttl=30)
+    cache.get('abc',load)
+    load.games['abc'] = {'id':1,'state':1}
+    clock.now += 29
+    assert cache.get('abc',load)['state'] == 0
+    clock.now += 2
+    assert cache.get('abc',load)['state'] == 1
+    assert load.calls == 2
+    assert cache.stats()['expirations'] == 1
+
+def test_invalidate():
+    load = Loader({'abc':{'id':1,'state':0}})
+    cache = gamecache.GameCache(ttl=30)
+    cache.get('abc',load)
+    load.games['abc'] = {'id':1,'state':1}
+    cache.invalidate('abc')
+    assert cache.get('abc',load)['state'] == 1
+    assert cache.stats()['invalidations'] == 1
+
+def test_invalidate_during_load_is_not_cached():
+    cache = gamecache.GameCache(ttl=30)
+    load = Loader({'abc':{'id':1,'state':1}})
+    def changed_while_loading(code):
+        cache.invalidate(code)
+        return {'id':1,'state':0}
+    assert cache.get('abc',changed_while_loading)['state'] == 0
+    assert cache.get('abc',load)['state'] == 1
+
+def test_concurrent_misses_share_one_load():
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+    def slow_load(code):
+        calls.append(code)
+        started.set()
+        release.wait(5)
+        return {'id':1}
+    cache = gamecache.GameCache(ttl=30)
+    results = []
+    first = threading.Thread(target=lambda: results.append(cache.get('abc',slow_load)))
+    first.start()
+    started.wait(5)
+    second = threading.Thread(target=lambda: results.append(cache.get('abc',slow_load)))
+    second.start()
+    # the second miss waits on the first load rather than running its own.
+    while cache.stats()['coalesced'] == 0 and second.is_alive():
+        second.join(0.01)
+    release.set()
+    first.join(5)
+    second.join(5)
+    assert results == [{'id':1},{'id':1}]
+    assert calls == ['abc']
+
+def test_load_errors_are_raised_and_not_cached():
+    cache = gamecache.GameCache(ttl=30)
+    def failing_load(code):
+        raise ConnectionError("database down")
+    with pytest.raises(ConnectionError):
+        cache.get('abc',failing_load)
+    assert cache.get('abc',Loader({'abc':{'id':1}})) == {'id':1}
+
+def test_disabled_with_zero_ttl():
+    load = Loader({'abc':{'id':1}})
+    cache = gamecache.GameCache(ttl=0)
+    cache.get('abc',load)
+    cache.get('abc',load)
+    assert load.calls == 2
@@ -0,0 +1,101 @@
+import itertools
+import random
+
+import pytest
+
+import SantaErrors
+import santadraw
+
+def assert_valid(people,exclusions,groups,result):
+    assignments = dict(result['assignments'])
+    assert sorted(assignments) == sorted(people)
+    assert sorted(assignments.values()) == sorted(people)
+    excluded = set(map(tuple,exclusions))
+    for santa,giftee in assignments.items():
+        assert santa != giftee
+        assert (santa,giftee) not in excluded
+        if groups and santa in groups and giftee in groups:
+            assert groups[santa] != groups[giftee]
+
+def cycle_count(assignments:list):
+    giftee_of = dict(assignments)
+    seen = set()
+    cycles = 0
+    for person in giftee_of:
+        if person in seen:
+            continue
+        cycles += 1
+        while person not in seen:
+            seen.add(person)
+            person = giftee_of[person]
+    return cycles
+
+def test_draw_is_derangement():
+    people = list(range(1,101))
+    result = santadraw.draw(people,rng=random.Random(1))
+    assert_valid(people,[],None,result)
+    assert result['people'] == 100
+    assert cycle_count(result['assignments']) == 1
+
+def test_draw_keeps_to_exclusions():
+    rng = random.Random(2)
+    people = list(range(1,501))
+    exclusions = [(person,rng.randint(1,500)) for person in people for _ in range(10)]
+    result = santadraw.draw(people,exclusions,rng=rng)
+    assert_valid(people,exclusions,None,result)
+
+def test_draw_keeps_to_groups():
+    people = list(range(1,201))
+    groups = {person:person % 4 for person in people}
+    result = santadraw.draw(people,[],groups,rng=random.Random(3))
+    assert_valid(people,[],groups,result)
+
+def test_draw_accepts_list_pairs_and_people_not_in_the_draw():
+    people = [1,2,3,4]
+    exclusions = [[1,2],[2,3],[9,1],[1,9]]
+    result = santadraw.draw(people,exclusions,rng=random.Random(4))
+    assert_valid(people,exclusions,None,result)
+
+def test_draw_needs_augmenting_paths_when_tight():
+    result = santadraw.benchmark_tight(300,3,seed=5)
+    assert result['augmented'] > 0
+    assert result['people'] == 300
+
+# 0 keeps the exclusions as pairs, a huge value always sorts them out by santa.
+@pytest.mark.parametrize('dense_exclusions',[0,10 ** 9])
+@pytest.mark.parametrize('seed',range(40))
+def test_draw_matches_brute_force(seed,dense_exclusions,monkeypatch):
+    monkeypatch.setattr(santadraw,'dense_exclusions',dense_exclusions)
+    rng = random.Random(seed)
+    people = list(range(rng.randint(2,7)))
+    density = rng.random()
+    exclusions = [(a,b) for a in people for b in people if a != b and rng.random() < density]
+    groups = {person:rng.randint(0,len(people)) for person in people} if seed % 2 else None
+    excluded = set(exclusions)
+    def allowed(santa,giftee):
+        return santa != giftee and (santa,giftee) not in excluded and not (groups and groups[santa] == groups[giftee])
+    possible = any(all(allowed(santa,giftee) for santa,giftee in zip(people,order)) for order in itertools.permutations(people))
+    if possible:
+        assert_valid(people,exclusions,groups,santadraw.draw(people,exclusions,groups,rng=rng))
+    else:
+        with pytest.raises(SantaErrors.DrawImpossible):
+            santadraw.draw(people,exclusions,groups,rng=rng)
+
+def test_draw_impossible_exclusions():
+    people = [1,2,3,4]
+    # nobody can draw 4.
+    exclusions = [(1,4),(2,4),(3,4)]
+    with pytest.raises(SantaErrors.DrawImpossible):
+        santadraw.draw(people,exclusions)
+
+def test_draw_impossible_group_over_half():
+    people = [1,2,3,4,5]
+    groups = {1:'a',2:'a',3:'a'}
+    with pytest.raises(SantaErrors.DrawImpossible):
+        santadraw.draw(people,[],groups)
+
+def test_draw_impossible_too_few_or_repeated_people():
+    with pytest.raises(SantaErrors.DrawImpossible):
+        santadraw.draw([1])
+    with pytest.raises(SantaErrors.DrawImpossible):
+        santadraw.draw([1,2,2])
@@ -0,0 +1,52 @@
+import time
+import types
+import uuid
+
+import santatokens
+
+identity = {'id':7,'name':'Santa','email':'santa@example.com'}
+
+def new_session():
+    return str(uuid.uuid4())
+
+def test_tokens_enabled_with_key():
+    assert santatokens.tokens_enabled()
+
+def test_issue_and_verify():
+    session = new_session()
+    issued = santatokens.issue_token(session,identity)
+    assert issued['token_expires'] > time.time()
+    verified = santatokens.verify_token(issued['token'],session)
+    assert verified is not None
+    assert verified.sessionid == session
+    assert verified['id'] == 7
+    assert verified['email'] == 'santa@example.com'
+
+def test_verify_rejects_other_session():
+    issued = santatokens.issue_token(new_session(),identity)
+    assert santatokens.verify_token(issued['token'],new_session()) is None
+
+def test_verify_rejects_tampered_token():
+    session = new_session()
+    payload,signature = santatokens.issue_token(session,identity)['token'].split('.')
+    other_payload = santatokens.issue_token(session,dict(identity,id=8))['token'].split('.')[0]
+    assert santatokens.verify_token("{}.{}".format(other_payload,signature),session) is None
+    assert santatokens.verify_token("{}.{}x".format(payload,signature),session) is None
+    assert santatokens.verify_token(payload,session) is None
+    assert santatokens.verify_token(None,session) is None
+
+def test_verify_rejects_expired_token(monkeypatch):
+    session = new_session()
+    issued = santatokens.issue_token(session,identity)
+    later = issued['token_expires'] + 1
+    monkeypatch.setattr(santatokens,'time',types.SimpleNamespace(time=lambda: later))
+    assert santatokens.verify_token(issued['token'],session) is None
+
+def test_revoked_session_is_rejected():
+    session = new_session()
+    other = new_session()
+    token = santatokens.issue_token(session,identity)['token']
+    other_token = santatokens.issue_token(other,identity)['token']
+    santatokens.revoke_session(session)
+    assert santatokens.verify_token(token,session) is None
+    assert santatokens.verify_token(other_token,other) is not None